@@ -8,6 +8,11 @@ import os
 import sys
 from pathlib import Path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + './../..')
+from table_loader import prefetch
+from chunk_sink import ChunkSink
+from feature_store import load_feature, iter_feature, offset_minutes, offset_hours
+from feature_dictionary import decode_columns, vocab_list
+from sparse_pivot import pivot_sparse
 if not os.path.exists("./data/dict"):
     os.makedirs("./data/dict")
     
@@ -59,29 +64,21 @@ class Generator():
         data=pd.read_csv(f"./data/cohort/{self.cohort_output}.csv.gz", compression='gzip', header=0, index_col=None)
         data['admittime'] = pd.to_datetime(data['admittime'])
         data['dischtime'] = pd.to_datetime(data['dischtime'])
-        data['los']=pd.to_timedelta(data['dischtime']-data['admittime'],unit='h')
-        data['los']=data['los'].astype(str)
-        data[['days', 'dummy','hours']] = data['los'].str.split(' ', -1, expand=True)
-        data[['hours','min','sec']] = data['hours'].str.split(':', -1, expand=True)
-        data['los']=pd.to_numeric(data['days'])*24+pd.to_numeric(data['hours'])
-        data=data.drop(columns=['days', 'dummy','hours','min','sec'])
+        data['los']=offset_hours(offset_minutes(data['dischtime']-data['admittime']))
         data=data[data['los']>0]
         data['Age']=data['Age'].astype(int)
         return data
     
     def generate_cond(self):
-        cond=pd.read_csv("./data/features/preproc_diag.csv.gz", compression='gzip', header=0, index_col=None)
+        cond=load_feature('preproc_diag')
         cond=cond[cond['hadm_id'].isin(self.data['hadm_id'])]
         cond_per_adm = cond.groupby('hadm_id').size().max()
         self.cond, self.cond_per_adm = cond, cond_per_adm
     
     def generate_proc(self):
-        proc=pd.read_csv("./data/features/preproc_proc.csv.gz", compression='gzip', header=0, index_col=None)
+        proc=load_feature('preproc_proc')
         proc=proc[proc['hadm_id'].isin(self.data['hadm_id'])]
-        proc[['start_days', 'dummy','start_hours']] = proc['proc_time_from_admit'].str.split(' ', -1, expand=True)
-        proc[['start_hours','min','sec']] = proc['start_hours'].str.split(':', -1, expand=True)
-        proc['start_time']=pd.to_numeric(proc['start_days'])*24+pd.to_numeric(proc['start_hours'])
-        proc=proc.drop(columns=['start_days', 'dummy','start_hours','min','sec'])
+        proc['start_time']=offset_hours(proc['proc_time_from_admit'])
         proc=proc[proc['start_time']>=0]
         
         ###Remove where event time is after discharge time
@@ -94,13 +91,10 @@ class Generator():
         
     def generate_labs(self):
         chunksize = 10000000
-        final=pd.DataFrame()
-        for labs in tqdm(pd.read_csv("./data/features/preproc_labs.csv.gz", compression='gzip', header=0, index_col=None,chunksize=chunksize)):
+        sink=ChunkSink()
+        for labs in tqdm(prefetch(iter_feature('preproc_labs', chunksize))):
             labs=labs[labs['hadm_id'].isin(self.data['hadm_id'])]
-            labs[['start_days', 'dummy','start_hours']] = labs['lab_time_from_admit'].str.split(' ', -1, expand=True)
-            labs[['start_hours','min','sec']] = labs['start_hours'].str.split(':', -1, expand=True)
-            labs['start_time']=pd.to_numeric(labs['start_days'])*24+pd.to_numeric(labs['start_hours'])
-            labs=labs.drop(columns=['start_days', 'dummy','start_hours','min','sec'])
+            labs['start_time']=offset_hours(labs['lab_time_from_admit'])
             labs=labs[labs['start_time']>=0]
 
             ###Remove where event time is after discharge time
@@ -109,22 +103,14 @@ class Generator():
             labs=labs[labs['sanity']>0]
             del labs['sanity']
             
-            if final.empty:
-                final=labs
-            else:
-                final=final.append(labs, ignore_index=True)
+            sink.append(labs)
 
-        self.labs=final
+        self.labs=sink.result()
         
     def generate_meds(self):
-        meds=pd.read_csv("./data/features/preproc_med.csv.gz", compression='gzip', header=0, index_col=None)
-        meds[['start_days', 'dummy','start_hours']] = meds['start_hours_from_admit'].str.split(' ', -1, expand=True)
-        meds[['start_hours','min','sec']] = meds['start_hours'].str.split(':', -1, expand=True)
-        meds['start_time']=pd.to_numeric(meds['start_days'])*24+pd.to_numeric(meds['start_hours'])
-        meds[['start_days', 'dummy','start_hours']] = meds['stop_hours_from_admit'].str.split(' ', -1, expand=True)
-        meds[['start_hours','min','sec']] = meds['start_hours'].str.split(':', -1, expand=True)
-        meds['stop_time']=pd.to_numeric(meds['start_days'])*24+pd.to_numeric(meds['start_hours'])
-        meds=meds.drop(columns=['start_days', 'dummy','start_hours','min','sec'])
+        meds=load_feature('preproc_med')
+        meds['start_time']=offset_hours(meds['start_hours_from_admit'])
+        meds['stop_time']=offset_hours(meds['stop_hours_from_admit'])
         #####Sanity check
         meds['sanity']=meds['stop_time']-meds['start_time']
         meds=meds[meds['sanity']>0]
@@ -241,9 +227,9 @@ class Generator():
 
             
     def smooth_meds(self,bucket):
-        final_meds=pd.DataFrame()
-        final_proc=pd.DataFrame()
-        final_labs=pd.DataFrame()
+        final_meds=ChunkSink(ignore_index=False)
+        final_proc=ChunkSink(ignore_index=False)
+        final_labs=ChunkSink(ignore_index=False)
         
         if(self.feat_med):
             self.meds=self.meds.sort_values(by=['start_time'])
@@ -258,33 +244,27 @@ class Generator():
                 sub_meds=sub_meds.reset_index()
                 sub_meds['start_time']=t
                 sub_meds['stop_time']=sub_meds['stop_time']/bucket
-                if final_meds.empty:
-                    final_meds=sub_meds
-                else:
-                    final_meds=final_meds.append(sub_meds)
+                final_meds.append(sub_meds)
             
             ###PROC
              if(self.feat_proc):
                 sub_proc=self.proc[(self.proc['start_time']>=i) & (self.proc['start_time']<i+bucket)].groupby(['hadm_id','icd_code']).agg({'subject_id':'max'})
                 sub_proc=sub_proc.reset_index()
                 sub_proc['start_time']=t
-                if final_proc.empty:
-                    final_proc=sub_proc
-                else:    
-                    final_proc=final_proc.append(sub_proc)
+                final_proc.append(sub_proc)
                     
             ###LABS
              if(self.feat_lab):
                 sub_labs=self.labs[(self.labs['start_time']>=i) & (self.labs['start_time']<i+bucket)].groupby(['hadm_id','itemid']).agg({'subject_id':'max','valuenum':np.nanmean})
                 sub_labs=sub_labs.reset_index()
                 sub_labs['start_time']=t
-                if final_labs.empty:
-                    final_labs=sub_labs
-                else:    
-                    final_labs=final_labs.append(sub_labs)
+                final_labs.append(sub_labs)
             
              t=t+1
         los=int(self.los/bucket)
+        final_meds=final_meds.result()
+        final_proc=final_proc.result()
+        final_labs=final_labs.result()
         
         ###MEDS
         if(self.feat_med):
@@ -310,6 +290,13 @@ class Generator():
         
         
     def create_Dict(self,meds,proc,labs,los):
+        # identifiers are dictionary codes (feature_dictionary.py) up to here, the dictionaries and csv files hold their values
+        meds,proc,labs=decode_columns(meds),decode_columns(proc),decode_columns(labs)
+        if(self.feat_cond):
+            self.cond=decode_columns(self.cond)
+            # multi-hot condition rows of all the admissions at once, the static features of each one are a row of it
+            cond_matrix,cond_index,cond_codes=pivot_sparse(self.cond,'new_icd_code',index_cols=['hadm_id'])
+            cond_rows=pd.Series(np.arange(len(cond_index)),index=cond_index['hadm_id'].values)
         print("[ CREATING DATA DICTIONARIES ]")
         dataDic={}
         labels_csv=pd.DataFrame(columns=['hadm_id','label'])
@@ -476,13 +463,8 @@ class Generator():
                     grp.columns=pd.MultiIndex.from_product([["COND"], grp.columns])
                 else:
                     dataDic[hid]['Cond']={'fids':list(grp['new_icd_code'])}
-                    grp['val']=1
-                    grp=grp.drop_duplicates()
-                    grp=grp.pivot(index='hadm_id',columns='new_icd_code',values='val').reset_index(drop=True)
-                    feat_df=pd.DataFrame(columns=list(set(feat)-set(grp.columns)))
-                    grp=pd.concat([grp,feat_df],axis=1)
-                    grp=grp.fillna(0)
-                    grp=grp[feat]
+                    grp=pd.DataFrame(cond_matrix[cond_rows[hid]].toarray().astype(int),columns=cond_codes.values)
+                    grp=grp.reindex(columns=feat,fill_value=0)
                     grp.columns=pd.MultiIndex.from_product([["COND"], grp.columns])
             grp.to_csv('./data/csv/'+str(hid)+'/static.csv',index=False)   
             labels_csv.to_csv('./data/csv/labels.csv',index=False)    
@@ -511,25 +493,25 @@ class Generator():
             
         if(self.feat_med):
             with open("./data/dict/medVocab", 'wb') as fp:
-                pickle.dump(list(meds['drug_name'].unique()), fp)
+                pickle.dump(vocab_list(meds['drug_name'], 'drug_name'), fp)
             self.med_vocab = meds['drug_name'].nunique()
             metaDic['Med']=self.med_per_adm
         
         if(self.feat_cond):
             with open("./data/dict/condVocab", 'wb') as fp:
-                pickle.dump(list(self.cond['new_icd_code'].unique()), fp)
+                pickle.dump(vocab_list(self.cond['new_icd_code'], 'icd_code'), fp)
             self.cond_vocab = self.cond['new_icd_code'].nunique()
             metaDic['Cond']=self.cond_per_adm
         
         if(self.feat_proc):    
             with open("./data/dict/procVocab", 'wb') as fp:
-                pickle.dump(list(proc['icd_code'].unique()), fp)
+                pickle.dump(vocab_list(proc['icd_code'], 'icd_code'), fp)
             self.proc_vocab = proc['icd_code'].unique()
             metaDic['Proc']=self.proc_per_adm
             
         if(self.feat_lab):    
             with open("./data/dict/labsVocab", 'wb') as fp:
-                pickle.dump(list(labs['itemid'].unique()), fp)
+                pickle.dump(vocab_list(labs['itemid'], 'itemid'), fp)
             self.lab_vocab = labs['itemid'].unique()
             metaDic['Lab']=self.labs_per_adm
             
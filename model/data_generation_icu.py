@@ -9,6 +9,11 @@ import os
 import sys
 from pathlib import Path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + './../..')
+from table_loader import prefetch
+from chunk_sink import ChunkSink
+from feature_store import load_feature, iter_feature, offset_minutes, offset_hours
+from feature_dictionary import decode_columns, vocab_list
+from sparse_pivot import pivot_sparse
 if not os.path.exists("./data/dict"):
     os.makedirs("./data/dict")
 if not os.path.exists("./data/csv"):
@@ -59,12 +64,7 @@ class Generator():
         data=pd.read_csv(f"./data/cohort/{self.cohort_output}.csv.gz", compression='gzip', header=0, index_col=None)
         data['intime'] = pd.to_datetime(data['intime'])
         data['outtime'] = pd.to_datetime(data['outtime'])
-        data['los']=pd.to_timedelta(data['outtime']-data['intime'],unit='h')
-        data['los']=data['los'].astype(str)
-        data[['days', 'dummy','hours']] = data['los'].str.split(' ', -1, expand=True)
-        data[['hours','min','sec']] = data['hours'].str.split(':', -1, expand=True)
-        data['los']=pd.to_numeric(data['days'])*24+pd.to_numeric(data['hours'])
-        data=data.drop(columns=['days', 'dummy','hours','min','sec'])
+        data['los']=offset_hours(offset_minutes(data['outtime']-data['intime']))
         data=data[data['los']>0]
         data['Age']=data['Age'].astype(int)
         #print(data.head())
@@ -72,18 +72,15 @@ class Generator():
         return data
     
     def generate_cond(self):
-        cond=pd.read_csv("./data/features/preproc_diag_icu.csv.gz", compression='gzip', header=0, index_col=None)
+        cond=load_feature('preproc_diag_icu')
         cond=cond[cond['stay_id'].isin(self.data['stay_id'])]
         cond_per_adm = cond.groupby('stay_id').size().max()
         self.cond, self.cond_per_adm = cond, cond_per_adm
     
     def generate_proc(self):
-        proc=pd.read_csv("./data/features/preproc_proc_icu.csv.gz", compression='gzip', header=0, index_col=None)
+        proc=load_feature('preproc_proc_icu')
         proc=proc[proc['stay_id'].isin(self.data['stay_id'])]
-        proc[['start_days', 'dummy','start_hours']] = proc['event_time_from_admit'].str.split(' ', -1, expand=True)
-        proc[['start_hours','min','sec']] = proc['start_hours'].str.split(':', -1, expand=True)
-        proc['start_time']=pd.to_numeric(proc['start_days'])*24+pd.to_numeric(proc['start_hours'])
-        proc=proc.drop(columns=['start_days', 'dummy','start_hours','min','sec'])
+        proc['start_time']=offset_hours(proc['event_time_from_admit'])
         proc=proc[proc['start_time']>=0]
         
         ###Remove where event time is after discharge time
@@ -95,12 +92,9 @@ class Generator():
         self.proc=proc
         
     def generate_out(self):
-        out=pd.read_csv("./data/features/preproc_out_icu.csv.gz", compression='gzip', header=0, index_col=None)
+        out=load_feature('preproc_out_icu')
         out=out[out['stay_id'].isin(self.data['stay_id'])]
-        out[['start_days', 'dummy','start_hours']] = out['event_time_from_admit'].str.split(' ', -1, expand=True)
-        out[['start_hours','min','sec']] = out['start_hours'].str.split(':', -1, expand=True)
-        out['start_time']=pd.to_numeric(out['start_days'])*24+pd.to_numeric(out['start_hours'])
-        out=out.drop(columns=['start_days', 'dummy','start_hours','min','sec'])
+        out['start_time']=offset_hours(out['event_time_from_admit'])
         out=out[out['start_time']>=0]
         
         ###Remove where event time is after discharge time
@@ -114,13 +108,11 @@ class Generator():
         
     def generate_chart(self):
         chunksize = 5000000
-        final=pd.DataFrame()
-        for chart in tqdm(pd.read_csv("./data/features/preproc_chart_icu.csv.gz", compression='gzip', header=0, index_col=None,chunksize=chunksize)):
+        sink=ChunkSink()
+        for chart in tqdm(prefetch(iter_feature('preproc_chart_icu', chunksize))):
             chart=chart[chart['stay_id'].isin(self.data['stay_id'])]
-            chart[['start_days', 'dummy','start_hours']] = chart['event_time_from_admit'].str.split(' ', -1, expand=True)
-            chart[['start_hours','min','sec']] = chart['start_hours'].str.split(':', -1, expand=True)
-            chart['start_time']=pd.to_numeric(chart['start_days'])*24+pd.to_numeric(chart['start_hours'])
-            chart=chart.drop(columns=['start_days', 'dummy','start_hours','min','sec','event_time_from_admit'])
+            chart['start_time']=offset_hours(chart['event_time_from_admit'])
+            chart=chart.drop(columns=['event_time_from_admit'])
             chart=chart[chart['start_time']>=0]
 
             ###Remove where event time is after discharge time
@@ -130,24 +122,16 @@ class Generator():
             del chart['sanity']
             del chart['los']
             
-            if final.empty:
-                final=chart
-            else:
-                final=final.append(chart, ignore_index=True)
+            sink.append(chart)
         
-        self.chart=final
+        self.chart=sink.result()
         
         
         
     def generate_meds(self):
-        meds=pd.read_csv("./data/features/preproc_med_icu.csv.gz", compression='gzip', header=0, index_col=None)
-        meds[['start_days', 'dummy','start_hours']] = meds['start_hours_from_admit'].str.split(' ', -1, expand=True)
-        meds[['start_hours','min','sec']] = meds['start_hours'].str.split(':', -1, expand=True)
-        meds['start_time']=pd.to_numeric(meds['start_days'])*24+pd.to_numeric(meds['start_hours'])
-        meds[['start_days', 'dummy','start_hours']] = meds['stop_hours_from_admit'].str.split(' ', -1, expand=True)
-        meds[['start_hours','min','sec']] = meds['start_hours'].str.split(':', -1, expand=True)
-        meds['stop_time']=pd.to_numeric(meds['start_days'])*24+pd.to_numeric(meds['start_hours'])
-        meds=meds.drop(columns=['start_days', 'dummy','start_hours','min','sec'])
+        meds=load_feature('preproc_med_icu')
+        meds['start_time']=offset_hours(meds['start_hours_from_admit'])
+        meds['stop_time']=offset_hours(meds['stop_hours_from_admit'])
         #####Sanity check
         meds['sanity']=meds['stop_time']-meds['start_time']
         meds=meds[meds['sanity']>0]
@@ -284,10 +268,10 @@ class Generator():
         
             
     def smooth_meds(self,bucket):
-        final_meds=pd.DataFrame()
-        final_proc=pd.DataFrame()
-        final_out=pd.DataFrame()
-        final_chart=pd.DataFrame()
+        final_meds=ChunkSink(ignore_index=False)
+        final_proc=ChunkSink(ignore_index=False)
+        final_out=ChunkSink(ignore_index=False)
+        final_chart=ChunkSink(ignore_index=False)
         
         if(self.feat_med):
             self.meds=self.meds.sort_values(by=['start_time'])
@@ -306,30 +290,21 @@ class Generator():
                 sub_meds=sub_meds.reset_index()
                 sub_meds['start_time']=t
                 sub_meds['stop_time']=sub_meds['stop_time']/bucket
-                if final_meds.empty:
-                    final_meds=sub_meds
-                else:
-                    final_meds=final_meds.append(sub_meds)
+                final_meds.append(sub_meds)
             
             ###PROC
              if(self.feat_proc):
                 sub_proc=self.proc[(self.proc['start_time']>=i) & (self.proc['start_time']<i+bucket)].groupby(['stay_id','itemid']).agg({'subject_id':'max'})
                 sub_proc=sub_proc.reset_index()
                 sub_proc['start_time']=t
-                if final_proc.empty:
-                    final_proc=sub_proc
-                else:    
-                    final_proc=final_proc.append(sub_proc)
+                final_proc.append(sub_proc)
                     
               ###OUT
              if(self.feat_out):
                 sub_out=self.out[(self.out['start_time']>=i) & (self.out['start_time']<i+bucket)].groupby(['stay_id','itemid']).agg({'subject_id':'max'})
                 sub_out=sub_out.reset_index()
                 sub_out['start_time']=t
-                if final_out.empty:
-                    final_out=sub_out
-                else:    
-                    final_out=final_out.append(sub_out)
+                final_out.append(sub_out)
                     
                     
               ###CHART
@@ -337,14 +312,15 @@ class Generator():
                 sub_chart=self.chart[(self.chart['start_time']>=i) & (self.chart['start_time']<i+bucket)].groupby(['stay_id','itemid']).agg({'valuenum':np.nanmean})
                 sub_chart=sub_chart.reset_index()
                 sub_chart['start_time']=t
-                if final_chart.empty:
-                    final_chart=sub_chart
-                else:    
-                    final_chart=final_chart.append(sub_chart)
+                final_chart.append(sub_chart)
             
              t=t+1
         print("bucket",bucket)
         los=int(self.los/bucket)
+        final_meds=final_meds.result()
+        final_proc=final_proc.result()
+        final_out=final_out.result()
+        final_chart=final_chart.result()
         
         
         ###MEDS
@@ -381,6 +357,7 @@ class Generator():
         
     
     def create_chartDict(self,chart,los):
+        chart=decode_columns(chart)
         dataDic={}
         for hid in self.hids:
             grp=self.data[self.data['stay_id']==hid]
@@ -429,7 +406,7 @@ class Generator():
 
       
         with open("./data/dict/chartVocab", 'wb') as fp:
-            pickle.dump(list(chart['itemid'].unique()), fp)
+            pickle.dump(vocab_list(chart['itemid'], 'itemid'), fp)
         self.chart_vocab = chart['itemid'].nunique()
         metaDic['Chart']=self.chart_per_adm
         
@@ -439,6 +416,13 @@ class Generator():
             
             
     def create_Dict(self,meds,proc,out,chart,los):
+        # identifiers are dictionary codes (feature_dictionary.py) up to here, the dictionaries and csv files hold their values
+        meds,proc,out,chart=decode_columns(meds),decode_columns(proc),decode_columns(out),decode_columns(chart)
+        if(self.feat_cond):
+            self.cond=decode_columns(self.cond)
+            # multi-hot condition rows of all the admissions at once, the static features of each one are a row of it
+            cond_matrix,cond_index,cond_codes=pivot_sparse(self.cond,'new_icd_code',index_cols=['stay_id'])
+            cond_rows=pd.Series(np.arange(len(cond_index)),index=cond_index['stay_id'].values)
         dataDic={}
         print(los)
         labels_csv=pd.DataFrame(columns=['stay_id','label'])
@@ -662,13 +646,8 @@ class Generator():
                     grp.columns=pd.MultiIndex.from_product([["COND"], grp.columns])
                 else:
                     dataDic[hid]['Cond']={'fids':list(grp['new_icd_code'])}
-                    grp['val']=1
-                    grp=grp.drop_duplicates()
-                    grp=grp.pivot(index='stay_id',columns='new_icd_code',values='val').reset_index(drop=True)
-                    feat_df=pd.DataFrame(columns=list(set(feat)-set(grp.columns)))
-                    grp=pd.concat([grp,feat_df],axis=1)
-                    grp=grp.fillna(0)
-                    grp=grp[feat]
+                    grp=pd.DataFrame(cond_matrix[cond_rows[hid]].toarray().astype(int),columns=cond_codes.values)
+                    grp=grp.reindex(columns=feat,fill_value=0)
                     grp.columns=pd.MultiIndex.from_product([["COND"], grp.columns])
             grp.to_csv('./data/csv/'+str(hid)+'/static.csv',index=False)   
             labels_csv.to_csv('./data/csv/labels.csv',index=False)    
@@ -697,31 +676,31 @@ class Generator():
             
         if(self.feat_med):
             with open("./data/dict/medVocab", 'wb') as fp:
-                pickle.dump(list(meds['itemid'].unique()), fp)
+                pickle.dump(vocab_list(meds['itemid'], 'itemid'), fp)
             self.med_vocab = meds['itemid'].nunique()
             metaDic['Med']=self.med_per_adm
             
         if(self.feat_out):
             with open("./data/dict/outVocab", 'wb') as fp:
-                pickle.dump(list(out['itemid'].unique()), fp)
+                pickle.dump(vocab_list(out['itemid'], 'itemid'), fp)
             self.out_vocab = out['itemid'].nunique()
             metaDic['Out']=self.out_per_adm
             
         if(self.feat_chart):
             with open("./data/dict/chartVocab", 'wb') as fp:
-                pickle.dump(list(chart['itemid'].unique()), fp)
+                pickle.dump(vocab_list(chart['itemid'], 'itemid'), fp)
             self.chart_vocab = chart['itemid'].nunique()
             metaDic['Chart']=self.chart_per_adm
         
         if(self.feat_cond):
             with open("./data/dict/condVocab", 'wb') as fp:
-                pickle.dump(list(self.cond['new_icd_code'].unique()), fp)
+                pickle.dump(vocab_list(self.cond['new_icd_code'], 'icd_code'), fp)
             self.cond_vocab = self.cond['new_icd_code'].nunique()
             metaDic['Cond']=self.cond_per_adm
         
         if(self.feat_proc):    
             with open("./data/dict/procVocab", 'wb') as fp:
-                pickle.dump(list(proc['itemid'].unique()), fp)
+                pickle.dump(vocab_list(proc['itemid'], 'itemid'), fp)
             self.proc_vocab = proc['itemid'].nunique()
             metaDic['Proc']=self.proc_per_adm
             
@@ -0,0 +1,103 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import disease_cohort
+import day_intervals_cohort
+import day_intervals_cohort_v2
+from parallel_extract import process_context
+
+# extract_data module of each MIMIC-IV version
+VERSIONS = {'1.0': day_intervals_cohort, '2.0': day_intervals_cohort_v2}
+
+# builder used by the worker processes of CohortBuilder.build, inherited through fork
+_BUILDER = None
+
+
+class CohortBuilder():
+    """Session building many cohorts from base tables loaded once.
+
+    extract_data reloads admissions, patients and icustays for every cohort. A builder keeps the merged visit_pts
+    frame of each (version, ICU flag), with the visits ending in a death flagged instead of dropped
+    (get_visit_pts(mark_admn=True)), and the hadm_ids of each disease filter (looked up in the inverted diagnosis
+    index, see disease_cohort.build_diag_index); a cohort only filters them.
+
+    builder = CohortBuilder(root_dir)
+    builder.build([("ICU", "Readmission", 30, "No Disease Filter", "I50"),
+                   ("Non-ICU", "Mortality", 0, "I25", ""), ...], workers=4)
+    builder.extract_data("ICU", "Mortality", 0, "No Disease Filter", "")"""
+
+    def __init__(self, root_dir, version='2.0', engine='pandas', icd_map_path="./utils/mappings/ICD9_to_ICD10_mapping.txt"):
+        self.root_dir = root_dir
+        self.version = version
+        self.engine = engine
+        self.icd_map_path = icd_map_path
+        self.visits = {}    # (version, use_ICU) -> visit_pts
+        self.diag_cohorts = {}    # (version, ICD-10 code) -> hadm_ids
+
+    def mimic4_path(self, version) -> str:
+        return self.root_dir + "/mimiciv/" + version + "/"
+
+    def visit_pts(self, version, use_ICU) -> pd.DataFrame:
+        """Visits of every label without disease filter, loaded on first use"""
+        if (version, use_ICU) not in self.visits:
+            if use_ICU:
+                cols = dict(group_col='subject_id', visit_col='stay_id', admit_col='intime', disch_col='outtime', adm_visit_col='hadm_id')
+            else:
+                cols = dict(group_col='subject_id', visit_col='hadm_id', admit_col='admittime', disch_col='dischtime', adm_visit_col='')
+            visit_pts = VERSIONS[version].get_visit_pts(mimic4_path=self.mimic4_path(version), use_mort=False, use_los=False, los=0,
+                                                        use_admn=False, disease_label='', use_ICU=use_ICU, engine=self.engine,
+                                                        mark_admn=True, **cols)
+            visit_pts['admn_valid'] = visit_pts['admn_valid'].fillna(False).astype(bool)
+            self.visits[(version, use_ICU)] = visit_pts
+        return self.visits[(version, use_ICU)]
+
+    def get_visit_pts(self, version, use_ICU, use_admn, disease_label, mark_admn=False) -> pd.DataFrame:
+        """Same visits as get_visit_pts of the version's module, filtered from the loaded visit_pts"""
+        visit_pts = self.visit_pts(version, use_ICU)
+        if use_admn and not mark_admn:
+            visit_pts = visit_pts[visit_pts['admn_valid']]
+        if len(disease_label) and (use_admn or mark_admn or not use_ICU):
+            visit_pts = visit_pts[visit_pts['hadm_id'].isin(self.extract_diag_cohort(version, disease_label)['hadm_id'])]
+            print("[ READMISSION DUE TO "+disease_label+" ]")
+        if not mark_admn:
+            visit_pts = visit_pts.drop(columns=['admn_valid'])
+        return visit_pts
+
+    def extract_diag_cohort(self, version, label) -> pd.DataFrame:
+        """hadm_ids with a diagnosis in the ICD-10 category label, as disease_cohort.extract_diag_cohort"""
+        if (version, label) not in self.diag_cohorts:
+            self.diag_cohorts[(version, label)] = disease_cohort.extract_diag_cohort(None, label, self.mimic4_path(version), self.icd_map_path)
+        return self.diag_cohorts[(version, label)]
+
+    def extract_data(self, use_ICU, label, time, icd_code, disease_label, cohort_output=None, summary_output=None, validate_years=False):
+        """extract_data of the builder's version (a list of label specs for extract_labels) on the loaded tables"""
+        return VERSIONS[self.version].extract_data(use_ICU, label, time, icd_code, self.root_dir, disease_label,
+                                                   cohort_output, summary_output, engine=self.engine, builder=self,
+                                                   validate_years=validate_years)
+
+    def _preload(self, jobs):
+        for use_ICU, label, time, icd_code, disease_label in jobs:
+            self.visit_pts(self.version, use_ICU == "ICU")
+            for code in (icd_code, disease_label):
+                if len(code) and code != "No Disease Filter":
+                    self.extract_diag_cohort(self.version, code)
+
+    def build(self, jobs, workers=1) -> list:
+        """Extracts the cohort of each job, a tuple (use_ICU, label, time, icd_code, disease_label) of extract_data
+        arguments, and returns their output names in the order of jobs.
+        With workers > 1 the cohorts are extracted in worker processes forked after the tables are loaded, which
+        read the loaded frames without copying them."""
+        global _BUILDER
+        if workers <= 1 or len(jobs) <= 1:
+            return [self.extract_data(*job) for job in jobs]
+        self._preload(jobs)
+        _BUILDER = self
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=process_context()) as pool:
+                return list(pool.map(_extract_job, jobs))
+        finally:
+            _BUILDER = None
+
+
+def _extract_job(job):
+    return _BUILDER.extract_data(*job)
@@ -1,5 +1,6 @@
 import datetime
 import os
+import re
 import sys
 import numpy as np
 import pandas as pd
@@ -9,11 +10,14 @@ import importlib
 import disease_cohort
 importlib.reload(disease_cohort)
 import disease_cohort
+import table_loader
+import sql_backend
+from feature_store import offset_minutes
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + './../..')
 if not os.path.exists("./data/cohort"):
     os.makedirs("./data/cohort")
     
-def get_visit_pts(mimic4_path:str, group_col:str, visit_col:str, admit_col:str, disch_col:str, adm_visit_col:str, use_mort:bool, use_los:bool, los:int, use_admn:bool, disease_label:str,use_ICU:bool):
+def get_visit_pts(mimic4_path:str, group_col:str, visit_col:str, admit_col:str, disch_col:str, adm_visit_col:str, use_mort:bool, use_los:bool, los:int, use_admn:bool, disease_label:str,use_ICU:bool, engine='pandas', mark_admn=False):
     """Combines the MIMIC-IV core/patients table information with either the icu/icustays or core/admissions data.
 
     Parameters:
@@ -23,36 +27,54 @@ def get_visit_pts(mimic4_path:str, group_col:str, visit_col:str, admit_col:str,
     admit_col: column for visit start date information (normally admittime or intime)
     disch_col: column for visit end date information (normally dischtime or outtime)
     use_ICU: describes whether to speficially look at ICU visits in icu/icustays OR look at general admissions from core/admissions
+    engine: 'pandas', or 'duckdb' to run the joins in SQL (see sql_backend.py)
+    mark_admn: keep the visits ending in a death (which use_admn drops) and flag the others in an 'admn_valid' column,
+    the disease filter is then applied to ICU stays as well (used for multi-label cohorts)
+    ICU stays also get the admittime and dischtime of their hospital admission (for in-hospital mortality labels).
     """
+    if sql_backend.use_sql(engine):
+        hids=None
+        # like below, ICU stays are only filtered by disease for readmission
+        if len(disease_label) and (use_admn or mark_admn or not use_ICU):
+            # the disease filter is applied to every visit; the SQL joins keep the ones passing the other filters
+            visit_table="icu/icustays" if use_ICU else "hosp/admissions"
+            hids=disease_cohort.extract_diag_cohort(table_loader.load_table(visit_table, mimic4_path=mimic4_path, columns=['hadm_id'])['hadm_id'],disease_label,mimic4_path)['hadm_id']
+            print("[ READMISSION DUE TO "+disease_label+" ]")
+        return sql_backend.get_visit_pts(mimic4_path, group_col, visit_col, admit_col, disch_col, adm_visit_col, use_admn, use_ICU, hids=hids, module="hosp", race_col="race", mark_admn=mark_admn)
+
 
     visit = None # df containing visit information depending on using ICU or not
+    # admissions and patients are read once here and reused for the visit, demographic and death information
+    adm = table_loader.load_table("hosp/admissions", mimic4_path=mimic4_path, columns=['subject_id', 'hadm_id', 'admittime', 'dischtime', 'hospital_expire_flag', 'insurance', 'race'], parse_dates=['admittime', 'dischtime'])
+    pts = table_loader.load_table("hosp/patients", mimic4_path=mimic4_path, columns=[group_col, 'anchor_year', 'anchor_age', 'anchor_year_group', 'dod','gender'], parse_dates=['dod'])
     if use_ICU:
-        visit = pd.read_csv(mimic4_path + "icu/icustays.csv.gz", compression='gzip', header=0, index_col=None, parse_dates=[admit_col, disch_col])
-        if use_admn:
+        visit = table_loader.load_table("icu/icustays", mimic4_path=mimic4_path, parse_dates=[admit_col, disch_col])
+        if use_admn or mark_admn:
             # icustays doesn't have a way to identify if patient died during visit; must
             # use core/patients to remove such stay_ids for readmission labels
-            pts = pd.read_csv(mimic4_path + "hosp/patients.csv.gz", compression='gzip', header=0, index_col=None, usecols=['subject_id', 'dod'], parse_dates=['dod'])
-            visit = visit.merge(pts, how='inner', left_on='subject_id', right_on='subject_id')
-            visit = visit.loc[(visit.dod.isna()) | (visit.dod >= visit[disch_col])]
+            visit = visit.merge(pts[['subject_id', 'dod']], how='inner', left_on='subject_id', right_on='subject_id')
+            if mark_admn:
+                visit['admn_valid'] = (visit.dod.isna()) | (visit.dod >= visit[disch_col])
+            else:
+                visit = visit.loc[(visit.dod.isna()) | (visit.dod >= visit[disch_col])]
             if len(disease_label):
                 hids=disease_cohort.extract_diag_cohort(visit['hadm_id'],disease_label,mimic4_path)
                 visit=visit[visit['hadm_id'].isin(hids['hadm_id'])]
                 print("[ READMISSION DUE TO "+disease_label+" ]")
         
     else:
-        visit = pd.read_csv(mimic4_path + "hosp/admissions.csv.gz", compression='gzip', header=0, index_col=None, parse_dates=[admit_col, disch_col])
+        visit = adm[['subject_id', 'hadm_id', admit_col, disch_col, 'hospital_expire_flag']].copy()
         visit['los']=visit[disch_col]-visit[admit_col]
 
         visit[admit_col] = pd.to_datetime(visit[admit_col])
         visit[disch_col] = pd.to_datetime(visit[disch_col])        
-        visit['los']=pd.to_timedelta(visit[disch_col]-visit[admit_col],unit='h')
-        visit['los']=visit['los'].astype(str)
-        visit[['days', 'dummy','hours']] = visit['los'].str.split(' ', -1, expand=True)
-        visit['los']=pd.to_numeric(visit['days'])
-        visit=visit.drop(columns=['days', 'dummy','hours'])
+        # whole days of the stay
+        visit['los']=offset_minutes(visit[disch_col]-visit[admit_col]) // (24*60)
         
         
-        if use_admn:
+        if mark_admn:
+            visit['admn_valid'] = visit.hospital_expire_flag == 0
+        elif use_admn:
             # remove hospitalizations with a death; impossible for readmission for such visits
             visit = visit.loc[visit.hospital_expire_flag == 0]
         if len(disease_label):
@@ -60,21 +82,19 @@ def get_visit_pts(mimic4_path:str, group_col:str, visit_col:str, admit_col:str,
                 visit=visit[visit['hadm_id'].isin(hids['hadm_id'])]
                 print("[ READMISSION DUE TO "+disease_label+" ]")
 
-    pts = pd.read_csv(
-            mimic4_path + "hosp/patients.csv.gz", compression='gzip', header=0, index_col = None, usecols=[group_col, 'anchor_year', 'anchor_age', 'anchor_year_group', 'dod','gender']
-        )
     pts['yob']= pts['anchor_year'] - pts['anchor_age']  # get yob to ensure a given visit is from an adult
     pts['min_valid_year'] = pts['anchor_year'] + (2019 - pts['anchor_year_group'].str.slice(start=-4).astype(int))
     
     # Define anchor_year corresponding to the anchor_year_group 2017-2019. This is later used to prevent consideration
     # of visits with prediction windows outside the dataset's time range (2008-2019)
     #[[group_col, visit_col, admit_col, disch_col]]
+    flag_cols = ['admn_valid'] if mark_admn else []
     if use_ICU:
-        visit_pts = visit[[group_col, visit_col, adm_visit_col, admit_col, disch_col,'los']].merge(
+        visit_pts = visit[[group_col, visit_col, adm_visit_col, admit_col, disch_col,'los'] + flag_cols].merge(
             pts[[group_col, 'anchor_year', 'anchor_age', 'yob', 'min_valid_year', 'dod','gender']], how='inner', left_on=group_col, right_on=group_col
         )
     else:
-        visit_pts = visit[[group_col, visit_col, admit_col, disch_col,'los']].merge(
+        visit_pts = visit[[group_col, visit_col, admit_col, disch_col,'los'] + flag_cols].merge(
                 pts[[group_col, 'anchor_year', 'anchor_age', 'yob', 'min_valid_year', 'dod','gender']], how='inner', left_on=group_col, right_on=group_col
             )
 
@@ -85,30 +105,27 @@ def get_visit_pts(mimic4_path:str, group_col:str, visit_col:str, admit_col:str,
     visit_pts = visit_pts.loc[visit_pts['Age'] >= 18]
     
     ##Add Demo data
-    eth = pd.read_csv(mimic4_path + "hosp/admissions.csv.gz", compression='gzip', header=0, usecols=['hadm_id', 'insurance','race'], index_col=None)
-    visit_pts= visit_pts.merge(eth, how='inner', left_on='hadm_id', right_on='hadm_id')
+    hosp_cols = ['admittime', 'dischtime'] if use_ICU else []
+    visit_pts= visit_pts.merge(adm[['hadm_id', 'insurance','race'] + hosp_cols], how='inner', left_on='hadm_id', right_on='hadm_id')
     
     if use_ICU:
-        return visit_pts[[group_col, visit_col, adm_visit_col, admit_col, disch_col,'los', 'min_valid_year', 'dod','Age','gender','race', 'insurance']]
+        return visit_pts[[group_col, visit_col, adm_visit_col, admit_col, disch_col,'los', 'min_valid_year', 'dod','Age','gender','race', 'insurance'] + hosp_cols + flag_cols]
     else:
-        return visit_pts.dropna(subset=['min_valid_year'])[[group_col, visit_col, admit_col, disch_col,'los', 'min_valid_year', 'dod','Age','gender','race', 'insurance']]
+        return visit_pts.dropna(subset=['min_valid_year'])[[group_col, visit_col, admit_col, disch_col,'los', 'min_valid_year', 'dod','Age','gender','race', 'insurance'] + flag_cols]
 
 
-def validate_row(row, ctrl, invalid, max_year, disch_col, valid_col, gap):
-    """Checks if visit's prediction window potentially extends beyond the dataset range (2008-2019).
+def valid_window(df:pd.DataFrame, gap:datetime.timedelta, group_col:str, disch_col:str, valid_col:str, max_year=None) -> pd.Series:
+    """Checks if visits' prediction windows potentially extend beyond the dataset range (2008-2019), False for those.
     An 'invalid row' is NOT guaranteed to be outside the range, only potentially outside due to
     de-identification of MIMIC-IV being done through 3-year time ranges.
     
     To be invalid, the end of the prediction window's year must both extend beyond the maximum seen year
-    for a patient AND beyond the year that corresponds to the 2017-2019 anchor year range for a patient"""
-    print("disch_col",row[disch_col])
-    print(gap)
-    pred_year = (row[disch_col] + gap).year
-    if max_year < pred_year and pred_year > row[valid_col]:
-        invalid = invalid.append(row)
-    else:
-        ctrl = ctrl.append(row)
-    return ctrl, invalid
+    for a patient AND beyond the year that corresponds to the 2017-2019 anchor year range for a patient.
+    max_year: year of the last disch_col of each visit's patient, computed from df if None"""
+    if max_year is None:
+        max_year = df.groupby(group_col)[disch_col].transform('max').dt.year
+    pred_year = (df[disch_col] + gap).dt.year
+    return ~((max_year < pred_year) & (pred_year > df[valid_col]))
 
 
 def partition_by_los(df:pd.DataFrame, los:int, group_col:str, visit_col:str, admit_col:str, disch_col:str, valid_col:str):
@@ -133,45 +150,46 @@ def partition_by_los(df:pd.DataFrame, los:int, group_col:str, visit_col:str, adm
     return cohort, invalid
         
         
-def partition_by_readmit(df:pd.DataFrame, gap:datetime.timedelta, group_col:str, visit_col:str, admit_col:str, disch_col:str, valid_col:str):
+def time_to_readmit(df:pd.DataFrame, group_col:str, admit_col:str, disch_col:str) -> pd.Series:
+    """Time from each visit's disch_col to the next admit_col of the same patient (the first one strictly after it),
+    NaT when there is none. df must be sorted by group_col and admit_col: the last visit of a patient (and the only
+    one of a single visit patient) is never followed by a readmission."""
+    # Each discharge is matched to the first admission of the same patient strictly after it (Readmissions must
+    # come AFTER the current timestamp)
+    disch = df[[group_col, disch_col]].assign(pos=np.arange(df.shape[0])).dropna(subset=[disch_col]).sort_values(disch_col)
+    admit = df[[group_col, admit_col]].dropna(subset=[admit_col]).sort_values(admit_col)
+    matched = pd.merge_asof(disch, admit, left_on=disch_col, right_on=admit_col, by=group_col,
+                            direction='forward', allow_exact_matches=False)
+    gap = np.full(df.shape[0], np.timedelta64('NaT'), dtype='timedelta64[ns]')
+    gap[matched['pos'].values] = (matched[admit_col] - matched[disch_col]).values
+    gap[~df[group_col].duplicated(keep='last').values] = np.timedelta64('NaT')
+    return pd.Series(gap, index=df.index)
+
+
+def partition_by_readmit(df:pd.DataFrame, gap:datetime.timedelta, group_col:str, visit_col:str, admit_col:str, disch_col:str, valid_col:str, validate=False):
     """Applies labels to individual visits according to whether or not a readmission has occurred within the specified `gap` days.
     For a given visit, another visit must occur within the gap window for a positive readmission label.
-    The gap window starts from the disch_col time and the admit_col of subsequent visits are considered."""
+    The gap window starts from the disch_col time and the admit_col of subsequent visits are considered.
+    With validate, visits without readmission whose prediction window may fall outside the dataset range (see valid_window)
+    are invalid instead of controls."""
     
-    case = pd.DataFrame()   # hadm_ids with readmission within the gap period
-    ctrl = pd.DataFrame()   # hadm_ids without readmission within the gap period
     invalid = pd.DataFrame()    # hadm_ids that are not considered in the cohort
 
-    # Iterate through groupbys based on group_col (subject_id). Data is sorted by subject_id and admit_col (admittime)
-    # to ensure that the most current hadm_id is last in a group.
-    #grouped= df[[group_col, visit_col, admit_col, disch_col, valid_col]].sort_values(by=[group_col, admit_col]).groupby(group_col)
-    grouped= df.sort_values(by=[group_col, admit_col]).groupby(group_col)
-    for subject, group in tqdm(grouped):
-        max_year = group.max()[disch_col].year
-
-        if group.shape[0] <= 1:
-            #ctrl, invalid = validate_row(group.iloc[0], ctrl, invalid, max_year, disch_col, valid_col, gap)   # A group with 1 row has no readmission; goes to ctrl
-            ctrl = ctrl.append(group.iloc[0])
-        else:
-            for idx in range(group.shape[0]-1):
-                visit_time = group.iloc[idx][disch_col]  # For each index (a unique hadm_id), get its timestamp
-                if group.loc[
-                    (group[admit_col] > visit_time) &    # Readmissions must come AFTER the current timestamp
-                    (group[admit_col] - visit_time <= gap)   # Distance between a timestamp and readmission must be within gap
-                    ].shape[0] >= 1:                # If ANY rows meet above requirements, a readmission has occurred after that visit
-
-                    case = case.append(group.iloc[idx])
-                else:
-                    # If no readmission is found, only add to ctrl if prediction window is guaranteed to be within the
-                    # time range of the dataset (2008-2019). Visits with prediction windows existing in potentially out-of-range
-                    # dates (like 2018-2020) are excluded UNLESS the prediction window takes place the same year as the visit,
-                    # in which case it is guaranteed to be within 2008-2019
-
-                    ctrl = ctrl.append(group.iloc[idx])
-
-            #ctrl, invalid = validate_row(group.iloc[-1], ctrl, invalid, max_year, disch_col, valid_col, gap)  # The last hadm_id datewise is guaranteed to have no readmission logically
-            ctrl = ctrl.append(group.iloc[-1])
-            #print(f"[ {gap.days} DAYS ] {case.shape[0] + ctrl.shape[0]}/{df.shape[0]} {visit_col}s processed")
+    # Data is sorted by subject_id and admit_col (admittime) to ensure that the most current hadm_id is last in a group.
+    df = df.sort_values(by=[group_col, admit_col])
+    # Distance between a timestamp and readmission must be within gap
+    readmit = (time_to_readmit(df, group_col, admit_col, disch_col) <= gap).values
+
+    case = df.loc[readmit]   # hadm_ids with readmission within the gap period
+    ctrl = df.loc[~readmit]   # hadm_ids without readmission within the gap period
+    if validate:
+        # If no readmission is found, only add to ctrl if prediction window is guaranteed to be within the
+        # time range of the dataset (2008-2019). Visits with prediction windows existing in potentially out-of-range
+        # dates (like 2018-2020) are excluded UNLESS the prediction window takes place the same year as the visit,
+        # in which case it is guaranteed to be within 2008-2019
+        valid = valid_window(df, gap, group_col, disch_col, valid_col).values
+        invalid = df.loc[~readmit & ~valid]
+        ctrl = df.loc[~readmit & valid]
 
     print("[ READMISSION LABELS FINISHED ]")
     return case, ctrl, invalid
@@ -213,7 +231,7 @@ def partition_by_mort(df:pd.DataFrame, group_col:str, visit_col:str, admit_col:s
     return cohort, invalid
 
 
-def get_case_ctrls(df:pd.DataFrame, gap:int, group_col:str, visit_col:str, admit_col:str, disch_col:str, valid_col:str, death_col:str, use_mort=False,use_admn=False,use_los=False) -> pd.DataFrame:
+def get_case_ctrls(df:pd.DataFrame, gap:int, group_col:str, visit_col:str, admit_col:str, disch_col:str, valid_col:str, death_col:str, use_mort=False,use_admn=False,use_los=False,validate=False) -> pd.DataFrame:
     """Handles logic for creating the labelled cohort based on arguments passed to extract().
 
     Parameters:
@@ -225,6 +243,7 @@ def get_case_ctrls(df:pd.DataFrame, gap:int, group_col:str, visit_col:str, admit
     disch_col: column for visit end date information (normally dischtime or outtime)
     valid_col: generated column containing a patient's year that corresponds to the 2017-2019 anchor time range
     dod_col: Date of death column
+    validate: leave readmission controls whose prediction window may fall outside the dataset range out of the cohort
     """
 
     case = None  # hadm_ids with readmission within the gap period
@@ -236,7 +255,8 @@ def get_case_ctrls(df:pd.DataFrame, gap:int, group_col:str, visit_col:str, admit
     elif use_admn:
         gap = datetime.timedelta(days=gap)
         # transform gap into a timedelta to compare with datetime columns
-        case, ctrl, invalid = partition_by_readmit(df, gap, group_col, visit_col, admit_col, disch_col, valid_col)
+        case, ctrl, invalid = partition_by_readmit(df, gap, group_col, visit_col, admit_col, disch_col, valid_col, validate)
+        print(f"[ {gap.days} DAYS ] {invalid.shape[0]} {visit_col}s are invalid")
 
         # case hadm_ids are labelled 1 for readmission, ctrls have a 0 label
         case['label'] = np.ones(case.shape[0]).astype(int)
@@ -249,14 +269,75 @@ def get_case_ctrls(df:pd.DataFrame, gap:int, group_col:str, visit_col:str, admit
     # print(f"[ {gap.days} DAYS ] {invalid.shape[0]} hadm_ids are invalid")
 
 
-def extract_data(use_ICU:str, label:str, time:int, icd_code:str, root_dir, disease_label, cohort_output=None, summary_output=None):
+def label_column(label:str, time:int) -> str:
+    """Cohort column of a label spec, e.g. ('Readmission', 30) -> 'label_readmission_30'"""
+    return "label_" + label.lower().replace(" ", "_") + "_" + str(time)
+
+
+def disease_suffix(icd_code) -> str:
+    """Part of the cohort file names for a disease filter: an ICD-10 prefix as is, a phenotype query
+    (phenotype.Query) with its spaces, parentheses and commas turned into _, e.g. '(I110, I50) and not N18'
+    -> 'I110_I50_and_not_N18'. The summary keeps the text of the filter."""
+    return re.sub('[^A-Za-z0-9]+', '_', str(icd_code)).strip('_')
+
+
+def get_labels(df:pd.DataFrame, labels:list, group_col:str, admit_col:str, disch_col:str, death_col:str, valid_col=None,
+               hosp_admit_col='admittime', hosp_disch_col='dischtime') -> pd.DataFrame:
+    """Labels every visit of df for each (label, time) spec of labels, in one column per spec (see label_column).
+    Labels follow partition_by_readmit, partition_by_mort and partition_by_los; a visit that one of them would leave out
+    gets a missing label in that column: readmission labels skip visits ending in a death (df['admn_valid'], see
+    get_visit_pts), mortality and length of stay labels skip visits without admit/disch times.
+
+    'ICU Mortality' (and 'Mortality') is a death between admit_col and disch_col of the visit, 'Hospital Mortality' a
+    death between hosp_admit_col and hosp_disch_col, the times of the hospital admission (of the ICU stay for ICU data).
+
+    With valid_col, readmission controls whose prediction window may fall outside the dataset range (see valid_window)
+    get a missing label too.
+
+    The time to the next admission (and each patient's last discharge year) is computed once and compared to every
+    readmission gap."""
+    df = df.sort_values(by=[group_col, admit_col])
+    valid = df[admit_col].notna() & df[disch_col].notna()
+    readmit_gap = None
+    for label, time in labels:
+        if label == 'Readmission':
+            if readmit_gap is None:
+                admn = df[df['admn_valid'].astype(bool)]
+                readmit_gap = time_to_readmit(admn, group_col, admit_col, disch_col).reindex(df.index)
+                max_year = admn.groupby(group_col)[disch_col].transform('max').dt.year.reindex(df.index)
+            readmit = readmit_gap <= datetime.timedelta(days=time)
+            flag = readmit.where(df['admn_valid'].astype(bool))
+            if valid_col is not None:
+                flag = flag.where(readmit | valid_window(df, datetime.timedelta(days=time), group_col, disch_col, valid_col, max_year))
+        elif label in ('Mortality', 'ICU Mortality'):
+            flag = ((df[death_col] >= df[admit_col]) & (df[death_col] <= df[disch_col])).where(valid)
+        elif label == 'Hospital Mortality':
+            hosp_valid = df[hosp_admit_col].notna() & df[hosp_disch_col].notna()
+            flag = ((df[death_col] >= df[hosp_admit_col]) & (df[death_col] <= df[hosp_disch_col])).where(hosp_valid)
+        elif label == 'Length of Stay':
+            flag = (df['los'] > time).where(valid & df['los'].notna())
+        else:
+            raise ValueError("unknown label " + str(label))
+        df[label_column(label, time)] = flag.astype(float).astype('Int32')
+    print("[ LABELS FINISHED ]")
+    return df
+
+
+def extract_data(use_ICU:str, label:str, time:int, icd_code:str, root_dir, disease_label, cohort_output=None, summary_output=None, engine='pandas', builder=None, validate_years=False):
     """Extracts cohort data and summary from MIMIC-IV data based on provided parameters.
 
     Parameters:
     cohort_output: name of labelled cohort output file
     summary_output: name of summary output file
     use_ICU: state whether to use ICU patient data or not
-    label: Can either be '{day} day Readmission' or 'Mortality', decides what binary data label signifies"""
+    label: Can either be '{day} day Readmission' or 'Mortality', decides what binary data label signifies,
+    or a list of (label, time) specs labelled in a single pass (see extract_labels, time is then not used)
+    engine: 'pandas', or 'duckdb' to run the cohort joins in SQL (see sql_backend.py)
+    builder: CohortBuilder whose loaded tables are used instead of reading them again (see cohort_builder.py)
+    validate_years: leave out the readmission controls whose prediction window may fall outside the dataset range
+    (2008-2019, see valid_window)"""
+    if not isinstance(label, str):
+        return extract_labels(use_ICU, label, icd_code, root_dir, disease_label, cohort_output, summary_output, engine, builder, validate_years)
     print("===========MIMIC-IV v2.0============")
     if not cohort_output:
         cohort_output="cohort_" + use_ICU.lower() + "_" + label.lower().replace(" ", "_") + "_" + str(time) + "_" + disease_label
@@ -306,20 +387,24 @@ def extract_data(use_ICU:str, label:str, time:int, icd_code:str, root_dir, disea
         disch_col='dischtime'
         death_col='dod'
 
-    pts = get_visit_pts(
-        mimic4_path=root_dir+"/mimiciv/2.0/",
-        group_col=group_col,
-        visit_col=visit_col,
-        admit_col=admit_col,
-        disch_col=disch_col,
-        adm_visit_col=adm_visit_col,
-        use_mort=use_mort,
-        use_los=use_los,
-        los=los,
-        use_admn=use_admn,
-        disease_label=disease_label,
-        use_ICU=use_ICU
-    )
+    if builder is not None:
+        pts = builder.get_visit_pts('2.0', use_ICU, use_admn, disease_label)
+    else:
+        pts = get_visit_pts(
+            mimic4_path=root_dir+"/mimiciv/2.0/",
+            group_col=group_col,
+            visit_col=visit_col,
+            admit_col=admit_col,
+            disch_col=disch_col,
+            adm_visit_col=adm_visit_col,
+            use_mort=use_mort,
+            use_los=use_los,
+            los=los,
+            use_admn=use_admn,
+            disease_label=disease_label,
+            use_ICU=use_ICU,
+            engine=engine
+        )
     #print("pts",pts.head())
     
     # cols to be extracted from get_case_ctrls
@@ -330,7 +415,7 @@ def extract_data(use_ICU:str, label:str, time:int, icd_code:str, root_dir, disea
         cohort, invalid = get_case_ctrls(pts, None, group_col, visit_col, admit_col, disch_col,'min_valid_year', death_col, use_mort=True,use_admn=False,use_los=False)
     elif use_admn:
         interval = time
-        cohort, invalid = get_case_ctrls(pts, interval, group_col, visit_col, admit_col, disch_col,'min_valid_year', death_col, use_mort=False,use_admn=True,use_los=False)
+        cohort, invalid = get_case_ctrls(pts, interval, group_col, visit_col, admit_col, disch_col,'min_valid_year', death_col, use_mort=False,use_admn=True,use_los=False,validate=validate_years)
     elif use_los:
         cohort, invalid = get_case_ctrls(pts, los, group_col, visit_col, admit_col, disch_col,'min_valid_year', death_col, use_mort=False,use_admn=False,use_los=True)
     #print(cohort.head())
@@ -340,13 +425,16 @@ def extract_data(use_ICU:str, label:str, time:int, icd_code:str, root_dir, disea
     #print(cohort.head())
     
     if use_disease:
-        hids=disease_cohort.extract_diag_cohort(cohort['hadm_id'],icd_code,root_dir+"/mimiciv/2.0/")
+        if builder is not None:
+            hids=builder.extract_diag_cohort('2.0', icd_code)
+        else:
+            hids=disease_cohort.extract_diag_cohort(cohort['hadm_id'],icd_code,root_dir+"/mimiciv/2.0/")
         #print(hids.shape)
         #print(cohort.shape)
         #print(len(list(set(hids['hadm_id'].unique()).intersection(set(cohort['hadm_id'].unique())))))
         cohort=cohort[cohort['hadm_id'].isin(hids['hadm_id'])]
-        cohort_output=cohort_output+"_"+icd_code
-        summary_output=summary_output+"_"+icd_code
+        cohort_output=cohort_output+"_"+disease_suffix(icd_code)
+        summary_output=summary_output+"_"+disease_suffix(icd_code)
     #print(cohort[cols].head())
     # save output
     cohort=cohort.rename(columns={"race":"ethnicity"})
@@ -360,6 +448,97 @@ def extract_data(use_ICU:str, label:str, time:int, icd_code:str, root_dir, disea
         f"# Positive cases: {cohort[cohort['label']==1].shape[0]}",
         f"# Negative cases: {cohort[cohort['label']==0].shape[0]}"
     ])
+    if use_disease:
+        summary += f"\nDisease filter: {icd_code}"
+
+    # save basic summary of data
+    with open(f"./data/cohort/{summary_output}.txt", "w") as f:
+        f.write(summary)
+
+    print("[ SUMMARY SUCCESSFULLY SAVED ]")
+    print(summary)
+
+    return cohort_output
+
+
+def extract_labels(use_ICU:str, labels:list, icd_code:str, root_dir, disease_label, cohort_output=None, summary_output=None, engine='pandas', builder=None, validate_years=False):
+    """Extracts one cohort labelled for several labels from a single visit table, e.g.
+    labels=[('Readmission', 30), ('Readmission', 90), ('Hospital Mortality', 0), ('ICU Mortality', 0), ('Length of Stay', 3)]
+    (time is the readmission gap or the length of stay in days, 0 for mortality). Hospital Mortality is death during
+    the hospital admission, also for ICU stays, ICU Mortality (ICU data only) death during the ICU stay. Mortality is
+    death during the visit: the ICU stay for ICU data, the hospital admission otherwise.
+    The cohort has a column per label (see get_labels) and the visits of every label; disease_label filters
+    the visits of all labels, also for ICU data. With validate_years, readmission controls whose prediction window
+    may fall outside the dataset range get a missing label."""
+    print("===========MIMIC-IV v2.0============")
+    names = "_".join(label.lower().replace(" ", "_") + "_" + str(time) for label, time in labels)
+    if not cohort_output:
+        cohort_output="cohort_" + use_ICU.lower() + "_" + names + "_" + disease_label
+    if not summary_output:
+        summary_output="summary_" + use_ICU.lower() + "_" + names + "_" + disease_label
+    print(f"EXTRACTING FOR: | {use_ICU.upper()} | " + " | ".join(f"{label.upper()} {time}" for label, time in labels) + " |")
+
+    ICU=use_ICU
+    use_ICU = use_ICU == "ICU"
+    if not use_ICU and any(label == 'ICU Mortality' for label, time in labels):
+        raise ValueError("ICU Mortality labels need ICU data")
+    use_disease=icd_code!="No Disease Filter"
+    group_col, death_col = 'subject_id', 'dod'
+    if use_ICU:
+        visit_col, admit_col, disch_col, adm_visit_col = 'stay_id', 'intime', 'outtime', 'hadm_id'
+    else:
+        visit_col, admit_col, disch_col, adm_visit_col = 'hadm_id', 'admittime', 'dischtime', ''
+
+    if builder is not None:
+        pts = builder.get_visit_pts('2.0', use_ICU, False, disease_label, mark_admn=True)
+    else:
+        pts = get_visit_pts(
+            mimic4_path=root_dir+"/mimiciv/2.0/",
+            group_col=group_col,
+            visit_col=visit_col,
+            admit_col=admit_col,
+            disch_col=disch_col,
+            adm_visit_col=adm_visit_col,
+            use_mort=False,
+            use_los=False,
+            los=0,
+            use_admn=False,
+            disease_label=disease_label,
+            use_ICU=use_ICU,
+            engine=engine,
+            mark_admn=True
+        )
+    cohort = get_labels(pts, labels, group_col, admit_col, disch_col, death_col, 'min_valid_year' if validate_years else None)
+
+    label_cols = [label_column(label, time) for label, time in labels]
+    cols = [group_col, visit_col, admit_col, disch_col, 'Age','gender','ethnicity','insurance']
+    if any(label.endswith('Mortality') for label, time in labels):
+        cols.append(death_col)
+    if use_ICU:
+        cols.append(adm_visit_col)
+
+    if use_disease:
+        if builder is not None:
+            hids=builder.extract_diag_cohort('2.0', icd_code)
+        else:
+            hids=disease_cohort.extract_diag_cohort(cohort['hadm_id'],icd_code,root_dir+"/mimiciv/2.0/")
+        cohort=cohort[cohort['hadm_id'].isin(hids['hadm_id'])]
+        cohort_output=cohort_output+"_"+disease_suffix(icd_code)
+        summary_output=summary_output+"_"+disease_suffix(icd_code)
+    cohort=cohort.rename(columns={"race":"ethnicity"})
+    cohort[cols + label_cols].to_csv(root_dir+"/data/cohort/"+cohort_output+".csv.gz", index=False, compression='gzip')
+    print("[ COHORT SUCCESSFULLY SAVED ]")
+
+    summary = [f"{ICU} DATA",
+               f"# Admission Records: {cohort.shape[0]}",
+               f"# Patients: {cohort[group_col].nunique()}"]
+    for (label, time), col in zip(labels, label_cols):
+        summary += [f"{label.upper()} {time}",
+                    f"# Positive cases: {cohort[cohort[col]==1].shape[0]}",
+                    f"# Negative cases: {cohort[cohort[col]==0].shape[0]}"]
+    if use_disease:
+        summary.append(f"Disease filter: {icd_code}")
+    summary = "\n".join(summary)
 
     # save basic summary of data
     with open(f"./data/cohort/{summary_output}.txt", "w") as f:
@@ -379,14 +558,8 @@ if __name__ == '__main__':
 
     response = input('Extra all datasets? (y/n)').strip().lower()
     if response == 'y':
-        extract_data("ICU", "Mortality")
-        extract_data("Non-ICU", "Mortality")
-
-        extract_data("ICU", "30 Day Readmission")
-        extract_data("Non-ICU", "30 Day Readmission")
-
-        extract_data("ICU", "60 Day Readmission")
-        extract_data("Non-ICU", "60 Day Readmission")
-
-        extract_data("ICU", "120 Day Readmission")
-        extract_data("Non-ICU", "120 Day Readmission")
\ No newline at end of file
+        labels = [('Readmission', 7), ('Readmission', 30), ('Readmission', 60), ('Readmission', 90), ('Readmission', 120),
+                  ('Hospital Mortality', 0), ('Length of Stay', 3), ('Length of Stay', 7)]
+        # ICU stays get in-hospital and in-ICU mortality in the same pass
+        extract_data("ICU", labels + [('ICU Mortality', 0)], 0, "No Disease Filter", ".", "")
+        extract_data("Non-ICU", labels, 0, "No Disease Filter", ".", "")
\ No newline at end of file
@@ -8,82 +8,41 @@ import pandas as pd
 import numpy as np
 import os
 import sys
+import json
+import hashlib
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import table_loader
+from icd_mapping import read_icd_mapping, standardize_icd
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + './../..')
 
-def read_icd_mapping(map_path: str) -> pd.DataFrame:
-    """Reads in mapping table for converting ICD9 to ICD10 codes"""
+# Inverted index from ICD-10 roots and full (converted) ICD-10 codes to the sorted hadm_ids diagnosed with them.
+# Built once from diagnoses_icd and the ICD-9 -> 10 mapping, and written next to diagnoses_icd of the release;
+# the file name holds a key of the mapping and diagnoses files, so a new mapping or release gets a new index.
+# The primary_ levels only hold the primary diagnoses (seq_num 1) of the admissions.
+INDEX_LEVELS = ['root', 'code', 'primary_root', 'primary_code']
+_indexes = {}   # (index path, level) -> keys and hadm_id lists of the level, kept for the other cohorts of the session
 
-    mapping = pd.read_csv(map_path, header=0, delimiter="\t")
-    mapping.diagnosis_description = mapping.diagnosis_description.apply(str.lower)
-    return mapping
+def get_diagnosis_icd(module_path: str, h_ids=None, columns=["hadm_id", "icd_code", "icd_version"]) -> pd.DataFrame:
+    """Reads in diagnosis_icd table, optionally only the rows of the given hadm_ids"""
 
-
-def get_diagnosis_icd(module_path: str) -> pd.DataFrame:
-    """Reads in diagnosis_icd table"""
-
-    return pd.read_csv(
-        module_path + "/hosp/diagnoses_icd.csv.gz", compression="gzip", header=0
+    return table_loader.load_table(
+        "hosp/diagnoses_icd", mimic4_path=module_path, columns=columns,
+        filters=[("hadm_id", "in", h_ids)] if h_ids is not None else None
     )
 
 
-def standardize_icd(
-    mapping: pd.DataFrame, diag: pd.DataFrame, map_code_col="diagnosis_code", root=True
-) -> str:
-    """Takes an ICD9 -> ICD10 mapping table and a diagnosis dataframe;
-    adds column with converted ICD10 column"""
-
-    count = 0
-    code_cols = mapping.columns
-    errors = []
-
-    def icd_9to10(icd):
-        """Function use to apply over the diag DataFrame for ICD9->ICD10 conversion"""
-        # If root is true, only map an ICD 9 -> 10 according to the
-        # ICD9's root (first 3 digits)
-        if root:
-            icd = icd[:3]
-
-        if map_code_col not in code_cols:
-            errors.append(f"ICD NOT FOUND: {icd}")
-            return np.nan
-
-        matches = mapping.loc[mapping[map_code_col] == icd]
-        if matches.shape[0] == 0:
-            errors.append(f"ICD NOT FOUND: {icd}")
-            return np.nan
-
-        return mapping.loc[mapping[map_code_col] == icd].icd10cm.iloc[0]
-
-    # Create new column with original codes as default
-    col_name = "root_icd10_convert"
-    diag[col_name] = diag["icd_code"].values
-
-    # Group identical ICD9 codes, then convert all ICD9 codes within
-    # a group to ICD10
-    for code, group in diag.loc[diag.icd_version == 9].groupby(by="icd_code"):
-        new_code = icd_9to10(code)
-        for idx in group.index.values:
-            # Modify values of original df at the indexes in the groups
-            diag.at[idx, col_name] = new_code
-
-        count += group.shape[0]
-        #print(f"{count}/{diag.shape[0]} rows processed")
-
-    # Column for just the roots of the converted ICD10 column
-    diag["root"] = diag[col_name].apply(lambda x: x[:3] if type(x) is str else np.nan)
-
-
-
 def preproc_icd_module(h_ids,
     module_path: str, ICD10_code: str, icd_map_path: str
 ) -> tuple:
     """Takes an module dataset with ICD codes and puts it in long_format,
     mapping ICD-codes by a mapping table path"""
 
-    diag = get_diagnosis_icd(module_path)
+    diag = get_diagnosis_icd(module_path, h_ids)
     icd_map = read_icd_mapping(icd_map_path)
 
-    standardize_icd(icd_map, diag, root=True)
+    standardize_icd(icd_map, diag, root=True, add_root=True)
 
     # patient ids that have at least 1 record of the given ICD10 code category
     diag.dropna(subset=["root"], inplace=True)
@@ -94,18 +53,77 @@ def preproc_icd_module(h_ids,
     return pos_ids
 
 
+def diag_index_path(module_path: str, icd_map_path: str) -> str:
+    """Path of the inverted diagnosis index of a MIMIC-IV release for a mapping file"""
+    parquet_path, csv_path = table_loader.table_paths("hosp/diagnoses_icd", module_path)
+    sources = [p for p in (parquet_path, csv_path) if os.path.exists(p)]
+    key = json.dumps([INDEX_LEVELS, table_loader.file_key(icd_map_path)] + [table_loader.file_key(p) for p in sources])
+    return csv_path[:-len('.csv.gz')] + '.icd10_' + hashlib.md5(key.encode()).hexdigest()[:12] + '.arrow'
+
+
+def build_diag_index(module_path: str, icd_map_path: str, overwrite=False) -> str:
+    """Maps every diagnosis of the release to ICD-10 (standardize_icd) and writes the inverted index:
+    one row per (level, key) with the sorted hadm_ids of the key, level 'root' for the ICD-10 category
+    (first 3 characters) and 'code' for the full ICD-10 code, 'primary_root' and 'primary_code' for the
+    primary diagnoses only"""
+    path = diag_index_path(module_path, icd_map_path)
+    if os.path.exists(path) and not overwrite:
+        return path
+    diag = get_diagnosis_icd(module_path, columns=["hadm_id", "seq_num", "icd_code", "icd_version"])
+    standardize_icd(read_icd_mapping(icd_map_path), diag, root=True, add_root=True)
+    primary = diag[diag["seq_num"] == 1]
+    tables = []
+    for level, df, col in zip(INDEX_LEVELS, [diag, diag, primary, primary], ["root", "root_icd10_convert"] * 2):
+        pairs = df[[col, "hadm_id"]].dropna().drop_duplicates().astype({col: str, "hadm_id": "int64"})
+        groups = [(key, ids.values) for key, ids in pairs.sort_values([col, "hadm_id"]).groupby(col, sort=True)["hadm_id"]]
+        tables.append(pa.table({'level': pa.array([level] * len(groups), pa.string()),
+                                'key': pa.array([key for key, _ in groups], pa.string()),
+                                'hadm_ids': pa.array([ids for _, ids in groups], pa.list_(pa.int64()))}))
+    feather.write_feather(pa.concat_tables(tables), path + '.tmp', compression='uncompressed')
+    os.replace(path + '.tmp', path)
+    print("[ DIAGNOSIS INDEX SAVED ]")
+    return path
+
+
+def load_diag_index(module_path: str, icd_map_path: str, level='root') -> tuple:
+    """(keys, hadm_id lists) of one level of the inverted diagnosis index of the release, built on first use"""
+    path = build_diag_index(module_path, icd_map_path)
+    if (path, level) not in _indexes:
+        index = feather.read_table(path, memory_map=True)
+        index = index.filter(pc.equal(index['level'], level))
+        _indexes[(path, level)] = (pd.Series(index['key'].to_numpy(zero_copy_only=False), dtype=object), index['hadm_ids'])
+    return _indexes[(path, level)]
+
+
+def index_hadm_ids(module_path: str, icd_map_path: str, level: str, match) -> np.ndarray:
+    """Sorted hadm_ids of the index keys of a level selected by match, a function of the keys returning a boolean mask"""
+    keys, hadm_ids = load_diag_index(module_path, icd_map_path, level)
+    selected = hadm_ids.filter(pa.array(np.asarray(match(keys), dtype=bool)))
+    return np.unique(pc.list_flatten(selected).to_numpy())
+
+
+def diag_hadm_ids(module_path: str, label: str, icd_map_path: str, level='root') -> np.ndarray:
+    """Sorted hadm_ids with a diagnosis whose ICD-10 root (or full code, level='code') contains label"""
+    return index_hadm_ids(module_path, icd_map_path, level, lambda keys: keys.str.contains(label))
+
+
 def extract_diag_cohort(
     h_ids,
     label: str,
     module_path,
     icd_map_path="./utils/mappings/ICD9_to_ICD10_mapping.txt"
 ) -> str:
-    """Takes UserInterface parameters, then creates and saves a labelled cohort
-    summary, and error file"""
-
-    cohort = preproc_icd_module(h_ids,
-        module_path, label, icd_map_path
-    )
+    """hadm_ids among h_ids (all if None) with a diagnosis of the ICD-10 category label,
+    looked up in the inverted diagnosis index (see build_diag_index).
+    label can also be a phenotype query (see phenotype.py)"""
+
+    if hasattr(label, 'hadm_ids'):
+        hids = label.hadm_ids(module_path, icd_map_path)
+    else:
+        hids = diag_hadm_ids(module_path, label, icd_map_path)
+    if h_ids is not None:
+        hids = hids[np.isin(hids, pd.Series(h_ids).dropna().values)]
+    cohort = pd.DataFrame(hids, columns=["hadm_id"])
 
     return cohort
 
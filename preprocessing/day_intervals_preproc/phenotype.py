@@ -0,0 +1,190 @@
+import re
+import numpy as np
+import pandas as pd
+import disease_cohort
+
+ICD_MAP_PATH = "./utils/mappings/ICD9_to_ICD10_mapping.txt"
+
+# Phenotype queries over the inverted diagnosis index (disease_cohort.build_diag_index).
+#
+#   (I50 or I110) and not N18       heart failure or hypertensive heart disease with heart failure, without CKD
+#   primary(I21, I22)               admitted for a myocardial infarction (primary diagnosis, seq_num 1)
+#
+# A code is a prefix of the ICD-10 codes (ICD-9 diagnoses are converted), dots are ignored; "I50, I110" is the
+# same as "I50 or I110". not is relative to all admissions with a diagnosis.
+# Queries can be combined with &, | and ~. A Query is also the str of its text, so it can be given to extract_data
+# as icd_code or disease_label like a single code.
+_TOKEN = re.compile(r"\s*([(),]|[A-Za-z0-9.]+)")
+_leaves = {}   # (index path, level, prefixes) -> hadm_ids, shared by the queries of the session
+
+
+def _tokenize(text: str) -> list:
+    tokens, pos = [], 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise ValueError(f"invalid phenotype query '{text}' at '{text[pos:]}'")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+class _Parser():
+    """expr := term (or term)* ; term := factor (and factor)* ;
+    factor := not factor | ( expr ) | primary ( expr ) | code (, code)*"""
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos].lower() if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError(f"invalid phenotype query '{self.text}': expected {expected or 'a code'}")
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def parse(self):
+        node = self.expr(False)
+        if self.peek() is not None:
+            raise ValueError(f"invalid phenotype query '{self.text}' at '{self.tokens[self.pos]}'")
+        return node
+
+    def expr(self, primary):
+        node = self.term(primary)
+        while self.peek() == 'or':
+            self.take()
+            node = _or(node, self.term(primary))
+        return node
+
+    def term(self, primary):
+        node = self.factor(primary)
+        while self.peek() == 'and':
+            self.take()
+            node = ('and', node, self.factor(primary))
+        return node
+
+    def factor(self, primary):
+        token = self.peek()
+        if token == 'not':
+            self.take()
+            return ('not', self.factor(primary))
+        if token == '(':
+            self.take()
+            node = self.expr(primary)
+            self.take(')')
+            return node
+        if token == 'primary':
+            self.take()
+            self.take('(')
+            node = self.expr(True)
+            self.take(')')
+            return node
+        if token in (None, ')', ',', 'and', 'or'):
+            raise ValueError(f"invalid phenotype query '{self.text}': expected a code")
+        prefixes = [self.take()]
+        while self.peek() == ',':
+            self.take()
+            prefixes.append(self.take())
+        return ('codes', tuple(sorted({p.replace('.', '').upper() for p in prefixes})), primary)
+
+
+def _or(a, b):
+    # prefix sets of the same kind are looked up in one pass over the index keys
+    if a[0] == 'codes' and b[0] == 'codes' and a[2] == b[2]:
+        return ('codes', tuple(sorted(set(a[1]) | set(b[1]))), a[2])
+    return ('or', a, b)
+
+
+def _render(node, parent=0) -> str:
+    """Text of a parsed query; parent is the precedence of the enclosing operator (or 1, and 2, not 3)"""
+    kind = node[0]
+    if kind == 'codes':
+        text = ", ".join(node[1])
+        if node[2]:
+            return "primary(" + text + ")"
+        return "(" + text + ")" if len(node[1]) > 1 and parent > 1 else text
+    if kind == 'not':
+        return "not " + _render(node[1], 3)
+    prec = 1 if kind == 'or' else 2
+    text = _render(node[1], prec) + " " + kind + " " + _render(node[2], prec)
+    return "(" + text + ")" if prec < parent else text
+
+
+class Query(str):
+    """Phenotype query parsed from its text, e.g. Query("(I50 or I110) and not N18")"""
+
+    def __new__(cls, text):
+        node = _Parser(str(text)).parse()
+        query = super().__new__(cls, _render(node))
+        query.node = node
+        return query
+
+    def __and__(self, other):
+        return Query("(" + self + ") and (" + Query(other) + ")")
+
+    def __rand__(self, other):
+        return Query(other) & self
+
+    def __or__(self, other):
+        return Query("(" + self + ") or (" + Query(other) + ")")
+
+    def __ror__(self, other):
+        return Query(other) | self
+
+    def __invert__(self):
+        return Query("not (" + self + ")")
+
+    def hadm_ids(self, module_path: str, icd_map_path=ICD_MAP_PATH) -> np.ndarray:
+        """Sorted hadm_ids of the admissions matching the query"""
+        return _evaluate(self.node, module_path, icd_map_path)
+
+
+def codes(*prefixes, primary=False) -> Query:
+    """Query matching any of the ICD-10 prefixes, only as primary diagnosis if primary"""
+    text = ", ".join(prefixes)
+    return Query("primary(" + text + ")" if primary else text)
+
+
+def _lookup(module_path, icd_map_path, level, prefixes) -> np.ndarray:
+    key = (disease_cohort.diag_index_path(module_path, icd_map_path), level, prefixes)
+    if key not in _leaves:
+        if prefixes is None:
+            match = lambda keys: np.ones(len(keys), dtype=bool)
+        else:
+            match = lambda keys: keys.str.startswith(prefixes)
+        _leaves[key] = disease_cohort.index_hadm_ids(module_path, icd_map_path, level, match)
+    return _leaves[key]
+
+
+def _evaluate(node, module_path, icd_map_path) -> np.ndarray:
+    kind = node[0]
+    if kind == 'codes':
+        return _lookup(module_path, icd_map_path, 'primary_code' if node[2] else 'code', node[1])
+    if kind == 'not':
+        admissions = _lookup(module_path, icd_map_path, 'code', None)
+        return np.setdiff1d(admissions, _evaluate(node[1], module_path, icd_map_path), assume_unique=True)
+    a = _evaluate(node[1], module_path, icd_map_path)
+    b = _evaluate(node[2], module_path, icd_map_path)
+    return np.union1d(a, b) if kind == 'or' else np.intersect1d(a, b, assume_unique=True)
+
+
+def phenotype_matrix(module_path: str, phenotypes, hadm_ids=None, icd_map_path=ICD_MAP_PATH) -> pd.DataFrame:
+    """Multi-label phenotype matrix: one row per admission (hadm_ids, all admissions with a diagnosis if None)
+    and one int8 column per phenotype, 1 if the admission matches its query.
+    phenotypes is a dict {column: query} or a list of queries (named by their text)."""
+    if not isinstance(phenotypes, dict):
+        phenotypes = {str(Query(q)): q for q in phenotypes}
+    if hadm_ids is None:
+        hadm_ids = _lookup(module_path, icd_map_path, 'code', None)
+    hadm_ids = np.unique(pd.Series(hadm_ids).dropna().astype('int64').values)
+    matrix = pd.DataFrame(index=pd.Index(hadm_ids, name='hadm_id'))
+    for name, query in phenotypes.items():
+        matrix[name] = np.isin(hadm_ids, Query(query).hadm_ids(module_path, icd_map_path)).astype('int8')
+    print("[ PHENOTYPES FINISHED ]")
+    return matrix
@@ -20,49 +20,93 @@ importlib.reload(utils.uom_conversion)
 import utils.uom_conversion
 from utils.uom_conversion import *
 
+import utils.parallel_extract
+from utils.parallel_extract import *
+importlib.reload(utils.parallel_extract)
+import utils.parallel_extract
+from utils.parallel_extract import *
+
+import utils.feature_store
+from utils.feature_store import *
+importlib.reload(utils.feature_store)
+import utils.feature_store
+from utils.feature_store import *
+
+import utils.feature_dictionary
+from utils.feature_dictionary import *
+importlib.reload(utils.feature_dictionary)
+import utils.feature_dictionary
+from utils.feature_dictionary import *
+
+import utils.subject_fingerprint
+from utils.subject_fingerprint import *
+importlib.reload(utils.subject_fingerprint)
+import utils.subject_fingerprint
+from utils.subject_fingerprint import *
+
 # module of preprocessing functions
 if not os.path.exists("./data/features"):
     os.makedirs("./data/features")
 if not os.path.exists("./data/summary"):
     os.makedirs("./data/summary")
 
-def feature_nonicu(cohort_output,version_path, diag_flag=True,lab_flag=True,proc_flag=True,med_flag=True):
-    if diag_flag:
-        print("[EXTRACTING DIAGNOSIS DATA]")
-        diag = preproc_icd_module("./"+version_path+"/hosp/diagnoses_icd.csv.gz", './data/cohort/'+cohort_output+'.csv.gz', './utils/mappings/ICD9_to_ICD10_mapping.txt', map_code_colname='diagnosis_code')
-        diag[['subject_id', 'hadm_id', 'icd_code','root_icd10_convert','root']].to_csv("./data/features/preproc_diag.csv.gz", compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED DIAGNOSIS DATA]")
+def extract_diag_hosp(cohort_output, version_path, refresh=False):
+    print("[EXTRACTING DIAGNOSIS DATA]")
+    diag = extract_subjects('preproc_diag', lambda cohort: preproc_icd_module("./"+version_path+"/hosp/diagnoses_icd.csv.gz", './data/cohort/'+cohort+'.csv.gz', './utils/mappings/ICD9_to_ICD10_mapping.txt', map_code_colname='diagnosis_code'),
+                            cohort_output, version_path, ['hosp/diagnoses_icd'], refresh, sources=['./utils/mappings/ICD9_to_ICD10_mapping.txt'])
+    save_feature(encode_columns(diag[['subject_id', 'hadm_id', 'icd_code','root_icd10_convert','root']]), 'preproc_diag')
+    print("[SUCCESSFULLY SAVED DIAGNOSIS DATA]")
 
-#     if lab_flag:    
-#         out = preproc_out("./mimic-iv-1.0/icu/outputevents.csv.gz", './data/cohort/'+cohort_output+'.csv.gz', 'charttime', dtypes=None, usecols=None)
-#         out[['subject_id', 'hadm_id', 'stay_id', 'itemid', 'charttime', 'intime', 'event_time_from_admit']].to_csv("./data/features/preproc_out_icu.csv.gz", compression='gzip', index=False)
-    
-    if proc_flag:
-        print("[EXTRACTING PROCEDURES DATA]")
-        proc = preproc_proc("./"+version_path+"/hosp/procedures_icd.csv.gz",'./data/cohort/'+cohort_output+'.csv.gz', 'chartdate', 'base_anchor_year', dtypes=None, usecols=None)
-        proc[['subject_id', 'hadm_id', 'icd_code','icd_version', 'chartdate', 'admittime', 'proc_time_from_admit']].to_csv("./data/features/preproc_proc.csv.gz", compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED PROCEDURES DATA]")
-    
-    if med_flag:
-        print("[EXTRACTING MEDICATIONS DATA]")
-        med = preproc_meds("./"+version_path+"/hosp/prescriptions.csv.gz", './data/cohort/'+cohort_output+'.csv.gz','./utils/mappings/ndc_product.txt')
-        med[['subject_id', 'hadm_id', 'starttime','stoptime','drug','nonproprietaryname', 'start_hours_from_admit', 'stop_hours_from_admit','dose_val_rx']].to_csv('./data/features/preproc_med.csv.gz', compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED MEDICATIONS DATA]")
-        
+def extract_proc_hosp(cohort_output, version_path, refresh=False):
+    print("[EXTRACTING PROCEDURES DATA]")
+    proc = extract_subjects('preproc_proc', lambda cohort: preproc_proc("./"+version_path+"/hosp/procedures_icd.csv.gz",'./data/cohort/'+cohort+'.csv.gz', 'chartdate', 'base_anchor_year', dtypes=None, usecols=None),
+                            cohort_output, version_path, ['hosp/procedures_icd'], refresh)
+    save_feature(encode_columns(proc[['subject_id', 'hadm_id', 'icd_code','icd_version', 'chartdate', 'admittime', 'proc_time_from_admit']]), 'preproc_proc')
+    print("[SUCCESSFULLY SAVED PROCEDURES DATA]")
+
+def extract_med_hosp(cohort_output, version_path, engine='pandas', refresh=False):
+    print("[EXTRACTING MEDICATIONS DATA]")
+    med = extract_subjects('preproc_med', lambda cohort: preproc_meds("./"+version_path+"/hosp/prescriptions.csv.gz", './data/cohort/'+cohort+'.csv.gz','./utils/mappings/ndc_product.txt', engine=engine),
+                           cohort_output, version_path, ['hosp/prescriptions'], refresh, sources=['./utils/mappings/ndc_product.txt'])
+    save_feature(encode_columns(med[['subject_id', 'hadm_id', 'starttime','stoptime','drug','nonproprietaryname', 'start_hours_from_admit', 'stop_hours_from_admit','dose_val_rx']]), 'preproc_med')
+    # pharmacologic classes, one row per prescription and class (see epc_matrix)
+    epc = med_epc(med, './utils/mappings/ndc_product.txt')
+    save_feature(encode_columns(epc), 'preproc_med_epc')
+    print("[SUCCESSFULLY SAVED MEDICATIONS DATA]")
+
+def extract_labs_hosp(cohort_output, version_path, engine='pandas', refresh=False, impute_workers=1):
+    print("[EXTRACTING LABS DATA]")
+    # missing hadm_ids of the lab events are imputed from the subject's admissions
+    adm_table = "core/admissions" if version_path=="mimiciv/1.0" else "hosp/admissions"
+    lab = extract_subjects('preproc_labs', lambda cohort: preproc_labs("./"+version_path+"/hosp/labevents.csv.gz", version_path,'./data/cohort/'+cohort+'.csv.gz','charttime', 'base_anchor_year', dtypes=None, usecols=None, engine=engine, impute_workers=impute_workers),
+                           cohort_output, version_path, ['hosp/labevents', adm_table], refresh)
+    lab = drop_wrong_uom(lab, 0.95)
+    save_feature(encode_columns(lab[['subject_id', 'hadm_id', 'charttime', 'itemid','admittime','lab_time_from_admit','valuenum']]), 'preproc_labs')
+    print("[SUCCESSFULLY SAVED LABS DATA]")
+
+def feature_nonicu(cohort_output,version_path, diag_flag=True,lab_flag=True,proc_flag=True,med_flag=True, engine='pandas', workers=1, memory_budget=None, memory_limit=None, refresh=False, impute_workers=1):
+    """Extracts the selected modules. With workers > 1 the modules run in parallel worker processes,
+    memory_budget/memory_limit are passed to parallel_extract.run_modules (budgets keyed by 'labs', 'med', ...).
+    impute_workers: worker processes imputing the missing hadm_ids of the lab events, kept for the whole labs module.
+    With refresh only the subjects whose rows changed since the previous refresh are extracted again
+    (see subject_fingerprint.py); the first refresh extracts every subject."""
+    jobs=[]
+    # heaviest modules first, the parallel run starts them in this order
     if lab_flag:
-        print("[EXTRACTING LABS DATA]")
-        lab = preproc_labs("./"+version_path+"/hosp/labevents.csv.gz", version_path,'./data/cohort/'+cohort_output+'.csv.gz','charttime', 'base_anchor_year', dtypes=None, usecols=None)
-        lab = drop_wrong_uom(lab, 0.95)
-        lab[['subject_id', 'hadm_id', 'charttime', 'itemid','admittime','lab_time_from_admit','valuenum']].to_csv('./data/features/preproc_labs.csv.gz', compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED LABS DATA]")
-        
-        
-        
+        jobs.append(('labs', extract_labs_hosp, (cohort_output, version_path, engine, refresh, impute_workers)))
+    if med_flag:
+        jobs.append(('med', extract_med_hosp, (cohort_output, version_path, engine, refresh)))
+    if proc_flag:
+        jobs.append(('proc', extract_proc_hosp, (cohort_output, version_path, refresh)))
+    if diag_flag:
+        jobs.append(('diag', extract_diag_hosp, (cohort_output, version_path, refresh)))
+    run_modules(jobs, workers, memory_budget, memory_limit)
+
 def preprocess_features_hosp(cohort_output, diag_flag,proc_flag,med_flag,lab_flag,group_diag,group_med,group_proc,clean_labs,impute_labs,thresh,left_thresh):
     #print(thresh)
     if diag_flag:
         print("[PROCESSING DIAGNOSIS DATA]")
-        diag = pd.read_csv("./data/features/preproc_diag.csv.gz", compression='gzip',header=0)
+        diag = load_feature('preproc_diag')
         if(group_diag=='Keep both ICD-9 and ICD-10 codes'):
             diag['new_icd_code']=diag['icd_code']
         if(group_diag=='Convert ICD-9 to ICD-10 codes'):
@@ -71,35 +115,37 @@ def preprocess_features_hosp(cohort_output, diag_flag,proc_flag,med_flag,lab_fla
             diag['new_icd_code']=diag['root']
 
         diag=diag[['subject_id', 'hadm_id', 'new_icd_code']].dropna()
+        diag['new_icd_code']=diag['new_icd_code'].astype('int32')
         print("Total number of rows",diag.shape[0])
-        diag.to_csv("./data/features/preproc_diag.csv.gz", compression='gzip', index=False)
+        save_feature(diag, 'preproc_diag')
         print("[SUCCESSFULLY SAVED DIAGNOSIS DATA]")
     
     if med_flag:
         print("[PROCESSING MEDICATIONS DATA]")
         if group_med:           
-            med = pd.read_csv("./data/features/preproc_med.csv.gz", compression='gzip',header=0)
+            med = load_feature('preproc_med')
             if group_med:
                 med['drug_name']=med['nonproprietaryname']
             else:
                 med['drug_name']=med['drug']
             med=med[['subject_id', 'hadm_id', 'starttime','stoptime','drug_name', 'start_hours_from_admit', 'stop_hours_from_admit','dose_val_rx']].dropna()
+            med['drug_name']=med['drug_name'].astype('int32')
             print("Total number of rows",med.shape[0])
-            med.to_csv('./data/features/preproc_med.csv.gz', compression='gzip', index=False)
+            save_feature(med, 'preproc_med')
             print("[SUCCESSFULLY SAVED MEDICATIONS DATA]")
     
     
     if proc_flag:
         print("[PROCESSING PROCEDURES DATA]")
-        proc = pd.read_csv("./data/features/preproc_proc.csv.gz", compression='gzip',header=0)
+        proc = load_feature('preproc_proc')
         if(group_proc=='ICD-9 and ICD-10'):
             proc=proc[['subject_id', 'hadm_id', 'icd_code', 'chartdate', 'admittime', 'proc_time_from_admit']]
             print("Total number of rows",proc.shape[0])
-            proc.dropna().to_csv("./data/features/preproc_proc.csv.gz", compression='gzip', index=False)
+            save_feature(proc.dropna(), 'preproc_proc')
         elif(group_proc=='ICD-10'):
             proc=proc.loc[proc.icd_version == 10][['subject_id', 'hadm_id', 'icd_code', 'chartdate', 'admittime', 'proc_time_from_admit']].dropna()
             print("Total number of rows",proc.shape[0])
-            proc.to_csv("./data/features/preproc_proc.csv.gz", compression='gzip', index=False)
+            save_feature(proc, 'preproc_proc')
         print("[SUCCESSFULLY SAVED PROCEDURES DATA]")
         
         
@@ -107,7 +153,7 @@ def preprocess_features_hosp(cohort_output, diag_flag,proc_flag,med_flag,lab_fla
         
         if clean_labs:   
             print("[PROCESSING LABS DATA]")
-            labs = pd.read_csv("./data/features/preproc_labs.csv.gz", compression='gzip',header=0)
+            labs = load_feature('preproc_labs')
             labs = outlier_imputation(labs, 'itemid', 'valuenum', thresh,left_thresh,impute_labs)
             
 
@@ -119,24 +165,25 @@ def preprocess_features_hosp(cohort_output, diag_flag,proc_flag,med_flag,lab_fla
 #                     print(f"{idx} not found")
             print("Total number of rows",labs.shape[0])
 #             del labs['valueuom']
-            labs.to_csv("./data/features/preproc_labs.csv.gz", compression='gzip', index=False)
+            save_feature(labs, 'preproc_labs')
             print("[SUCCESSFULLY SAVED LABS DATA]")
         
 def generate_summary_hosp(diag_flag,proc_flag,med_flag,lab_flag):
     print("[GENERATING FEATURE SUMMARY]")
     if diag_flag:
-        diag = pd.read_csv("./data/features/preproc_diag.csv.gz", compression='gzip',header=0)
+        diag = load_feature('preproc_diag', ['hadm_id','new_icd_code'])
         freq=diag.groupby(['hadm_id','new_icd_code']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['new_icd_code'])['mean_frequency'].mean().reset_index()
         total=diag.groupby('new_icd_code').size().reset_index(name="total_count")
         summary=pd.merge(freq,total,on='new_icd_code',how='right')
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/diag_summary.csv',index=False)
         summary['new_icd_code'].to_csv('./data/summary/diag_features.csv',index=False)
 
 
     if med_flag:
-        med = pd.read_csv("./data/features/preproc_med.csv.gz", compression='gzip',header=0)
+        med = load_feature('preproc_med', ['hadm_id','drug_name','dose_val_rx'])
         freq=med.groupby(['hadm_id','drug_name']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['drug_name'])['mean_frequency'].mean().reset_index()
         
@@ -146,31 +193,36 @@ def generate_summary_hosp(diag_flag,proc_flag,med_flag,lab_flag):
         summary=pd.merge(freq,summary,on='drug_name',how='right')
         summary['missing%']=100*(summary['missing_count']/summary['total_count'])
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/med_summary.csv',index=False)
         summary['drug_name'].to_csv('./data/summary/med_features.csv',index=False)
 
-    
+        # pharmacologic classes: admissions given each class, the column sums of the admission x class matrix
+        epc = load_feature('preproc_med_epc', ['hadm_id','epc'])
+        matrix, index, classes = epc_matrix(epc)
+        summary=pd.DataFrame({'epc': classes.values, 'admission_count': np.asarray(matrix.sum(axis=0)).ravel()})
+        total=epc.groupby('epc').size().reset_index(name="total_count")
+        summary=pd.merge(summary,total,on='epc',how='left')
+        summary=decode_columns(summary)
+        summary.to_csv('./data/summary/med_epc_summary.csv',index=False)
+
+
     
     if proc_flag:
-        proc = pd.read_csv("./data/features/preproc_proc.csv.gz", compression='gzip',header=0)
+        proc = load_feature('preproc_proc', ['hadm_id','icd_code'])
         freq=proc.groupby(['hadm_id','icd_code']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['icd_code'])['mean_frequency'].mean().reset_index()
         total=proc.groupby('icd_code').size().reset_index(name="total_count")
         summary=pd.merge(freq,total,on='icd_code',how='right')
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/proc_summary.csv',index=False)
         summary['icd_code'].to_csv('./data/summary/proc_features.csv',index=False)
 
         
         
     if lab_flag:
-        chunksize = 10000000
-        labs=pd.DataFrame()
-        for chunk in tqdm(pd.read_csv("./data/features/preproc_labs.csv.gz", compression='gzip',header=0, index_col=None,chunksize=chunksize)):
-            if labs.empty:
-                labs=chunk
-            else:
-                labs=labs.append(chunk, ignore_index=True)
+        labs=load_feature('preproc_labs', ['hadm_id','itemid','valuenum'])
         freq=labs.groupby(['hadm_id','itemid']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['itemid'])['mean_frequency'].mean().reset_index()
         
@@ -180,6 +232,7 @@ def generate_summary_hosp(diag_flag,proc_flag,med_flag,lab_flag):
         summary=pd.merge(freq,summary,on='itemid',how='right')
         summary['missing%']=100*(summary['missing_count']/summary['total_count'])
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/labs_summary.csv',index=False)
         summary['itemid'].to_csv('./data/summary/labs_features.csv',index=False)
 
@@ -189,48 +242,37 @@ def features_selection_hosp(cohort_output, diag_flag,proc_flag,med_flag,lab_flag
     if diag_flag:
         if group_diag:
             print("[FEATURE SELECTION DIAGNOSIS DATA]")
-            diag = pd.read_csv("./data/features/preproc_diag.csv.gz", compression='gzip',header=0)
-            features=pd.read_csv("./data/summary/diag_features.csv",header=0)
-            diag=diag[diag['new_icd_code'].isin(features['new_icd_code'].unique())]
-        
-            print("Total number of rows",diag.shape[0])
-            diag.to_csv("./data/features/preproc_diag.csv.gz", compression='gzip', index=False)
+            diag = load_feature('preproc_diag', ['new_icd_code'])
+            features=pd.read_csv("./data/summary/diag_features.csv",header=0,dtype=str)
+            rows = rewrite_feature('preproc_diag', mask=diag['new_icd_code'].isin(lookup(features['new_icd_code'], 'icd_code')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED DIAGNOSIS DATA]")
     
     if med_flag:       
         if group_med:   
             print("[FEATURE SELECTION MEDICATIONS DATA]")
-            med = pd.read_csv("./data/features/preproc_med.csv.gz", compression='gzip',header=0)
-            features=pd.read_csv("./data/summary/med_features.csv",header=0)
-            med=med[med['drug_name'].isin(features['drug_name'].unique())]
-            print("Total number of rows",med.shape[0])
-            med.to_csv('./data/features/preproc_med.csv.gz', compression='gzip', index=False)
+            med = load_feature('preproc_med', ['drug_name'])
+            features=pd.read_csv("./data/summary/med_features.csv",header=0,dtype=str)
+            rows = rewrite_feature('preproc_med', mask=med['drug_name'].isin(lookup(features['drug_name'], 'drug_name')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED MEDICATIONS DATA]")
     
     
     if proc_flag:
         if group_proc:
             print("[FEATURE SELECTION PROCEDURES DATA]")
-            proc = pd.read_csv("./data/features/preproc_proc.csv.gz", compression='gzip',header=0)
-            features=pd.read_csv("./data/summary/proc_features.csv",header=0)
-            proc=proc[proc['icd_code'].isin(features['icd_code'].unique())]
-            print("Total number of rows",proc.shape[0])
-            proc.to_csv("./data/features/preproc_proc.csv.gz", compression='gzip', index=False)
+            proc = load_feature('preproc_proc', ['icd_code'])
+            features=pd.read_csv("./data/summary/proc_features.csv",header=0,dtype=str)
+            rows = rewrite_feature('preproc_proc', mask=proc['icd_code'].isin(lookup(features['icd_code'], 'icd_code')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED PROCEDURES DATA]")
         
         
     if lab_flag:
         if clean_labs:            
             print("[FEATURE SELECTION LABS DATA]")
-            chunksize = 10000000
-            labs=pd.DataFrame()
-            for chunk in tqdm(pd.read_csv("./data/features/preproc_labs.csv.gz", compression='gzip',header=0, index_col=None,chunksize=chunksize)):
-                if labs.empty:
-                    labs=chunk
-                else:
-                    labs=labs.append(chunk, ignore_index=True)
+            labs = load_feature('preproc_labs', ['itemid'])
             features=pd.read_csv("./data/summary/labs_features.csv",header=0)
-            labs=labs[labs['itemid'].isin(features['itemid'].unique())]
-            print("Total number of rows",labs.shape[0])
-            labs.to_csv("./data/features/preproc_labs.csv.gz", compression='gzip', index=False)
+            rows = rewrite_feature('preproc_labs', mask=labs['itemid'].isin(lookup(features['itemid'], 'itemid')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED LABS DATA]")
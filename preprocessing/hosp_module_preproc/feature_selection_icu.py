@@ -23,48 +23,95 @@ importlib.reload(utils.uom_conversion)
 import utils.uom_conversion
 from utils.uom_conversion import *
 
+import utils.parallel_extract
+from utils.parallel_extract import *
+importlib.reload(utils.parallel_extract)
+import utils.parallel_extract
+from utils.parallel_extract import *
+
+import utils.feature_store
+from utils.feature_store import *
+importlib.reload(utils.feature_store)
+import utils.feature_store
+from utils.feature_store import *
+
+import utils.feature_dictionary
+from utils.feature_dictionary import *
+importlib.reload(utils.feature_dictionary)
+import utils.feature_dictionary
+from utils.feature_dictionary import *
+
+import utils.subject_fingerprint
+from utils.subject_fingerprint import *
+importlib.reload(utils.subject_fingerprint)
+import utils.subject_fingerprint
+from utils.subject_fingerprint import *
+
 
 if not os.path.exists("./data/features"):
     os.makedirs("./data/features")
 if not os.path.exists("./data/features/chartevents"):
     os.makedirs("./data/features/chartevents")
 
-def feature_icu(cohort_output, version_path, diag_flag=True,out_flag=True,chart_flag=True,proc_flag=True,med_flag=True):
-    if diag_flag:
-        print("[EXTRACTING DIAGNOSIS DATA]")
-        diag = preproc_icd_module("./"+version_path+"/hosp/diagnoses_icd.csv.gz", './data/cohort/'+cohort_output+'.csv.gz', './utils/mappings/ICD9_to_ICD10_mapping.txt', map_code_colname='diagnosis_code')
-        diag[['subject_id', 'hadm_id', 'stay_id', 'icd_code','root_icd10_convert','root']].to_csv("./data/features/preproc_diag_icu.csv.gz", compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED DIAGNOSIS DATA]")
-    
-    if out_flag:  
-        print("[EXTRACTING OUPTPUT EVENTS DATA]")
-        out = preproc_out("./"+version_path+"/icu/outputevents.csv.gz", './data/cohort/'+cohort_output+'.csv.gz', 'charttime', dtypes=None, usecols=None)
-        out[['subject_id', 'hadm_id', 'stay_id', 'itemid', 'charttime', 'intime', 'event_time_from_admit']].to_csv("./data/features/preproc_out_icu.csv.gz", compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED OUPTPUT EVENTS DATA]")
-    
+def extract_diag_icu(cohort_output, version_path, refresh=False):
+    print("[EXTRACTING DIAGNOSIS DATA]")
+    diag = extract_subjects('preproc_diag_icu', lambda cohort: preproc_icd_module("./"+version_path+"/hosp/diagnoses_icd.csv.gz", './data/cohort/'+cohort+'.csv.gz', './utils/mappings/ICD9_to_ICD10_mapping.txt', map_code_colname='diagnosis_code'),
+                            cohort_output, version_path, ['hosp/diagnoses_icd'], refresh, sources=['./utils/mappings/ICD9_to_ICD10_mapping.txt'])
+    save_feature(encode_columns(diag[['subject_id', 'hadm_id', 'stay_id', 'icd_code','root_icd10_convert','root']]), 'preproc_diag_icu')
+    print("[SUCCESSFULLY SAVED DIAGNOSIS DATA]")
+
+def extract_out_icu(cohort_output, version_path, refresh=False):
+    print("[EXTRACTING OUPTPUT EVENTS DATA]")
+    out = extract_subjects('preproc_out_icu', lambda cohort: preproc_out("./"+version_path+"/icu/outputevents.csv.gz", './data/cohort/'+cohort+'.csv.gz', 'charttime', dtypes=None, usecols=None),
+                           cohort_output, version_path, ['icu/outputevents'], refresh)
+    save_feature(encode_columns(out[['subject_id', 'hadm_id', 'stay_id', 'itemid', 'charttime', 'intime', 'event_time_from_admit']]), 'preproc_out_icu')
+    print("[SUCCESSFULLY SAVED OUPTPUT EVENTS DATA]")
+
+def extract_chart_icu(cohort_output, version_path, engine='pandas', refresh=False):
+    print("[EXTRACTING CHART EVENTS DATA]")
+    chart = extract_subjects('preproc_chart_icu', lambda cohort: preproc_chart("./"+version_path+"/icu/chartevents.csv.gz", './data/cohort/'+cohort+'.csv.gz', 'charttime', dtypes=None, usecols=['stay_id','charttime','itemid','valuenum','valueuom'], engine=engine),
+                             cohort_output, version_path, ['icu/chartevents'], refresh)
+    chart = drop_wrong_uom(chart, 0.95)
+    save_feature(encode_columns(chart[['stay_id', 'itemid','event_time_from_admit','valuenum']]), 'preproc_chart_icu')
+    print("[SUCCESSFULLY SAVED CHART EVENTS DATA]")
+
+def extract_proc_icu(cohort_output, version_path, refresh=False):
+    print("[EXTRACTING PROCEDURES DATA]")
+    proc = extract_subjects('preproc_proc_icu', lambda cohort: preproc_proc("./"+version_path+"/icu/procedureevents.csv.gz", './data/cohort/'+cohort+'.csv.gz', 'starttime', dtypes=None, usecols=['stay_id','starttime','itemid']),
+                            cohort_output, version_path, ['icu/procedureevents'], refresh)
+    save_feature(encode_columns(proc[['subject_id', 'hadm_id', 'stay_id', 'itemid', 'starttime', 'intime', 'event_time_from_admit']]), 'preproc_proc_icu')
+    print("[SUCCESSFULLY SAVED PROCEDURES DATA]")
+
+def extract_med_icu(cohort_output, version_path, engine='pandas', refresh=False):
+    print("[EXTRACTING MEDICATIONS DATA]")
+    med = extract_subjects('preproc_med_icu', lambda cohort: preproc_meds("./"+version_path+"/icu/inputevents.csv.gz", './data/cohort/'+cohort+'.csv.gz', engine=engine),
+                           cohort_output, version_path, ['icu/inputevents'], refresh)
+    save_feature(encode_columns(med[['subject_id', 'hadm_id', 'stay_id', 'itemid' ,'starttime','endtime', 'start_hours_from_admit', 'stop_hours_from_admit','rate','amount','orderid']]), 'preproc_med_icu')
+    print("[SUCCESSFULLY SAVED MEDICATIONS DATA]")
+
+def feature_icu(cohort_output, version_path, diag_flag=True,out_flag=True,chart_flag=True,proc_flag=True,med_flag=True, engine='pandas', workers=1, memory_budget=None, memory_limit=None, refresh=False):
+    """Extracts the selected modules. With workers > 1 the modules run in parallel worker processes,
+    memory_budget/memory_limit are passed to parallel_extract.run_modules (budgets keyed by 'chart', 'med', ...).
+    With refresh only the subjects whose rows changed since the previous refresh are extracted again
+    (see subject_fingerprint.py); the first refresh extracts every subject."""
+    jobs=[]
+    # heaviest modules first, the parallel run starts them in this order
     if chart_flag:
-        print("[EXTRACTING CHART EVENTS DATA]")
-        chart=preproc_chart("./"+version_path+"/icu/chartevents.csv.gz", './data/cohort/'+cohort_output+'.csv.gz', 'charttime', dtypes=None, usecols=['stay_id','charttime','itemid','valuenum','valueuom'])
-        chart = drop_wrong_uom(chart, 0.95)
-        chart[['stay_id', 'itemid','event_time_from_admit','valuenum']].to_csv("./data/features/preproc_chart_icu.csv.gz", compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED CHART EVENTS DATA]")
-    
-    if proc_flag:
-        print("[EXTRACTING PROCEDURES DATA]")
-        proc = preproc_proc("./"+version_path+"/icu/procedureevents.csv.gz", './data/cohort/'+cohort_output+'.csv.gz', 'starttime', dtypes=None, usecols=['stay_id','starttime','itemid'])
-        proc[['subject_id', 'hadm_id', 'stay_id', 'itemid', 'starttime', 'intime', 'event_time_from_admit']].to_csv("./data/features/preproc_proc_icu.csv.gz", compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED PROCEDURES DATA]")
-    
+        jobs.append(('chart', extract_chart_icu, (cohort_output, version_path, engine, refresh)))
     if med_flag:
-        print("[EXTRACTING MEDICATIONS DATA]")
-        med = preproc_meds("./"+version_path+"/icu/inputevents.csv.gz", './data/cohort/'+cohort_output+'.csv.gz')
-        med[['subject_id', 'hadm_id', 'stay_id', 'itemid' ,'starttime','endtime', 'start_hours_from_admit', 'stop_hours_from_admit','rate','amount','orderid']].to_csv('./data/features/preproc_med_icu.csv.gz', compression='gzip', index=False)
-        print("[SUCCESSFULLY SAVED MEDICATIONS DATA]")
+        jobs.append(('med', extract_med_icu, (cohort_output, version_path, engine, refresh)))
+    if out_flag:
+        jobs.append(('out', extract_out_icu, (cohort_output, version_path, refresh)))
+    if proc_flag:
+        jobs.append(('proc', extract_proc_icu, (cohort_output, version_path, refresh)))
+    if diag_flag:
+        jobs.append(('diag', extract_diag_icu, (cohort_output, version_path, refresh)))
+    run_modules(jobs, workers, memory_budget, memory_limit)
 
 def preprocess_features_icu(cohort_output, diag_flag, group_diag,chart_flag,clean_chart,impute_outlier_chart,thresh,left_thresh):
     if diag_flag:
         print("[PROCESSING DIAGNOSIS DATA]")
-        diag = pd.read_csv("./data/features/preproc_diag_icu.csv.gz", compression='gzip',header=0)
+        diag = load_feature('preproc_diag_icu')
         if(group_diag=='Keep both ICD-9 and ICD-10 codes'):
             diag['new_icd_code']=diag['icd_code']
         if(group_diag=='Convert ICD-9 to ICD-10 codes'):
@@ -73,14 +120,15 @@ def preprocess_features_icu(cohort_output, diag_flag, group_diag,chart_flag,clea
             diag['new_icd_code']=diag['root']
 
         diag=diag[['subject_id', 'hadm_id', 'stay_id', 'new_icd_code']].dropna()
+        diag['new_icd_code']=diag['new_icd_code'].astype('int32')
         print("Total number of rows",diag.shape[0])
-        diag.to_csv("./data/features/preproc_diag_icu.csv.gz", compression='gzip', index=False)
+        save_feature(diag, 'preproc_diag_icu')
         print("[SUCCESSFULLY SAVED DIAGNOSIS DATA]")
         
     if chart_flag:
         if clean_chart:   
             print("[PROCESSING CHART EVENTS DATA]")
-            chart = pd.read_csv("./data/features/preproc_chart_icu.csv.gz", compression='gzip',header=0)
+            chart = load_feature('preproc_chart_icu')
             chart = outlier_imputation(chart, 'itemid', 'valuenum', thresh,left_thresh,impute_outlier_chart)
             
 #             for i in [227441, 229357, 229358, 229360]:
@@ -90,7 +138,7 @@ def preprocess_features_icu(cohort_output, diag_flag, group_diag,chart_flag,clea
 #                 except IndexError:
 #                     print(f"{idx} not found")
             print("Total number of rows",chart.shape[0])
-            chart.to_csv("./data/features/preproc_chart_icu.csv.gz", compression='gzip', index=False)
+            save_feature(chart, 'preproc_chart_icu')
             print("[SUCCESSFULLY SAVED CHART EVENTS DATA]")
             
         
@@ -98,18 +146,19 @@ def preprocess_features_icu(cohort_output, diag_flag, group_diag,chart_flag,clea
 def generate_summary_icu(diag_flag,proc_flag,med_flag,out_flag,chart_flag):
     print("[GENERATING FEATURE SUMMARY]")
     if diag_flag:
-        diag = pd.read_csv("./data/features/preproc_diag_icu.csv.gz", compression='gzip',header=0)
+        diag = load_feature('preproc_diag_icu', ['stay_id','new_icd_code'])
         freq=diag.groupby(['stay_id','new_icd_code']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['new_icd_code'])['mean_frequency'].mean().reset_index()
         total=diag.groupby('new_icd_code').size().reset_index(name="total_count")
         summary=pd.merge(freq,total,on='new_icd_code',how='right')
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/diag_summary.csv',index=False)
         summary['new_icd_code'].to_csv('./data/summary/diag_features.csv',index=False)
 
 
     if med_flag:
-        med = pd.read_csv("./data/features/preproc_med_icu.csv.gz", compression='gzip',header=0)
+        med = load_feature('preproc_med_icu', ['stay_id','itemid','amount'])
         freq=med.groupby(['stay_id','itemid']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['itemid'])['mean_frequency'].mean().reset_index()
         
@@ -119,34 +168,37 @@ def generate_summary_icu(diag_flag,proc_flag,med_flag,out_flag,chart_flag):
         summary=pd.merge(freq,summary,on='itemid',how='right')
         #summary['missing%']=100*(summary['missing_count']/summary['total_count'])
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/med_summary.csv',index=False)
         summary['itemid'].to_csv('./data/summary/med_features.csv',index=False)
 
     
     
     if proc_flag:
-        proc = pd.read_csv("./data/features/preproc_proc_icu.csv.gz", compression='gzip',header=0)
+        proc = load_feature('preproc_proc_icu', ['stay_id','itemid'])
         freq=proc.groupby(['stay_id','itemid']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['itemid'])['mean_frequency'].mean().reset_index()
         total=proc.groupby('itemid').size().reset_index(name="total_count")
         summary=pd.merge(freq,total,on='itemid',how='right')
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/proc_summary.csv',index=False)
         summary['itemid'].to_csv('./data/summary/proc_features.csv',index=False)
 
         
     if out_flag:
-        out = pd.read_csv("./data/features/preproc_out_icu.csv.gz", compression='gzip',header=0)
+        out = load_feature('preproc_out_icu', ['stay_id','itemid'])
         freq=out.groupby(['stay_id','itemid']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['itemid'])['mean_frequency'].mean().reset_index()
         total=out.groupby('itemid').size().reset_index(name="total_count")
         summary=pd.merge(freq,total,on='itemid',how='right')
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/out_summary.csv',index=False)
         summary['itemid'].to_csv('./data/summary/out_features.csv',index=False)
         
     if chart_flag:
-        chart=pd.read_csv("./data/features/preproc_chart_icu.csv.gz", compression='gzip',header=0)
+        chart=load_feature('preproc_chart_icu', ['stay_id','itemid','valuenum'])
         freq=chart.groupby(['stay_id','itemid']).size().reset_index(name="mean_frequency")
         freq=freq.groupby(['itemid'])['mean_frequency'].mean().reset_index()
 
@@ -161,6 +213,7 @@ def generate_summary_icu(diag_flag,proc_flag,med_flag,out_flag,chart_flag):
 #         final.groupby('itemid')['total_count'].sum().reset_index()
 #         final.groupby('itemid')['missing%'].mean().reset_index()
         summary=summary.fillna(0)
+        summary=decode_columns(summary)
         summary.to_csv('./data/summary/chart_summary.csv',index=False)
         summary['itemid'].to_csv('./data/summary/chart_features.csv',index=False)
 
@@ -170,54 +223,47 @@ def features_selection_icu(cohort_output, diag_flag,proc_flag,med_flag,out_flag,
     if diag_flag:
         if group_diag:
             print("[FEATURE SELECTION DIAGNOSIS DATA]")
-            diag = pd.read_csv("./data/features/preproc_diag_icu.csv.gz", compression='gzip',header=0)
-            features=pd.read_csv("./data/summary/diag_features.csv",header=0)
-            diag=diag[diag['new_icd_code'].isin(features['new_icd_code'].unique())]
-        
-            print("Total number of rows",diag.shape[0])
-            diag.to_csv("./data/features/preproc_diag_icu.csv.gz", compression='gzip', index=False)
+            diag = load_feature('preproc_diag_icu', ['new_icd_code'])
+            features=pd.read_csv("./data/summary/diag_features.csv",header=0,dtype=str)
+            rows = rewrite_feature('preproc_diag_icu', mask=diag['new_icd_code'].isin(lookup(features['new_icd_code'], 'icd_code')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED DIAGNOSIS DATA]")
     
     if med_flag:       
         if group_med:   
             print("[FEATURE SELECTION MEDICATIONS DATA]")
-            med = pd.read_csv("./data/features/preproc_med_icu.csv.gz", compression='gzip',header=0)
+            med = load_feature('preproc_med_icu', ['itemid'])
             features=pd.read_csv("./data/summary/med_features.csv",header=0)
-            med=med[med['itemid'].isin(features['itemid'].unique())]
-            print("Total number of rows",med.shape[0])
-            med.to_csv('./data/features/preproc_med_icu.csv.gz', compression='gzip', index=False)
+            rows = rewrite_feature('preproc_med_icu', mask=med['itemid'].isin(lookup(features['itemid'], 'itemid')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED MEDICATIONS DATA]")
     
     
     if proc_flag:
         if group_proc:
             print("[FEATURE SELECTION PROCEDURES DATA]")
-            proc = pd.read_csv("./data/features/preproc_proc_icu.csv.gz", compression='gzip',header=0)
+            proc = load_feature('preproc_proc_icu', ['itemid'])
             features=pd.read_csv("./data/summary/proc_features.csv",header=0)
-            proc=proc[proc['itemid'].isin(features['itemid'].unique())]
-            print("Total number of rows",proc.shape[0])
-            proc.to_csv("./data/features/preproc_proc_icu.csv.gz", compression='gzip', index=False)
+            rows = rewrite_feature('preproc_proc_icu', mask=proc['itemid'].isin(lookup(features['itemid'], 'itemid')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED PROCEDURES DATA]")
         
         
     if out_flag:
         if group_out:            
             print("[FEATURE SELECTION OUTPUT EVENTS DATA]")
-            out = pd.read_csv("./data/features/preproc_out_icu.csv.gz", compression='gzip',header=0)
+            out = load_feature('preproc_out_icu', ['itemid'])
             features=pd.read_csv("./data/summary/out_features.csv",header=0)
-            out=out[out['itemid'].isin(features['itemid'].unique())]
-            print("Total number of rows",out.shape[0])
-            out.to_csv("./data/features/preproc_out_icu.csv.gz", compression='gzip', index=False)
+            rows = rewrite_feature('preproc_out_icu', mask=out['itemid'].isin(lookup(features['itemid'], 'itemid')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED OUTPUT EVENTS DATA]")
             
     if chart_flag:
         if group_chart:            
             print("[FEATURE SELECTION CHART EVENTS DATA]")
             
-            chart=pd.read_csv("./data/features/preproc_chart_icu.csv.gz", compression='gzip',header=0, index_col=None)
-            
+            chart = load_feature('preproc_chart_icu', ['itemid'])
             features=pd.read_csv("./data/summary/chart_features.csv",header=0)
-            chart=chart[chart['itemid'].isin(features['itemid'].unique())]
-            print("Total number of rows",chart.shape[0])
-            chart.to_csv("./data/features/preproc_chart_icu.csv.gz", compression='gzip', index=False)
+            rows = rewrite_feature('preproc_chart_icu', mask=chart['itemid'].isin(lookup(features['itemid'], 'itemid')))
+            print("Total number of rows",rows)
             print("[SUCCESSFULLY SAVED CHART EVENTS DATA]")
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the utils and cohort modules import each other by plain name, as the notebooks set up sys.path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'utils'), os.path.join(ROOT, 'preprocessing', 'day_intervals_preproc')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
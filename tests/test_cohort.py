@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import day_intervals_cohort
+import day_intervals_cohort_v2
+import phenotype
+from test_readmission import random_cohort
+
+MODULES = [day_intervals_cohort, day_intervals_cohort_v2]
+
+
+@pytest.mark.parametrize('module', MODULES)
+def test_disease_suffix(module):
+    assert module.disease_suffix('I50') == 'I50'
+    assert module.disease_suffix(phenotype.Query('(I50 or I110) and not N18')) == 'I110_I50_and_not_N18'
+    assert module.disease_suffix(phenotype.codes('I50', 'I110', primary=True)) == 'primary_I110_I50'
+
+
+def icu_stays():
+    t = pd.Timestamp('2150-01-01')
+    days = lambda *d: [t + pd.Timedelta(days=x) if x is not None else pd.NaT for x in d]
+    # 100 dies in the ICU, 200 after leaving the ICU but in the hospital, 300 after leaving the hospital,
+    # 400 is followed by an ICU stay 10 days later, 500 has no ICU discharge time
+    return pd.DataFrame({'subject_id': [1, 2, 3, 4, 4, 5], 'stay_id': [100, 200, 300, 400, 401, 500],
+                         'hadm_id': [10, 20, 30, 40, 41, 50],
+                         'intime': days(1, 1, 1, 1, 14, 1), 'outtime': days(3, 3, 3, 4, 16, None),
+                         'admittime': days(0, 0, 0, 0, 13, 0), 'dischtime': days(10, 10, 10, 6, 20, 10),
+                         'dod': days(2, 5, 20, None, None, None), 'los': [2, 2, 2, 3, 2, np.nan],
+                         'admn_valid': [False, True, True, True, True, True]})
+
+
+@pytest.mark.parametrize('module', MODULES)
+def test_get_labels_hospital_and_icu_mortality(module):
+    labels = [('Readmission', 30), ('Hospital Mortality', 0), ('ICU Mortality', 0), ('Length of Stay', 2)]
+    df = module.get_labels(icu_stays(), labels, 'subject_id', 'intime', 'outtime', 'dod').set_index('stay_id')
+    expected = pd.DataFrame({'label_readmission_30': [np.nan, 0, 0, 1, 0, 0],
+                             'label_hospital_mortality_0': [1, 1, 0, 0, 0, 0],
+                             'label_icu_mortality_0': [1, 0, 0, 0, 0, np.nan],
+                             'label_length_of_stay_2': [0, 0, 0, 1, 0, np.nan]},
+                            index=pd.Index([100, 200, 300, 400, 401, 500], name='stay_id')).astype('Int32')
+    pd.testing.assert_frame_equal(df[expected.columns], expected)
+
+
+@pytest.mark.parametrize('module', MODULES)
+@pytest.mark.parametrize('seed', range(10))
+def test_get_labels_match_single_label_cohorts(module, seed):
+    rng = np.random.default_rng(seed)
+    df = random_cohort(rng, 200, with_nat=seed % 2 == 0)
+    df['dod'] = df['admittime'] + pd.to_timedelta(rng.integers(-5, 30, len(df)), unit='D')
+    df.loc[rng.random(len(df)) < 0.7, 'dod'] = pd.NaT
+    df['admn_valid'] = True
+    labels = module.get_labels(df, [('Readmission', 30), ('Hospital Mortality', 0)], 'subject_id', 'admittime', 'dischtime', 'dod').set_index('hadm_id')
+
+    readmit, _ = module.get_case_ctrls(df, 30, 'subject_id', 'hadm_id', 'admittime', 'dischtime', 'min_valid_year', 'dod', use_admn=True)
+    readmit = readmit.set_index('hadm_id')['label']
+    assert (labels.loc[readmit.index, 'label_readmission_30'] == readmit).all()
+    assert labels['label_readmission_30'].drop(readmit.index).isna().all()
+
+    mort, _ = module.get_case_ctrls(df, None, 'subject_id', 'hadm_id', 'admittime', 'dischtime', 'min_valid_year', 'dod', use_mort=True)
+    mort = mort.set_index('hadm_id')['label']
+    assert (labels.loc[mort.index, 'label_hospital_mortality_0'] == mort).all()
+    assert labels['label_hospital_mortality_0'].drop(mort.index).isna().all()
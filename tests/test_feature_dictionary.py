@@ -0,0 +1,60 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import feature_dictionary
+
+pytestmark = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+
+
+@pytest.fixture(autouse=True)
+def features_dir(tmp_path, monkeypatch):
+    # feature_store paths are relative to the working directory, like ./data/features in the notebooks
+    monkeypatch.chdir(tmp_path)
+
+
+def _take_lock(flag):
+    with feature_dictionary._Lock('itemid'):
+        open(flag, 'w').close()
+
+
+def _die_holding_lock(ready):
+    feature_dictionary._Lock('itemid').__enter__()
+    open(ready, 'w').close()
+    os._exit(0)
+
+
+def test_lock_waits_for_live_holder(tmp_path):
+    flag = str(tmp_path / 'taken')
+    ctx = multiprocessing.get_context('fork')
+    with feature_dictionary._Lock('itemid'):
+        worker = ctx.Process(target=_take_lock, args=(flag,))
+        worker.start()
+        time.sleep(1)
+        assert not os.path.exists(flag)
+    worker.join(10)
+    assert os.path.exists(flag)
+
+
+def test_lock_of_dead_holder_is_released(tmp_path):
+    ready = str(tmp_path / 'ready')
+    ctx = multiprocessing.get_context('fork')
+    worker = ctx.Process(target=_die_holding_lock, args=(ready,))
+    worker.start()
+    worker.join(10)
+    assert os.path.exists(ready)
+    flag = str(tmp_path / 'taken')
+    worker = ctx.Process(target=_take_lock, args=(flag,))
+    worker.start()
+    worker.join(10)
+    assert os.path.exists(flag)
+
+
+def test_release_without_lock_file():
+    lock = feature_dictionary._Lock('itemid')
+    with lock:
+        os.remove(lock.path)
+    with feature_dictionary._Lock('itemid'):
+        pass
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import hosp_preprocess_util
+
+
+def row_new_ndc(ndc):
+    """The per-row formatter ndc_meds replaced"""
+    if ndc < 0:
+        return np.nan
+    ndc = str(ndc)
+    return (("0" * (11 - len(ndc))) + ndc)[0:-2]
+
+
+def write_ndc_table(path):
+    rows = [('a', '6-0740', 'Sitagliptin', 'Dipeptidyl Peptidase 4 Inhibitor [EPC],Dipeptidyl Peptidase 4 Inhibitors [MoA]'),
+            ('b', '74-4339', 'Adalimumab', 'Tumor Necrosis Factor Blocker [EPC]'),
+            ('c', '12345-678', 'Heparin', np.nan)]
+    pd.DataFrame(rows, columns=['PRODUCTID', 'PRODUCTNDC', 'NONPROPRIETARYNAME', 'PHARM_CLASSES']).to_csv(path, sep='\t', index=False)
+
+
+def test_ndc_meds_matches_row_formatter(tmp_path):
+    mapping = str(tmp_path / 'ndc_product.txt')
+    write_ndc_table(mapping)
+    rng = np.random.default_rng(0)
+    ndc = pd.Series(np.concatenate([[600074012, 7443390, 1234567801, 99, 0, 123456789012], rng.integers(0, 10**11, 50)]), dtype='float64')
+    ndc[[1, 7, 20]] = np.nan
+    med = pd.DataFrame({'hadm_id': np.arange(len(ndc)), 'drug': 'x', 'ndc': ndc})
+
+    out = hosp_preprocess_util.ndc_meds(med.copy(), mapping)
+
+    expected = med.ndc.fillna(-1).astype('Int64').apply(row_new_ndc)
+    ndc_map = hosp_preprocess_util.read_ndc_table(mapping)
+    expected = expected[expected.isin(ndc_map['new_ndc'])]
+    # prescriptions without NDC are dropped by the merge, they never take the code of another drug
+    assert sorted(out['hadm_id']) == sorted(expected.index)
+    assert out.set_index('hadm_id')['new_ndc'].sort_index().equals(expected.sort_index().rename_axis('hadm_id').rename('new_ndc'))
+
@@ -0,0 +1,66 @@
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+import day_intervals_cohort
+import day_intervals_cohort_v2
+
+
+def loop_partition_by_readmit(df, gap, group_col, visit_col, admit_col, disch_col, valid_col):
+    """The per-visit loop partition_by_readmit replaced (without DataFrame.append)"""
+    case, ctrl = [], []
+    for subject, group in df.sort_values(by=[group_col, admit_col]).groupby(group_col):
+        for idx in range(group.shape[0] - 1):
+            visit_time = group.iloc[idx][disch_col]
+            if group.loc[(group[admit_col] > visit_time) & (group[admit_col] - visit_time <= gap)].shape[0] >= 1:
+                case.append(group.iloc[[idx]])
+            else:
+                ctrl.append(group.iloc[[idx]])
+        ctrl.append(group.iloc[[-1]])
+    return (pd.concat(case) if case else df.iloc[:0]), (pd.concat(ctrl) if ctrl else df.iloc[:0])
+
+
+def random_cohort(rng, n, with_nat):
+    admit = pd.Timestamp('2150-01-01') + pd.to_timedelta(rng.integers(0, 400, n), unit='D') + pd.to_timedelta(rng.integers(0, 3, n) * 12, unit='h')
+    df = pd.DataFrame({'subject_id': rng.integers(0, max(1, n // 3), n), 'hadm_id': np.arange(n) + 100, 'admittime': admit,
+                       'dischtime': admit + pd.to_timedelta(rng.integers(-2, 20, n), unit='D'), 'min_valid_year': 2150})
+    if with_nat:
+        df.loc[rng.random(n) < 0.05, 'dischtime'] = pd.NaT
+        df.loc[rng.random(n) < 0.05, 'admittime'] = pd.NaT
+    return df
+
+
+def assert_same_rows(expected, actual):
+    assert list(expected.index) == list(actual.index)
+    assert expected.astype(str).equals(actual[expected.columns].astype(str))
+
+
+@pytest.mark.parametrize('module', [day_intervals_cohort, day_intervals_cohort_v2])
+@pytest.mark.parametrize('seed', range(20))
+def test_partition_by_readmit_matches_loop(module, seed):
+    # whole day admissions with 12h offsets give ties and readmissions exactly at the gap,
+    # negative stays give admissions before the previous discharge
+    rng = np.random.default_rng(seed)
+    df = random_cohort(rng, int(rng.integers(1, 300)), with_nat=seed % 3 == 0)
+    gap = datetime.timedelta(days=int(rng.integers(0, 40)))
+    case, ctrl = loop_partition_by_readmit(df, gap, 'subject_id', 'hadm_id', 'admittime', 'dischtime', 'min_valid_year')
+    new_case, new_ctrl, _ = module.partition_by_readmit(df, gap, 'subject_id', 'hadm_id', 'admittime', 'dischtime', 'min_valid_year')
+    assert_same_rows(case, new_case)
+    assert_same_rows(ctrl, new_ctrl)
+
+
+@pytest.mark.parametrize('module', [day_intervals_cohort, day_intervals_cohort_v2])
+def test_partition_by_readmit_boundaries(module):
+    t = pd.Timestamp('2150-01-01')
+    df = pd.DataFrame({'subject_id': [1, 1, 1, 2, 2, 3, 3],
+                       'hadm_id': [10, 11, 12, 20, 21, 30, 31],
+                       'admittime': [t, t + pd.Timedelta(days=35), t + pd.Timedelta(days=35), t, t + pd.Timedelta(days=31), t, pd.NaT],
+                       'dischtime': [t + pd.Timedelta(days=5), t + pd.Timedelta(days=35), t + pd.Timedelta(days=36), t + pd.Timedelta(days=1), t + pd.Timedelta(days=32), pd.NaT, t],
+                       'min_valid_year': 2150})
+    gap = datetime.timedelta(days=30)
+    case, ctrl = loop_partition_by_readmit(df, gap, 'subject_id', 'hadm_id', 'admittime', 'dischtime', 'min_valid_year')
+    new_case, new_ctrl, _ = module.partition_by_readmit(df, gap, 'subject_id', 'hadm_id', 'admittime', 'dischtime', 'min_valid_year')
+    # readmitted exactly gap days after the discharge (10), not readmitted at the discharge time itself (11)
+    assert sorted(new_case['hadm_id']) == sorted(case['hadm_id']) == [10, 20]
+    assert_same_rows(case, new_case)
+    assert_same_rows(ctrl, new_ctrl)
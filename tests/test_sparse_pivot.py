@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import hosp_preprocess_util
+import icu_preprocess_util
+
+
+def long_format(seed, n=400):
+    rng = np.random.default_rng(seed)
+    # few subjects and features, so that many features are found for as many subjects
+    return pd.DataFrame({'subject_id': rng.integers(0, 6, n), 'label': 0, 'timedelta': rng.integers(0, 3, n),
+                         'itemid': rng.integers(0, 12, n), 'values': rng.random(n).round(2)})
+
+
+@pytest.mark.parametrize('module', [hosp_preprocess_util, icu_preprocess_util])
+@pytest.mark.parametrize('ohe', [True, False])
+@pytest.mark.parametrize('seed', range(10))
+def test_sparse_pivot_matches_dense(module, ohe, seed):
+    df = long_format(seed)
+    if ohe:
+        df = df.drop(columns='values')
+    dense = module.pivot_cohort(df, 'chart_', 'itemid', ohe=ohe, max_features=5)
+    matrix, index, columns = module.pivot_cohort(df, 'chart_', 'itemid', ohe=ohe, max_features=5, as_sparse=True)
+
+    assert list(columns) == list(dense.columns)
+    expected = dense.reset_index()
+    assert (index.values == expected[['subject_id', 'label', 'timedelta']].values).all()
+    np.testing.assert_allclose(matrix.toarray(), expected[dense.columns].fillna(0).values)
+
+
+def test_top_features_ties_in_value_order():
+    df = pd.DataFrame({'subject_id': [1, 1, 2, 2, 3], 'itemid': [30, 10, 20, 10, 30]})
+    # 10 and 30 are found for two subjects, 20 for one
+    assert list(hosp_preprocess_util.top_features(df, 'itemid', 2)) == [10, 30]
+    assert list(hosp_preprocess_util.top_features(df, 'itemid', 3)) == [10, 30, 20]
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import hosp_preprocess_util
+
+pytest.importorskip('duckdb')
+
+
+@pytest.fixture
+def release(tmp_path, monkeypatch):
+    """A few admissions and lab events of a synthetic MIMIC-IV release, in the working directory like ./mimiciv"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('mimiciv/2.0/hosp')
+    os.makedirs('data/cohort')
+    adm = pd.DataFrame({'subject_id': [1, 1, 2, 3],
+                        'hadm_id': [10, 11, 20, 30],
+                        'admittime': ['2150-01-01 08:00:00', '2150-03-01 08:00:00', '2151-05-02 10:00:00', '2152-07-01 00:00:00'],
+                        'dischtime': ['2150-01-05 12:00:00', '2150-03-04 08:00:00', '2151-05-09 10:00:00', '2152-07-03 00:00:00']})
+    adm.to_csv('mimiciv/2.0/hosp/admissions.csv.gz', index=False)
+    adm[adm['hadm_id'] != 30].assign(label=0).to_csv('data/cohort/cohort.csv.gz', index=False)
+
+    rng = np.random.default_rng(0)
+    n = 200
+    subjects = rng.choice([1, 2, 3], n)
+    hadm_ids = pd.Series(subjects * 10, dtype='float64').where(rng.random(n) > 0.3)
+    charttimes = pd.to_datetime('2150-01-01') + pd.to_timedelta(rng.integers(0, 900 * 24 * 60, n), unit='min')
+    labs = pd.DataFrame({'labevent_id': np.arange(n), 'subject_id': subjects, 'hadm_id': hadm_ids,
+                         'itemid': rng.choice([50912, 51221], n), 'charttime': charttimes.strftime('%Y-%m-%d %H:%M:%S'),
+                         'valuenum': pd.Series(rng.random(n).round(3)).where(rng.random(n) > 0.1),
+                         'valueuom': pd.Series(rng.choice(['mg/dL', '%'], n)).where(rng.random(n) > 0.2)})
+    # events inside the admissions, so that the imputation has hadm_ids to find
+    inside = labs.index % 3 == 0
+    admittimes = pd.to_datetime(labs.loc[inside, 'subject_id'].map(adm.groupby('subject_id')['admittime'].first()))
+    labs.loc[inside, 'charttime'] = (admittimes + pd.to_timedelta(labs.index[inside], unit='min')).dt.strftime('%Y-%m-%d %H:%M:%S')
+    labs.to_csv('mimiciv/2.0/hosp/labevents.csv.gz', index=False)
+
+
+def test_labs_engines_match(release):
+    results = [hosp_preprocess_util.preproc_labs("./mimiciv/2.0/hosp/labevents.csv.gz", 'mimiciv/2.0', './data/cohort/cohort.csv.gz',
+                                                 'charttime', 'base_anchor_year', dtypes=None, usecols=None, engine=engine)
+               for engine in ['pandas', 'duckdb']]
+    by = ['subject_id', 'charttime', 'itemid', 'valuenum']
+    pandas_labs, sql_labs = [df.sort_values(by).reset_index(drop=True) for df in results]
+    assert len(pandas_labs) > 0 and (pandas_labs['valueuom'] == '0').any()
+    pd.testing.assert_frame_equal(pandas_labs, sql_labs[pandas_labs.columns])
@@ -0,0 +1,86 @@
+import os
+import glob
+import shutil
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Collected chunks are spilled to disk once they take more memory than this (bytes).
+# Read when a sink is created, so it can be lowered for a whole process (see parallel_extract.py).
+DEFAULT_MEMORY_BUDGET = 4 * 1024 ** 3
+
+
+class ChunkSink():
+    """Accumulates the per-chunk results of a loop and concatenates them once at the end.
+
+    Replaces growing a frame with `df = df.append(chunk)` inside the loop, which copies everything
+    collected so far on every iteration. Chunks are kept in a list; once they take more than
+    memory_budget bytes (DEFAULT_MEMORY_BUDGET if None) they are written to a Parquet file in a temporary
+    folder and released.
+    result() reads the spilled files back (memory-mapped) and concatenates everything in order.
+
+    sink = ChunkSink()
+    for chunk in chunks:
+        sink.append(chunk)
+    df = sink.result()"""
+
+    def __init__(self, memory_budget=None, ignore_index=True, spill_dir=None):
+        self.memory_budget = memory_budget if memory_budget is not None else DEFAULT_MEMORY_BUDGET
+        self.ignore_index = ignore_index
+        self.spill_dir = spill_dir
+        self.chunks = []
+        self.nbytes = 0
+        self.spill_path = None
+        self.spills = 0
+        self.last_empty = None
+
+    def append(self, chunk: pd.DataFrame):
+        if chunk.empty:
+            # only kept so that a loop without any rows still returns the columns
+            self.last_empty = chunk
+            return
+        self.chunks.append(chunk)
+        self.nbytes += int(chunk.memory_usage(index=True, deep=True).sum())
+        if self.nbytes > self.memory_budget:
+            self._spill()
+
+    def _spill(self):
+        if self.spill_path is None:
+            self.spill_path = tempfile.mkdtemp(prefix='chunk_sink_', dir=self.spill_dir)
+        df = pd.concat(self.chunks, ignore_index=self.ignore_index)
+        path = os.path.join(self.spill_path, f'part-{self.spills:05d}')
+        try:
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=not self.ignore_index), path + '.parquet')
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # object columns mixing types (e.g. strings filled with 0) cannot be stored in Parquet
+            df.to_pickle(path + '.pkl')
+        self.spills += 1
+        self.chunks = []
+        self.nbytes = 0
+
+    def _read_spills(self) -> list:
+        frames = []
+        for path in sorted(glob.glob(os.path.join(self.spill_path, 'part-*'))):
+            if path.endswith('.parquet'):
+                frames.append(pq.read_table(path, memory_map=True).to_pandas())
+            else:
+                frames.append(pd.read_pickle(path))
+        return frames
+
+    def result(self) -> pd.DataFrame:
+        """Concatenation of all appended chunks (an empty frame if none had rows)"""
+        frames = self.chunks
+        if self.spill_path is not None:
+            try:
+                frames = self._read_spills() + self.chunks
+            finally:
+                shutil.rmtree(self.spill_path, ignore_errors=True)
+                self.spill_path = None
+        self.chunks = []
+        self.nbytes = 0
+        if not frames:
+            return self.last_empty if self.last_empty is not None else pd.DataFrame()
+        if len(frames) == 1 and not self.ignore_index:
+            return frames[0]
+        return pd.concat(frames, ignore_index=self.ignore_index)
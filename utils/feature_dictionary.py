@@ -0,0 +1,134 @@
+import os
+import numpy as np
+import pandas as pd
+from feature_store import FEATURE_DIR, feature_path, save_feature, load_feature
+
+# the dictionary lock is an OS file lock, released by the OS if its holder dies
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+# Global dictionary encoding of the feature identifiers. The extraction step replaces the values of these
+# columns by contiguous int32 codes before saving a feature table, so the cleaning, summary, selection and
+# Generator steps group and pivot dense ints instead of object columns. Codes are shared across tables
+# (chart, output, procedure and medication itemids use one dictionary) and stay stable as new values are
+# added. Values are decoded back at the boundaries: summary csv files and the ./data/dict pickles.
+VOCABULARIES = {'itemid': int, 'icd_code': str, 'drug_name': str, 'epc': str}
+COLUMN_VOCAB = {'itemid': 'itemid',
+                'icd_code': 'icd_code', 'root_icd10_convert': 'icd_code', 'root': 'icd_code', 'new_icd_code': 'icd_code',
+                'drug': 'drug_name', 'nonproprietaryname': 'drug_name', 'drug_name': 'drug_name',
+                'epc': 'epc'}
+
+
+def _dictionary_name(vocab: str) -> str:
+    return 'dictionary_' + vocab
+
+
+def _normalize(values: pd.Series, vocab: str) -> pd.Series:
+    # codes read without a dtype can mix numbers and strings ('4019' and 4019 are the same code),
+    # empty names count as missing like they did in the csv feature files
+    if VOCABULARIES[vocab] is str:
+        values = values.replace('', np.nan)
+        return values.where(values.isna(), values.astype(str))
+    return values
+
+
+class _Lock():
+    """Lock serializing dictionary updates between the parallel extraction workers. The lock file is never
+    removed, a worker waits on the lock of the open file, which the OS drops when the holder exits or crashes."""
+
+    def __init__(self, vocab):
+        self.path = feature_path(_dictionary_name(vocab)) + '.lock'
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(FEATURE_DIR, exist_ok=True)
+        while True:
+            self.file = open(self.path, 'a+')
+            if fcntl is None:
+                self.file.seek(0)
+                try:
+                    # retries for 10 seconds before raising
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    return self
+                except OSError:
+                    self.file.close()
+                    continue
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            # the lock file may have been removed (a cleared features folder) while this worker waited on it
+            try:
+                if os.path.samestat(os.fstat(self.file.fileno()), os.stat(self.path)):
+                    return self
+            except FileNotFoundError:
+                pass
+            self.file.close()
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+
+
+def vocabulary(vocab: str) -> pd.Index:
+    """Values of a dictionary, the position of a value is its code"""
+    if not os.path.exists(feature_path(_dictionary_name(vocab))):
+        return pd.Index([], dtype=VOCABULARIES[vocab] if VOCABULARIES[vocab] is int else object)
+    return pd.Index(load_feature(_dictionary_name(vocab))['value'])
+
+
+def _codes(values: pd.Series, index: pd.Index) -> pd.Series:
+    """int32 codes of values, float with NaN where values are missing (as pandas does for ids)"""
+    codes = pd.Series(index.get_indexer(values), index=values.index)
+    if values.isna().any():
+        return codes.where(values.notna())
+    return codes.astype('int32')
+
+
+def encode(values: pd.Series, vocab: str) -> pd.Series:
+    """Codes of values, adding the values not yet in the dictionary"""
+    values = _normalize(values, vocab)
+    with _Lock(vocab):
+        index = vocabulary(vocab)
+        new = pd.Index(values.dropna().unique()).difference(index)
+        if len(new):
+            index = index.append(new.sort_values())
+            save_feature(pd.DataFrame({'value': index}), _dictionary_name(vocab))
+    return _codes(values, index)
+
+
+def lookup(values: pd.Series, vocab: str) -> pd.Series:
+    """Codes of values without changing the dictionary, -1 for values it does not hold"""
+    return _codes(_normalize(values, vocab), vocabulary(vocab))
+
+
+def decode(codes: pd.Series, vocab: str) -> pd.Series:
+    """Values of codes, NaN where the code is missing"""
+    index = vocabulary(vocab)
+    missing = codes.isna()
+    values = pd.Series(np.asarray(index)[codes.fillna(0).astype('int64').values], index=codes.index)
+    return values.where(~missing) if missing.any() else values
+
+
+def encode_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Replaces the identifier columns of a feature table (see COLUMN_VOCAB) by their codes"""
+    return df.assign(**{col: encode(df[col], COLUMN_VOCAB[col]) for col in df.columns if col in COLUMN_VOCAB})
+
+
+def decode_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Replaces the coded identifier columns of a feature table by their values"""
+    return df.assign(**{col: decode(df[col], COLUMN_VOCAB[col]) for col in df.columns if col in COLUMN_VOCAB})
+
+
+def vocab_list(values: pd.Series, vocab: str) -> list:
+    """Distinct values ordered by their code, the vocabulary lists pickled in ./data/dict"""
+    codes = lookup(pd.Series(values.dropna().unique()), vocab)
+    index = vocabulary(vocab)
+    return list(index[np.sort(codes.values)])
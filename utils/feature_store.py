@@ -0,0 +1,114 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# Intermediate feature tables (preproc_diag_icu, preproc_chart_icu, preproc_labs, ...) written by the feature
+# extraction and rewritten by the cleaning / selection steps before the Generator reads them.
+# They are stored as uncompressed Arrow IPC (Feather v2) files so that reads are memory-mapped and only the
+# requested columns are materialized, and dtypes (int32 ids and offsets, float32 values, datetimes) survive.
+# Event offsets from admission (event_time_from_admit, lab_time_from_admit, start_hours_from_admit, ...) are stored
+# as whole minutes (see offset_minutes) and read as numbers by the Generators.
+FEATURE_DIR = "./data/features"
+
+
+def feature_path(name: str) -> str:
+    return os.path.join(FEATURE_DIR, name + '.arrow')
+
+
+def _to_table(df: pd.DataFrame) -> pa.Table:
+    # empty strings are stored as missing values, as the csv files did (e.g. drugs without a
+    # nonproprietaryname are dropped by the dropna of the cleaning step)
+    text = [col for col in df.columns[df.dtypes == object] if (df[col] == '').any()]
+    if text:
+        df = df.copy()
+        for col in text:
+            df[col] = df[col].replace('', np.nan)
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # object columns mixing numbers and strings (e.g. codes read without a dtype) are stored as strings
+        df = df.copy()
+        for col in df.columns[df.dtypes == object]:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _write(table: pa.Table, name: str):
+    # written next to the old file and renamed, the old file may still be memory-mapped by the caller
+    os.makedirs(FEATURE_DIR, exist_ok=True)
+    path = feature_path(name)
+    feather.write_feather(table, path + '.tmp', compression='uncompressed')
+    os.replace(path + '.tmp', path)
+
+
+def _read(name: str, columns=None) -> pa.Table:
+    return feather.read_table(feature_path(name), columns=columns, memory_map=True)
+
+
+def save_feature(df: pd.DataFrame, name: str):
+    """Saves a feature table, replacing the previous version"""
+    _write(_to_table(df), name)
+
+
+def load_feature(name: str, columns=None) -> pd.DataFrame:
+    """Reads a feature table, only the given columns are materialized"""
+    return _read(name, columns).to_pandas()
+
+
+def iter_feature(name: str, chunksize: int, columns=None):
+    """Yields a feature table in frames of chunksize rows, indexed like pd.read_csv(chunksize=...) chunks"""
+    table = _read(name, columns)
+    if table.num_rows == 0:
+        yield table.to_pandas()
+    for start in range(0, table.num_rows, chunksize):
+        df = table.slice(start, chunksize).to_pandas()
+        df.index = pd.RangeIndex(start, start + len(df))
+        yield df
+
+
+def append_feature(df: pd.DataFrame, name: str):
+    """Adds rows to a feature table. The existing record batches are copied as they are, without being
+    converted to pandas and back."""
+    if not os.path.exists(feature_path(name)):
+        return save_feature(df, name)
+    table = _read(name)
+    new = _to_table(df[table.column_names]).cast(table.schema)
+    _write(pa.concat_tables([table, new]), name)
+
+
+def rewrite_feature(name: str, mask=None, columns=None, keep=None) -> int:
+    """Rewrites a feature table changing only what is given, the other columns are carried over as Arrow arrays.
+    - mask: boolean array over the rows, rows where it is False are dropped
+    - columns: {name: values} of columns to replace or add (values aligned with the current rows)
+    - keep: columns to keep (in this order), after the new columns are added
+    Returns the number of rows left."""
+    table = _read(name)
+    for col, values in (columns or {}).items():
+        arr = pa.Array.from_pandas(pd.Series(values).reset_index(drop=True))
+        if col in table.column_names:
+            table = table.set_column(table.column_names.index(col), col, arr)
+        else:
+            table = table.append_column(col, arr)
+    if keep is not None:
+        table = table.select(keep)
+    if mask is not None:
+        table = table.filter(pa.array(np.asarray(mask, dtype=bool)))
+    _write(table, name)
+    return table.num_rows
+
+
+def offset_minutes(offset: pd.Series) -> pd.Series:
+    """Whole minutes (rounded down) of a timedelta column such as charttime - intime, int32,
+    float with NaN where the offset is missing"""
+    minutes = offset // pd.Timedelta(minutes=1)
+    if minutes.isna().any():
+        return minutes.astype('float64')
+    return minutes.astype('int32')
+
+
+def offset_hours(minutes: pd.Series) -> pd.Series:
+    """Whole hours (rounded down) of an offset in minutes such as event_time_from_admit (days*24 plus the hour
+    of the day), NaN where the offset is missing"""
+    return minutes // 60
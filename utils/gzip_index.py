@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+from tqdm import tqdm
+
+# indexed_gzip is optional; without it (or without an index) the tables are read sequentially
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# Raw tables that are indexed by build_indexes, the ones too large to wait for a sequential read
+INDEXED_TABLES = ['icu/chartevents', 'hosp/labevents']
+INDEX_SUFFIX = '.gzidx'
+# Uncompressed bytes between two seek points / row-aligned split points
+SPACING = 16 * 1024 ** 2
+
+
+def index_paths(csv_path: str) -> tuple:
+    """(seek point index, split point file) of a gzip csv table"""
+    return csv_path + INDEX_SUFFIX, csv_path + INDEX_SUFFIX + '.json'
+
+
+def has_index(csv_path: str) -> bool:
+    """True if the table was indexed with build_index and indexed_gzip is installed"""
+    return indexed_gzip is not None and all(os.path.exists(p) for p in index_paths(csv_path))
+
+
+def _row_start(block: bytes, quotes: int):
+    """Offset in block of the first row start, given the number of quote characters before the block,
+    None if the block holds no row break (quoted fields may contain line breaks)"""
+    pos = block.find(b'\n')
+    while pos != -1:
+        if (quotes + block.count(b'"', 0, pos)) % 2 == 0:
+            return pos + 1
+        pos = block.find(b'\n', pos + 1)
+    return None
+
+
+def build_index(csv_path: str, spacing=SPACING, overwrite=False):
+    """Builds a zran-style seek point index over a gzip csv table in a single decompression pass, plus a list
+    of row-aligned split points about `spacing` uncompressed bytes apart. Written next to the table as
+    <table>.csv.gz.gzidx and <table>.csv.gz.gzidx.json; iter_table then parses ranges of the table in parallel."""
+    if indexed_gzip is None:
+        raise ImportError("building a gzip index requires the indexed_gzip package (pip install indexed_gzip)")
+    index_path, splits_path = index_paths(csv_path)
+    if os.path.exists(splits_path) and not overwrite:
+        return index_path
+    with indexed_gzip.IndexedGzipFile(csv_path, spacing=spacing) as f:
+        header = f.readline()
+        offset, quotes, lines = len(header), 0, 0
+        splits = [offset]
+        with tqdm(unit='B', unit_scale=True) as progress:
+            while True:
+                block = f.read(spacing)
+                if not block:
+                    break
+                start = _row_start(block, quotes)
+                if start is not None:
+                    splits.append(offset + start)
+                quotes += block.count(b'"')
+                lines += block.count(b'\n')
+                offset += len(block)
+                progress.update(len(block))
+        f.export_index(index_path + '.tmp')
+    os.replace(index_path + '.tmp', index_path)
+    # written last: a seek point index without split points is an unfinished build and is ignored
+    with open(splits_path, 'w') as out:
+        json.dump({'header': header.decode(), 'size': offset, 'lines': lines, 'splits': splits + [offset]}, out)
+    return index_path
+
+
+def load_index(csv_path: str) -> dict:
+    with open(index_paths(csv_path)[1]) as f:
+        return json.load(f)
+
+
+def split_ranges(csv_path: str, rows: int) -> list:
+    """Splits the rows of an indexed table into (start, end) uncompressed byte ranges of about `rows` rows each"""
+    index = load_index(csv_path)
+    splits = index['splits']
+    target = max(1, rows) * index['size'] / max(1, index['lines'])
+    ranges, start = [], splits[0]
+    for point in splits[1:]:
+        if point - start >= target or point == splits[-1]:
+            if point > start:
+                ranges.append((start, point))
+            start = point
+    return ranges
+
+
+def read_range(csv_path: str, start: int, end: int) -> bytes:
+    """Decompresses bytes [start, end) of an indexed table, seeking from the closest seek point"""
+    with indexed_gzip.IndexedGzipFile(csv_path, index_file=index_paths(csv_path)[0]) as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def build_indexes(mimic4_path: str, overwrite=False):
+    """Indexes the large raw event tables (INDEXED_TABLES) of a MIMIC-IV release"""
+    for name in INDEXED_TABLES:
+        csv_path = os.path.join(mimic4_path, name + '.csv.gz')
+        if not os.path.exists(csv_path):
+            continue
+        print(f"[ INDEXING {name} ]")
+        build_index(csv_path, overwrite=overwrite)
+    print("[ SUCCESSFULLY INDEXED TABLES ]")
+
+
+if __name__ == '__main__':
+    # python utils/gzip_index.py ./mimiciv/2.0
+    build_indexes(sys.argv[1] if len(sys.argv) > 1 else './mimiciv/2.0')
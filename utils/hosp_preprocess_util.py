@@ -9,11 +9,28 @@ import datetime as dt
 from tqdm import tqdm
 import labs_preprocess_util
 from labs_preprocess_util import *
+import table_loader
+from table_loader import *
+import chunk_sink
+from chunk_sink import *
+import sql_backend
+from feature_store import offset_minutes
+from icd_mapping import read_icd_mapping, standardize_icd
+from mapping_cache import cached_table
+from scipy import sparse
+from sparse_pivot import pivot_sparse, top_features
 
-from sklearn.preprocessing import MultiLabelBinarizer
 importlib.reload(labs_preprocess_util)
 import labs_preprocess_util
 from labs_preprocess_util import *
+importlib.reload(table_loader)
+import table_loader
+from table_loader import *
+importlib.reload(chunk_sink)
+import chunk_sink
+from chunk_sink import *
+importlib.reload(sql_backend)
+import sql_backend
 
 ########################## GENERAL ##########################
 def dataframe_from_csv(path, compression='gzip', header=0, index_col=0, chunksize=None):
@@ -58,31 +75,6 @@ def read_diagnoses(mimic4_path):
     )
 
 
-def standardize_icd(mapping, df, root=False):
-    """Takes an ICD9 -> ICD10 mapping table and a diagnosis dataframe; adds column with converted ICD10 column"""
-
-    def icd_9to10(icd):
-        # If root is true, only map an ICD 9 -> 10 according to the ICD9's root (first 3 digits)
-        if root:
-            icd = icd[:3]
-        try:
-            # Many ICD-9's do not have a 1-to-1 mapping; get first index of mapped codes
-            return mapping.loc[mapping.diagnosis_code == icd].icd10cm.iloc[0]
-        except:
-            print("Error on code", icd)
-            return np.nan
-
-    # Create new column with original codes as default
-    col_name = 'icd10_convert'
-    if root: col_name = 'root_' + col_name
-    df[col_name] = df['icd_code'].values
-
-    # Group identical ICD9 codes, then convert all ICD9 codes within a group to ICD10
-    for code, group in df.loc[df.icd_version == 9].groupby(by='icd_code'):
-        new_code = icd_9to10(code)
-        for idx in group.index.values:
-            # Modify values of original df at the indexes in the groups
-            df.at[idx, col_name] = new_code
 
 
 ########################## LABS ##########################
@@ -149,12 +141,6 @@ def get_generic_drugs(mapping, df):
 
 
 ########################## MAPPING ##########################
-def read_icd_mapping(map_path):
-    mapping = pd.read_csv(map_path, header=0, delimiter='\t')
-    mapping.diagnosis_description = mapping.diagnosis_description.apply(str.lower)
-    return mapping
-
-
 def read_ndc_mapping(map_path):
     ndc_map = pd.read_csv(map_path, header=0, delimiter='\t')
     ndc_map.NONPROPRIETARYNAME = ndc_map.NONPROPRIETARYNAME.fillna("")
@@ -163,6 +149,49 @@ def read_ndc_mapping(map_path):
     return ndc_map
 
 
+# The mapping table is ALSO incorrectly formatted for 11 digit NDC codes. An 11 digit NDC is in the
+# form of xxxxx-xxxx-xx for manufactuerer-product-dosage. The hyphens are in the correct spots, but
+# the number of digits within each section may not be 5-4-2, in which case we add leading 0's to each
+# to restore the 11 digit format. However, we only take the 5-4 sections, just like format_ndc of ndc_meds
+def format_ndc_table(productndc: pd.Series) -> pd.Series:
+    parts = productndc.str.split("-")
+    return parts.str[0].str.zfill(5) + parts.str[1].str.zfill(4)
+
+
+def _parse_ndc_table(map_path):
+    ndc_map = pd.read_csv(map_path, header=0, delimiter='\t', encoding = 'latin1')
+    ndc_map.NONPROPRIETARYNAME = ndc_map.NONPROPRIETARYNAME.fillna("")
+    ndc_map.NONPROPRIETARYNAME = ndc_map.NONPROPRIETARYNAME.apply(str.lower)
+    ndc_map.columns = list(map(str.lower, ndc_map.columns))
+    ndc_map = ndc_map[['productndc', 'nonproprietaryname', 'pharm_classes']]
+
+    # Normalize the NDC codes in the mapping table so that they can be merged
+    ndc_map['new_ndc'] = format_ndc_table(ndc_map.productndc)
+    return ndc_map.drop_duplicates(subset=['new_ndc', 'nonproprietaryname'])
+
+
+def read_ndc_table(map_path):
+    """NDC product table normalized for the prescriptions join (productndc, nonproprietaryname, pharm_classes and the
+    9 digit new_ndc), parsed once and cached next to it (mapping_cache.py)"""
+    return cached_table(map_path, 'ndc_product', _parse_ndc_table)
+
+
+# In NDC mapping table, the pharm_class col is structured as a text string, separating different pharm classes from eachother
+# This can be [PE], [EPC], and others, but we're interested in EPC. Luckily, between each commas, it states if a phrase is [EPC]
+# So, we just string split by commas and keep phrases containing "[EPC]"
+def _parse_epc_table(map_path):
+    epc = read_ndc_table(map_path)[['new_ndc', 'pharm_classes']].dropna()
+    epc = epc.assign(epc=epc.pharm_classes.str.split(",")).explode('epc')
+    epc = epc[epc.epc.str.contains("[EPC]", regex=False)]
+    return epc[['new_ndc', 'epc']].drop_duplicates().reset_index(drop=True)
+
+
+def read_epc_table(map_path):
+    """Established Pharmacologic Classes (EPC) of the NDC products, one row per (new_ndc, epc),
+    to be joined to the prescriptions by new_ndc; parsed once and cached next to the NDC table"""
+    return cached_table(map_path, 'ndc_epc', _parse_epc_table)
+
+
 ########################## PREPROCESSING ##########################
 def get_range(df: pd.DataFrame, time_col:str, anchor_col:str, measure='days') -> pd.Series:
     """Uses array arithmetic to find the ranges an observation time could be in based on the patient's anchor info"""
@@ -189,19 +218,23 @@ def get_range(df: pd.DataFrame, time_col:str, anchor_col:str, measure='days') ->
     else:
         raise Exception('\'measure\' argument must be either \'years\' or \'days\'.')
 
-def preproc_meds(module_path:str, adm_cohort_path:str, mapping:str) -> pd.DataFrame:
+def preproc_meds(module_path:str, adm_cohort_path:str, mapping:str, engine='pandas') -> pd.DataFrame:
   
-    adm = pd.read_csv(adm_cohort_path, usecols=['hadm_id', 'admittime'], parse_dates = ['admittime'])
-    med = pd.read_csv(module_path, compression='gzip', usecols=['subject_id', 'hadm_id', 'drug', 'starttime', 'stoptime','ndc','dose_val_rx'], parse_dates = ['starttime', 'stoptime'])
-    med = med.merge(adm, left_on = 'hadm_id', right_on = 'hadm_id', how = 'inner')
-    med['start_hours_from_admit'] = med['starttime'] - med['admittime']
-    med['stop_hours_from_admit'] = med['stoptime'] - med['admittime']
+    if sql_backend.use_sql(engine):
+        med = sql_backend.preproc_meds_hosp(module_path, adm_cohort_path)
+    else:
+        adm = pd.read_csv(adm_cohort_path, usecols=['hadm_id', 'admittime'], parse_dates = ['admittime'])
+        med = load_table(module_path, columns=['subject_id', 'hadm_id', 'drug', 'starttime', 'stoptime','ndc','dose_val_rx'], filters=[('hadm_id', 'in', adm['hadm_id'].unique())], parse_dates = ['starttime', 'stoptime'])
+        med = med.merge(adm, left_on = 'hadm_id', right_on = 'hadm_id', how = 'inner')
+        med['start_hours_from_admit'] = offset_minutes(med['starttime'] - med['admittime'])
+        med['stop_hours_from_admit'] = offset_minutes(med['stoptime'] - med['admittime'])
     
     # Normalize drug strings and remove potential duplicates
 
+    # (once per distinct drug string)
     med.drug = med.drug.fillna("").astype(str)
-    med.drug = med.drug.apply(lambda x: x.lower().strip().replace(" ", "_") if not "" else "")
-    med.drug=med.drug.dropna().apply(lambda x: x.lower().strip())
+    codes, drugs = pd.factorize(med.drug)
+    med.drug = pd.Series(drugs).str.lower().str.strip().str.replace(" ", "_", regex=False).values.take(codes)
     
     #meds.to_csv(output_path, compression='gzip', index=False)
     med = ndc_meds(med,mapping)
@@ -224,107 +257,85 @@ def ndc_meds(med, mapping:str) -> pd.DataFrame:
     
     # The NDC codes in the prescription dataset is the 11-digit NDC code, although codes are missing
     # their leading 0's because the column was interpreted as a float then integer; this function restores
-    # the leading 0's, then obtains only the PRODUCT and MANUFACTUERER parts of the NDC code (first 9 digits)
-    def to_str(ndc):
-        if ndc < 0:         # dummy values are < 0
-            return np.nan
-        ndc = str(ndc)
-        return (("0"*(11 - len(ndc))) + ndc)[0:-2]
-
-    # The mapping table is ALSO incorrectly formatted for 11 digit NDC codes. An 11 digit NDC is in the
-    # form of xxxxx-xxxx-xx for manufactuerer-product-dosage. The hyphens are in the correct spots, but
-    # the number of digits within each section may not be 5-4-2, in which case we add leading 0's to each
-    # to restore the 11 digit format. However, we only take the 5-4 sections, just like the to_str function
-    def format_ndc_table(ndc):
-        parts = ndc.split("-")
-        return ("0"*(5 - len(parts[0])) + parts[0]) + ("0"*(4 - len(parts[1])) + parts[1])
-    
-    def read_ndc_mapping2(map_path):
-        ndc_map = pd.read_csv(map_path, header=0, delimiter='\t', encoding = 'latin1')
-        ndc_map.NONPROPRIETARYNAME = ndc_map.NONPROPRIETARYNAME.fillna("")
-        ndc_map.NONPROPRIETARYNAME = ndc_map.NONPROPRIETARYNAME.apply(str.lower)
-        ndc_map.columns = list(map(str.lower, ndc_map.columns))
-        return ndc_map
-    
-    # Read in NDC mapping table
-    ndc_map = read_ndc_mapping2(mapping)[['productndc', 'nonproprietaryname', 'pharm_classes']]
-    
-    # Normalize the NDC codes in the mapping table so that they can be merged
-    ndc_map['new_ndc'] = ndc_map.productndc.apply(format_ndc_table)
-    ndc_map.drop_duplicates(subset=['new_ndc', 'nonproprietaryname'], inplace=True)
-    med['new_ndc'] = med.ndc.apply(to_str)  
+    # the leading 0's, then obtains only the PRODUCT and MANUFACTUERER parts of the NDC code (first 9 digits),
+    # i.e. the code without its last 2 digits padded to 9 digits
+    def format_ndc(ndc):
+        new_ndc = pd.Series(ndc // 100).astype(str).str.zfill(9)
+        return new_ndc.where(ndc >= 0)     # dummy values are < 0
+
+    # Read in NDC mapping table, normalized (see format_ndc_table)
+    ndc_map = read_ndc_table(mapping)
+    # each distinct code is formatted once, missing codes (code -1 of factorize) take the NaN appended last
+    codes, uniques = pd.factorize(med.ndc)
+    formatted = format_ndc(np.asarray(uniques, dtype='int64')).values
+    med['new_ndc'] = np.append(formatted, np.nan).take(codes)
     
     # Left join the med dataset to the mapping information
     med = med.merge(ndc_map, how='inner', left_on='new_ndc', right_on='new_ndc')
-    
-    # In NDC mapping table, the pharm_class col is structured as a text string, separating different pharm classes from eachother
-    # This can be [PE], [EPC], and others, but we're interested in EPC. Luckily, between each commas, it states if a phrase is [EPC]
-    # So, we just string split by commas and keep phrases containing "[EPC]"
-    def get_EPC(s):
-        """Gets the Established Pharmacologic Class (EPC) from the mapping table"""
-        if type(s) != str:
-            return np.nan
-        words = s.split(",")
-        return [x for x in words if "[EPC]" in x]
-    
-    # Function generates a list of EPCs, as a drug can have multiple EPCs
-    med['EPC'] = med.pharm_classes.apply(get_EPC)
+    # a drug can have multiple EPCs, they are kept apart in med_epc
     
     return med
 
-def preproc_labs(dataset_path: str, version_path:str, cohort_path:str, time_col:str, anchor_col:str, dtypes: dict, usecols: list) -> pd.DataFrame:
-    """Function for getting hosp observations pertaining to a pickled cohort. Function is structured to save memory when reading and transforming data."""
+
+def med_epc(med: pd.DataFrame, mapping:str) -> pd.DataFrame:
+    """Established Pharmacologic Classes of the prescriptions of ndc_meds, one row per prescription and class
+    (joined to read_epc_table by new_ndc) instead of a list of classes per prescription"""
+    cols = [col for col in ['subject_id', 'hadm_id', 'start_hours_from_admit', 'stop_hours_from_admit'] if col in med.columns]
+    epc = med[cols + ['new_ndc']].merge(read_epc_table(mapping), how='inner', on='new_ndc')
+    return epc.drop(columns=['new_ndc']).drop_duplicates().reset_index(drop=True)
+
+def preproc_labs(dataset_path: str, version_path:str, cohort_path:str, time_col:str, anchor_col:str, dtypes: dict, usecols: list, engine='pandas', impute_workers=1) -> pd.DataFrame:
+    """Function for getting hosp observations pertaining to a pickled cohort. Function is structured to save memory when reading and transforming data.
+    impute_workers: worker processes imputing the missing hadm_ids (labs_preprocess_util.ImputationPool)"""
     
     usecols = ['itemid','subject_id','hadm_id','charttime','valuenum','valueuom']
-    dtypes = {
-        'itemid':'int64',
-        'subject_id':'int64',
-        # 'hadm_id':'int64',            # hadm_id type not defined because it contains NaN values
-        # 'charttime':'datetime64[ns]', # used as an argument in 'parse_cols' in pd.read_csv
-        'value':'object',
-        'valuenum':'float64',
-        'valueuom':'object',
-        'flag':'object'
-    }
-    df_cohort=pd.DataFrame()
-    cohort = pd.read_csv(cohort_path, compression='gzip', parse_dates = ['admittime'])
-    if version_path=="mimiciv/1.0":
-        adm = pd.read_csv("./"+version_path+"/core/admissions.csv.gz", header=0, index_col=None, compression='gzip', usecols=['subject_id', 'hadm_id', 'admittime', 'dischtime'], parse_dates=['admittime', 'dischtime'])
-    elif version_path=="mimiciv/2.0":
-        adm = pd.read_csv("./"+version_path+"/hosp/admissions.csv.gz", header=0, index_col=None, compression='gzip', usecols=['subject_id', 'hadm_id', 'admittime', 'dischtime'], parse_dates=['admittime', 'dischtime'])
+    # dtypes of the labevents columns come from the schema registry (table_schema.py)
+    adm_path = "./"+version_path+("/core/admissions.csv.gz" if version_path=="mimiciv/1.0" else "/hosp/admissions.csv.gz")
+    if sql_backend.use_sql(engine):
+        df_cohort=sql_backend.preproc_labs(dataset_path, adm_path, cohort_path)
+    else:
+        sink=ChunkSink()
+        cohort = pd.read_csv(cohort_path, compression='gzip', parse_dates = ['admittime','dischtime'])
+        adm = load_table(adm_path, columns=['subject_id', 'hadm_id', 'admittime', 'dischtime'], parse_dates=['admittime', 'dischtime'])
         
-    # read module w/ custom params
-    chunksize = 10000000
-    for chunk in tqdm(pd.read_csv(dataset_path, compression='gzip', usecols=usecols, dtype=dtypes, parse_dates=[time_col],chunksize=chunksize)):
-        #print(chunk.shape)
-        #chunk.dropna(subset=['hadm_id'],inplace=True,axis=1)
-        chunk=chunk.dropna(subset=['valuenum'])
-        chunk['valueuom']=chunk['valueuom'].fillna(0)
+        # read module w/ custom params
+        chunksize = 10000000
+        # missing hadm_ids are imputed by the same workers for every chunk
+        with ImputationPool(adm, impute_workers) as imputer:
+            for chunk in tqdm(prefetch(iter_table(dataset_path, chunksize, columns=usecols, filters=[('subject_id', 'in', cohort['subject_id'].unique())], dtype=dtypes, parse_dates=[time_col]))):
+                #print(chunk.shape)
+                #chunk.dropna(subset=['hadm_id'],inplace=True,axis=1)
+                chunk=chunk.dropna(subset=['valuenum'])
+                # labs without a unit get the unit '0', as in sql_backend.preproc_labs
+                if isinstance(chunk['valueuom'].dtype, pd.CategoricalDtype) and '0' not in chunk['valueuom'].cat.categories:
+                    chunk['valueuom']=chunk['valueuom'].cat.add_categories(['0'])
+                chunk['valueuom']=chunk['valueuom'].fillna('0')
         
-        chunk=chunk[chunk['subject_id'].isin(cohort['subject_id'].unique())]
-        #print(chunk['hadm_id'].isna().sum())
-        chunkna=chunk[chunk['hadm_id'].isna()]
-        chunk=chunk[chunk['hadm_id'].notnull()]
-        chunkna = impute_hadm_ids(chunkna[['subject_id','hadm_id','itemid','charttime','valuenum','valueuom']].copy(), adm)
-        del chunkna['hadm_id']
-        chunkna=chunkna.rename(columns={'hadm_id_new':'hadm_id'})
-        chunkna=chunkna[['subject_id','hadm_id','itemid','charttime','valuenum','valueuom']]
-        chunk=chunk.append(chunkna, ignore_index=True)
-        #print(chunk['hadm_id'].isna().sum())
+                chunk=chunk[chunk['subject_id'].isin(cohort['subject_id'].unique())]
+                #print(chunk['hadm_id'].isna().sum())
+                chunkna=chunk[chunk['hadm_id'].isna()]
+                chunk=chunk[chunk['hadm_id'].notnull()]
+                chunkna = impute_hadm_ids(chunkna[['subject_id','hadm_id','itemid','charttime','valuenum','valueuom']].copy(), adm, imputer)
+                del chunkna['hadm_id']
+                chunkna=chunkna.rename(columns={'hadm_id_new':'hadm_id'})
+                chunkna=chunkna[['subject_id','hadm_id','itemid','charttime','valuenum','valueuom']]
+                chunk=pd.concat([chunk, chunkna], ignore_index=True)
+                # drop_wrong_uom counts the units of an object column (value_counts of a categorical lists every category)
+                chunk['valueuom']=chunk['valueuom'].astype(object)
+                #print(chunk['hadm_id'].isna().sum())
          
-        chunk = chunk.merge(cohort[['hadm_id', 'admittime','dischtime']], how='inner', left_on='hadm_id', right_on='hadm_id')
-        #print(chunk.head())
-        chunk['charttime']=pd.to_datetime(chunk['charttime'])
-        chunk['lab_time_from_admit'] = chunk['charttime'] - chunk['admittime']
-        #chunk['valuenum']=chunk['valuenum'].fillna(0)
-        chunk=chunk.dropna()
+                chunk = chunk.merge(cohort[['hadm_id', 'admittime','dischtime']], how='inner', left_on='hadm_id', right_on='hadm_id')
+                #print(chunk.head())
+                chunk['charttime']=pd.to_datetime(chunk['charttime'])
+                chunk['lab_time_from_admit'] = chunk['charttime'] - chunk['admittime']
+                #chunk['valuenum']=chunk['valuenum'].fillna(0)
+                chunk=chunk.dropna()
+                chunk['lab_time_from_admit'] = offset_minutes(chunk['lab_time_from_admit'])
         
-        #print(chunk.shape)
-        #print(chunk.head())
-        if df_cohort.empty:
-            df_cohort=chunk
-        else:
-            df_cohort=df_cohort.append(chunk, ignore_index=True)
+                #print(chunk.shape)
+                #print(chunk.head())
+                sink.append(chunk)
+        df_cohort=sink.result()
     
     #labs = pd.read_csv(dataset_path, compression='gzip', usecols=usecols, dtype=dtypes, parse_dates=[time_col]).drop_duplicates()
     
@@ -361,11 +372,11 @@ def preproc_proc(dataset_path: str, cohort_path:str, time_col:str, anchor_col:st
     def merge_module_cohort() -> pd.DataFrame:
         """Gets the initial module data with patients anchor year data and only the year of the charttime"""
         
-        # read module w/ custom params
-        module = pd.read_csv(dataset_path, compression='gzip', usecols=usecols, dtype=dtypes, parse_dates=[time_col]).drop_duplicates()
-
         # Only consider values in our cohort
         cohort = pd.read_csv(cohort_path, compression='gzip', parse_dates = ['admittime'])
+
+        # read module w/ custom params
+        module = load_table(dataset_path, columns=usecols, filters=[('hadm_id', 'in', cohort['hadm_id'].unique())], dtype=dtypes, parse_dates=[time_col]).drop_duplicates()
         
         #print(module.head())
         #print(cohort.head())
@@ -376,6 +387,7 @@ def preproc_proc(dataset_path: str, cohort_path:str, time_col:str, anchor_col:st
     df_cohort = merge_module_cohort()
     df_cohort['proc_time_from_admit'] = df_cohort['chartdate'] - df_cohort['admittime']
     df_cohort=df_cohort.dropna()
+    df_cohort['proc_time_from_admit'] = offset_minutes(df_cohort['proc_time_from_admit'])
     # Print unique counts and value_counts
     print("# Unique ICD9 Procedures:  ", df_cohort.loc[df_cohort.icd_version == 9].icd_code.dropna().nunique())
     print("# Unique ICD10 Procedures: ",df_cohort.loc[df_cohort.icd_version == 10].icd_code.dropna().nunique())
@@ -391,44 +403,14 @@ def preproc_icd_module(module_path:str, adm_cohort_path:str, icd_map_path=None,
     """Takes an module dataset with ICD codes and puts it in long_format, optionally mapping ICD-codes by a mapping table path"""    
     
     def get_module_cohort(module_path:str, cohort_path:str):
-        module = pd.read_csv(module_path, compression='gzip', header=0)
         adm_cohort = pd.read_csv(adm_cohort_path, compression='gzip', header=0)
+        module = load_table(module_path, filters=[('hadm_id', 'in', adm_cohort['hadm_id'].unique())])
         #print(module.head())
         #print(adm_cohort.head())
         
         #adm_cohort = adm_cohort.loc[(adm_cohort.timedelta_years <= 6) & (~adm_cohort.timedelta_years.isna())]
         return module.merge(adm_cohort[['hadm_id', 'label']], how='inner', left_on='hadm_id', right_on='hadm_id')
 
-    def standardize_icd(mapping, df, root=False):
-        """Takes an ICD9 -> ICD10 mapping table and a modulenosis dataframe; adds column with converted ICD10 column"""
-        
-        def icd_9to10(icd):
-            # If root is true, only map an ICD 9 -> 10 according to the ICD9's root (first 3 digits)
-            if root:
-                icd = icd[:3]
-            try:
-                # Many ICD-9's do not have a 1-to-1 mapping; get first index of mapped codes
-                return mapping.loc[mapping[map_code_colname] == icd].icd10cm.iloc[0]
-            except:
-                #print("Error on code", icd)
-                return np.nan
-
-        # Create new column with original codes as default
-        col_name = 'icd10_convert'
-        if root: col_name = 'root_' + col_name
-        df[col_name] = df['icd_code'].values
-
-        # Group identical ICD9 codes, then convert all ICD9 codes within a group to ICD10
-        for code, group in tqdm(df.loc[df.icd_version == 9].groupby(by='icd_code')):
-            new_code = icd_9to10(code)
-            for idx in group.index.values:
-                # Modify values of original df at the indexes in the groups
-                df.at[idx, col_name] = new_code
-
-        if only_icd10:
-            # Column for just the roots of the converted ICD10 column
-            df['root'] = df[col_name].apply(lambda x: x[:3] if type(x) is str else np.nan)
-
     module = get_module_cohort(module_path, adm_cohort_path)
     #print(module.shape)
     #print(module['icd_code'].nunique())
@@ -437,7 +419,7 @@ def preproc_icd_module(module_path:str, adm_cohort_path:str, icd_map_path=None,
     if icd_map_path:
         icd_map = read_icd_mapping(icd_map_path)
         #print(icd_map)
-        standardize_icd(icd_map, module, root=True)
+        standardize_icd(icd_map, module, root=True, map_code_col=map_code_colname or 'diagnosis_code', add_root=only_icd10)
         print("# unique ICD-9 codes",module[module['icd_version']==9]['icd_code'].nunique())
         print("# unique ICD-10 codes",module[module['icd_version']==10]['icd_code'].nunique())
         print("# unique ICD-10 codes (After converting ICD-9 to ICD-10)",module['root_icd10_convert'].nunique())
@@ -446,31 +428,64 @@ def preproc_icd_module(module_path:str, adm_cohort_path:str, icd_map_path=None,
     return module
 
 
-def pivot_cohort(df: pd.DataFrame, prefix: str, target_col:str, values='values', use_mlb=False, ohe=True, max_features=None):
+def pivot_cohort(df: pd.DataFrame, prefix: str, target_col:str, values='values', use_mlb=False, ohe=True, max_features=None, as_sparse=False):
     """Pivots long_format data into a multiindex array:
                                             || feature 1 || ... || feature n ||
         || subject_id || label || timedelta ||
+    With as_sparse (one feature per row, without use_mlb) returns the scipy.sparse matrix of sparse_pivot.pivot_sparse,
+    the index frame of its rows and its column names instead.
     """
+    if as_sparse and not use_mlb:
+        matrix, index, columns = pivot_sparse(df, target_col, values=None if ohe else values, aggfunc='max' if ohe else 'mean', max_features=max_features)
+        return matrix, index, pd.Index(prefix + columns.astype(str).values)
     aggfunc = np.mean
     pivot_df = df.dropna(subset=[target_col])
 
     if use_mlb:
-        mlb = MultiLabelBinarizer()
-        output = mlb.fit_transform(pivot_df[target_col].apply(ast.literal_eval))
-        output = pd.DataFrame(output, columns=mlb.classes_)
+        # lists of labels (or their text, as read back from csv, parsed once per distinct text) are binarized into
+        # a sparse matrix; only the kept columns are made dense
+        labels = pivot_df[target_col].reset_index(drop=True)
+        if len(labels) and isinstance(labels.iloc[0], str):
+            distinct = labels.unique()
+            labels = labels.map(dict(zip(distinct, map(ast.literal_eval, distinct))))
+        pairs = labels.explode().dropna()
+        col, classes = pd.factorize(pairs, sort=True)
+        output = sparse.csr_matrix((np.ones(len(pairs), dtype=int), (pairs.index.values, col)), shape=(len(labels), len(classes)))
+        output.data[:] = 1    # a label repeated in a list counts once
+        keep = np.arange(len(classes))
         if max_features:
-            top_features = output.sum().sort_values(ascending=False).index[:max_features]
-            output = output[top_features]
+            keep = np.argsort(-output.sum(axis=0).A1, kind='stable')[:max_features]
+        output = pd.DataFrame(output[:, keep].toarray(), columns=classes[keep])
         pivot_df = pd.concat([pivot_df[['subject_id', 'label', 'timedelta']].reset_index(drop=True), output], axis=1)
         pivot_df = pd.pivot_table(pivot_df, index=['subject_id', 'label', 'timedelta'], values=pivot_df.columns[3:], aggfunc=np.max)
     else:
         if max_features:
-            top_features = pd.Series(pivot_df[['subject_id', target_col]].drop_duplicates()[target_col].value_counts().index[:max_features], name=target_col)
-            pivot_df = pivot_df.merge(top_features, how='inner', left_on=target_col, right_on=target_col)
+            pivot_df = pivot_df[pivot_df[target_col].isin(top_features(pivot_df, target_col, max_features))]
         if ohe:
             pivot_df = pd.concat([pivot_df.reset_index(drop=True), pd.Series(np.ones(pivot_df.shape[0], dtype=int), name='values')], axis=1)
             aggfunc = np.max
         pivot_df = pivot_df.pivot_table(index=['subject_id', 'label', 'timedelta'], columns=target_col, values=values, aggfunc=aggfunc)
 
     pivot_df.columns = [prefix + str(i) for i in pivot_df.columns]
-    return pivot_df
\ No newline at end of file
+    return pivot_df
+
+def epc_matrix(epc: pd.DataFrame, index_cols=['hadm_id'], bucket_hours=None):
+    """Multi-hot matrix of the pharmacologic classes of a med_epc table (the epc column coded, as in preproc_med_epc):
+    one row per distinct index_cols, one column per class.
+    With bucket_hours the rows are split by time bucket from admission (start_hours_from_admit, in minutes),
+    a (visit, bucket, class) tensor flattened to rows.
+    Returns the scipy.sparse csr_matrix, the index frame of its rows (bucket column added) and the class codes
+    of its columns (feature_dictionary.decode(..., 'epc') gives the class names)."""
+    keys = epc[index_cols].copy()
+    if bucket_hours:
+        keys['bucket'] = epc['start_hours_from_admit'] // (60 * bucket_hours)
+    keys = keys.dropna()
+    if bucket_hours:
+        keys['bucket'] = keys['bucket'].astype('int64')
+    by = list(keys.columns)
+    row = keys.groupby(by, sort=True).ngroup().values
+    index = keys.drop_duplicates().sort_values(by).reset_index(drop=True)
+    col, classes = pd.factorize(epc.loc[keys.index, 'epc'], sort=True)
+    matrix = sparse.csr_matrix((np.ones(len(row), dtype='int8'), (row, col)), shape=(len(index), len(classes)))
+    matrix.data[:] = 1    # a class given several times in a row counts once
+    return matrix, index, pd.Series(classes, name='epc')
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+from mapping_cache import cached_table
+
+# ICD-9 -> ICD-10 conversion shared by the cohort and feature extraction.
+# The mapping table (./utils/mappings/ICD9_to_ICD10_mapping.txt) is compiled into a lookup from an ICD-9 code
+# to the ICD-10 code of its first row (many ICD-9 codes do not have a 1-to-1 mapping), which is applied with
+# a hashed map over the distinct codes instead of scanning the table for every code.
+ICD_MAP_PATH = "./utils/mappings/ICD9_to_ICD10_mapping.txt"
+
+
+def _parse_icd_mapping(map_path: str) -> pd.DataFrame:
+    mapping = pd.read_csv(map_path, header=0, delimiter='\t')
+    mapping.diagnosis_description = mapping.diagnosis_description.apply(str.lower)
+    return mapping
+
+
+def read_icd_mapping(map_path: str) -> pd.DataFrame:
+    """Reads in mapping table for converting ICD9 to ICD10 codes, parsed once and cached next to it (mapping_cache.py)"""
+    return cached_table(map_path, 'icd_mapping', _parse_icd_mapping)
+
+
+def compile_icd_mapping(mapping: pd.DataFrame, map_code_col='diagnosis_code') -> pd.Series:
+    """ICD-10 code of each ICD-9 code of map_code_col, the first row of the mapping table for a code"""
+    first = mapping.drop_duplicates(subset=[map_code_col], keep='first')
+    return pd.Series(first['icd10cm'].values, index=first[map_code_col].values)
+
+
+def icd_root(codes: pd.Series) -> pd.Series:
+    """First 3 characters of the codes, NaN where the code is not a string"""
+    return codes.astype(object).str[:3]
+
+
+def icd9_to_icd10(codes: pd.Series, mapping, root=True, map_code_col='diagnosis_code') -> pd.Series:
+    """ICD-10 codes of ICD-9 codes, NaN for the codes the mapping does not hold.
+    root: look up the root of the ICD-9 codes (first 3 characters) instead of the full code
+    mapping: the mapping table (read_icd_mapping) or its compiled lookup (compile_icd_mapping)"""
+    if isinstance(mapping, pd.DataFrame):
+        mapping = compile_icd_mapping(mapping, map_code_col)
+    # each distinct code is looked up once
+    distinct = pd.Series(codes.dropna().unique())
+    keys = icd_root(distinct) if root else distinct
+    converted = pd.Series(keys.map(mapping).values, index=distinct.values)
+    return codes.map(converted)
+
+
+def standardize_icd(mapping, df: pd.DataFrame, root=False, map_code_col='diagnosis_code', add_root=False):
+    """Takes an ICD9 -> ICD10 mapping table and a diagnosis dataframe; adds column with converted ICD10 column
+    (root_icd10_convert when the ICD-9 roots are mapped, icd10_convert otherwise), ICD-10 codes are kept as they are.
+    add_root: also add the column root, the roots of the converted ICD-10 codes"""
+    col_name = 'icd10_convert'
+    if root: col_name = 'root_' + col_name
+    icd9 = (df['icd_version'] == 9).values
+    converted = df['icd_code'].astype(object).copy()
+    if icd9.any():
+        converted[icd9] = icd9_to_icd10(df.loc[icd9, 'icd_code'], mapping, root, map_code_col).values
+    df[col_name] = converted.values
+    if add_root:
+        # Column for just the roots of the converted ICD10 column
+        df['root'] = icd_root(df[col_name]).values
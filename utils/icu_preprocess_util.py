@@ -4,10 +4,26 @@ import pandas as pd
 import sys, os
 import re
 import ast
+import importlib
 import datetime as dt
 from tqdm import tqdm
-
-from sklearn.preprocessing import MultiLabelBinarizer
+import table_loader
+from table_loader import *
+import chunk_sink
+from chunk_sink import *
+import sql_backend
+from feature_store import offset_minutes
+from icd_mapping import read_icd_mapping, standardize_icd
+importlib.reload(table_loader)
+import table_loader
+from table_loader import *
+importlib.reload(chunk_sink)
+import chunk_sink
+from chunk_sink import *
+importlib.reload(sql_backend)
+import sql_backend
+from scipy import sparse
+from sparse_pivot import pivot_sparse, top_features
 
 ########################## GENERAL ##########################
 def dataframe_from_csv(path, compression='gzip', header=0, index_col=0, chunksize=None):
@@ -52,31 +68,6 @@ def read_diagnoses(mimic4_path):
     )
 
 
-def standardize_icd(mapping, df, root=False):
-    """Takes an ICD9 -> ICD10 mapping table and a diagnosis dataframe; adds column with converted ICD10 column"""
-
-    def icd_9to10(icd):
-        # If root is true, only map an ICD 9 -> 10 according to the ICD9's root (first 3 digits)
-        if root:
-            icd = icd[:3]
-        try:
-            # Many ICD-9's do not have a 1-to-1 mapping; get first index of mapped codes
-            return mapping.loc[mapping.diagnosis_code == icd].icd10cm.iloc[0]
-        except:
-            print("Error on code", icd)
-            return np.nan
-
-    # Create new column with original codes as default
-    col_name = 'icd10_convert'
-    if root: col_name = 'root_' + col_name
-    df[col_name] = df['icd_code'].values
-
-    # Group identical ICD9 codes, then convert all ICD9 codes within a group to ICD10
-    for code, group in df.loc[df.icd_version == 9].groupby(by='icd_code'):
-        new_code = icd_9to10(code)
-        for idx in group.index.values:
-            # Modify values of original df at the indexes in the groups
-            df.at[idx, col_name] = new_code
 
 
 ########################## PROCEDURES ##########################
@@ -98,25 +89,23 @@ def read_procedures(mimic4_path):
     )
 
 
-########################## MAPPING ##########################
-def read_icd_mapping(map_path):
-    mapping = pd.read_csv(map_path, header=0, delimiter='\t')
-    mapping.diagnosis_description = mapping.diagnosis_description.apply(str.lower)
-    return mapping
-
-
 ########################## PREPROCESSING ##########################
 
-def preproc_meds(module_path:str, adm_cohort_path:str) -> pd.DataFrame:
+def preproc_meds(module_path:str, adm_cohort_path:str, engine='pandas') -> pd.DataFrame:
   
-    adm = pd.read_csv(adm_cohort_path, usecols=['hadm_id', 'stay_id', 'intime'], parse_dates = ['intime'])
-    med = pd.read_csv(module_path, compression='gzip', usecols=['subject_id', 'stay_id', 'itemid', 'starttime', 'endtime','rate','amount','orderid'], parse_dates = ['starttime', 'endtime'])
-    med = med.merge(adm, left_on = 'stay_id', right_on = 'stay_id', how = 'inner')
-    med['start_hours_from_admit'] = med['starttime'] - med['intime']
-    med['stop_hours_from_admit'] = med['endtime'] - med['intime']
-    
-    #print(med.isna().sum())
-    med=med.dropna()
+    if sql_backend.use_sql(engine):
+        med = sql_backend.preproc_meds_icu(module_path, adm_cohort_path)
+    else:
+        adm = pd.read_csv(adm_cohort_path, usecols=['hadm_id', 'stay_id', 'intime'], parse_dates = ['intime'])
+        med = load_table(module_path, columns=['subject_id', 'stay_id', 'itemid', 'starttime', 'endtime','rate','amount','orderid'], filters=[('stay_id', 'in', adm['stay_id'].unique())], parse_dates = ['starttime', 'endtime'])
+        med = med.merge(adm, left_on = 'stay_id', right_on = 'stay_id', how = 'inner')
+        med['start_hours_from_admit'] = med['starttime'] - med['intime']
+        med['stop_hours_from_admit'] = med['endtime'] - med['intime']
+        
+        #print(med.isna().sum())
+        med=med.dropna()
+        med['start_hours_from_admit'] = offset_minutes(med['start_hours_from_admit'])
+        med['stop_hours_from_admit'] = offset_minutes(med['stop_hours_from_admit'])
     #med[['amount','rate']]=med[['amount','rate']].fillna(0)
     print("# of unique type of drug: ", med.itemid.nunique())
     print("# Admissions:  ", med.stay_id.nunique())
@@ -130,11 +119,11 @@ def preproc_proc(dataset_path: str, cohort_path:str, time_col:str, dtypes: dict,
     def merge_module_cohort() -> pd.DataFrame:
         """Gets the initial module data with patients anchor year data and only the year of the charttime"""
         
-        # read module w/ custom params
-        module = pd.read_csv(dataset_path, compression='gzip', usecols=usecols, dtype=dtypes, parse_dates=[time_col]).drop_duplicates()
-        #print(module.head())
         # Only consider values in our cohort
         cohort = pd.read_csv(cohort_path, compression='gzip', parse_dates = ['intime'])
+        # read module w/ custom params
+        module = load_table(dataset_path, columns=usecols, filters=[('stay_id', 'in', cohort['stay_id'].unique())], dtype=dtypes, parse_dates=[time_col]).drop_duplicates()
+        #print(module.head())
         
         #print(module.head())
         #print(cohort.head())
@@ -146,6 +135,7 @@ def preproc_proc(dataset_path: str, cohort_path:str, time_col:str, dtypes: dict,
     df_cohort['event_time_from_admit'] = df_cohort[time_col] - df_cohort['intime']
     
     df_cohort=df_cohort.dropna()
+    df_cohort['event_time_from_admit'] = offset_minutes(df_cohort['event_time_from_admit'])
     # Print unique counts and value_counts
     print("# Unique Events:  ", df_cohort.itemid.dropna().nunique())
     print("# Admissions:  ", df_cohort.stay_id.nunique())
@@ -160,11 +150,11 @@ def preproc_out(dataset_path: str, cohort_path:str, time_col:str, dtypes: dict,
     def merge_module_cohort() -> pd.DataFrame:
         """Gets the initial module data with patients anchor year data and only the year of the charttime"""
         
-        # read module w/ custom params
-        module = pd.read_csv(dataset_path, compression='gzip', usecols=usecols, dtype=dtypes, parse_dates=[time_col]).drop_duplicates()
-        #print(module.head())
         # Only consider values in our cohort
         cohort = pd.read_csv(cohort_path, compression='gzip', parse_dates = ['intime'])
+        # read module w/ custom params
+        module = load_table(dataset_path, columns=usecols, filters=[('stay_id', 'in', cohort['stay_id'].unique())], dtype=dtypes, parse_dates=[time_col]).drop_duplicates()
+        #print(module.head())
         
         #print(module.head())
         #print(cohort.head())
@@ -175,6 +165,7 @@ def preproc_out(dataset_path: str, cohort_path:str, time_col:str, dtypes: dict,
     df_cohort = merge_module_cohort()
     df_cohort['event_time_from_admit'] = df_cohort[time_col] - df_cohort['intime']
     df_cohort=df_cohort.dropna()
+    df_cohort['event_time_from_admit'] = offset_minutes(df_cohort['event_time_from_admit'])
     # Print unique counts and value_counts
     print("# Unique Events:  ", df_cohort.itemid.nunique())
     print("# Admissions:  ", df_cohort.stay_id.nunique())
@@ -183,46 +174,29 @@ def preproc_out(dataset_path: str, cohort_path:str, time_col:str, dtypes: dict,
     # Only return module measurements within the observation range, sorted by subject_id
     return df_cohort
 
-def preproc_chart(dataset_path: str, cohort_path:str, time_col:str, dtypes: dict, usecols: list) -> pd.DataFrame:
+def preproc_chart(dataset_path: str, cohort_path:str, time_col:str, dtypes: dict, usecols: list, engine='pandas') -> pd.DataFrame:
     """Function for getting hosp observations pertaining to a pickled cohort. Function is structured to save memory when reading and transforming data."""
     
-    # Only consider values in our cohort
-    cohort = pd.read_csv(cohort_path, compression='gzip', parse_dates = ['intime'])
-    df_cohort=pd.DataFrame()
+    if sql_backend.use_sql(engine):
+        df_cohort=sql_backend.preproc_chart(dataset_path, cohort_path, time_col, usecols)
+    else:
+        # Only consider values in our cohort
+        cohort = pd.read_csv(cohort_path, compression='gzip', parse_dates = ['intime'])
+        sink=ChunkSink()
         # read module w/ custom params
-    chunksize = 10000000
-    count=0
-    nitem=[]
-    nstay=[]
-    nrows=0
-    for chunk in tqdm(pd.read_csv(dataset_path, compression='gzip', usecols=usecols, dtype=dtypes, parse_dates=[time_col],chunksize=chunksize)):
-        #print(chunk.head())
-        count=count+1
-        #chunk['valuenum']=chunk['valuenum'].fillna(0)
-        chunk=chunk.dropna(subset=['valuenum'])
-        chunk_merged=chunk.merge(cohort[['stay_id', 'intime']], how='inner', left_on='stay_id', right_on='stay_id')
-        chunk_merged['event_time_from_admit'] = chunk_merged[time_col] - chunk_merged['intime']
-        
-        del chunk_merged[time_col] 
-        del chunk_merged['intime']
-        chunk_merged=chunk_merged.dropna()
-        chunk_merged=chunk_merged.drop_duplicates()
-        if df_cohort.empty:
-            df_cohort=chunk_merged
-        else:
-            df_cohort=df_cohort.append(chunk_merged, ignore_index=True)
+        chunksize = 10000000
+        for chunk in tqdm(prefetch(iter_table(dataset_path, chunksize, columns=usecols, filters=[('stay_id', 'in', cohort['stay_id'].unique())], dtype=dtypes, parse_dates=[time_col]))):
+            chunk=chunk.dropna(subset=['valuenum'])
+            chunk_merged=chunk.merge(cohort[['stay_id', 'intime']], how='inner', left_on='stay_id', right_on='stay_id')
+            chunk_merged['event_time_from_admit'] = chunk_merged[time_col] - chunk_merged['intime']
         
-        
-#         nitem.append(chunk_merged.itemid.dropna().unique())
-#         nstay=nstay.append(chunk_merged.stay_id.unique())
-#         nrows=nrows+chunk_merged.shape[0]
-                
-        
-    
-    # Print unique counts and value_counts
-#     print("# Unique Events:  ", len(set(nitem)))
-#     print("# Admissions:  ", len(set(nstay)))
-#     print("Total rows", nrows)
+            del chunk_merged[time_col] 
+            del chunk_merged['intime']
+            chunk_merged=chunk_merged.dropna()
+            chunk_merged=chunk_merged.drop_duplicates()
+            chunk_merged['event_time_from_admit'] = offset_minutes(chunk_merged['event_time_from_admit'])
+            sink.append(chunk_merged)
+        df_cohort=sink.result()
     print("# Unique Events:  ", df_cohort.itemid.nunique())
     print("# Admissions:  ", df_cohort.stay_id.nunique())
     print("Total rows", df_cohort.shape[0])
@@ -234,44 +208,14 @@ def preproc_icd_module(module_path:str, adm_cohort_path:str, icd_map_path=None,
     """Takes an module dataset with ICD codes and puts it in long_format, optionally mapping ICD-codes by a mapping table path"""    
     
     def get_module_cohort(module_path:str, cohort_path:str):
-        module = pd.read_csv(module_path, compression='gzip', header=0)
         adm_cohort = pd.read_csv(adm_cohort_path, compression='gzip', header=0)
+        module = load_table(module_path, filters=[('hadm_id', 'in', adm_cohort['hadm_id'].unique())])
         #print(module.head())
         #print(adm_cohort.head())
         
         #adm_cohort = adm_cohort.loc[(adm_cohort.timedelta_years <= 6) & (~adm_cohort.timedelta_years.isna())]
         return module.merge(adm_cohort[['hadm_id', 'stay_id', 'label']], how='inner', left_on='hadm_id', right_on='hadm_id')
 
-    def standardize_icd(mapping, df, root=False):
-        """Takes an ICD9 -> ICD10 mapping table and a modulenosis dataframe; adds column with converted ICD10 column"""
-        
-        def icd_9to10(icd):
-            # If root is true, only map an ICD 9 -> 10 according to the ICD9's root (first 3 digits)
-            if root:
-                icd = icd[:3]
-            try:
-                # Many ICD-9's do not have a 1-to-1 mapping; get first index of mapped codes
-                return mapping.loc[mapping[map_code_colname] == icd].icd10cm.iloc[0]
-            except:
-                #print("Error on code", icd)
-                return np.nan
-
-        # Create new column with original codes as default
-        col_name = 'icd10_convert'
-        if root: col_name = 'root_' + col_name
-        df[col_name] = df['icd_code'].values
-
-        # Group identical ICD9 codes, then convert all ICD9 codes within a group to ICD10
-        for code, group in df.loc[df.icd_version == 9].groupby(by='icd_code'):
-            new_code = icd_9to10(code)
-            for idx in group.index.values:
-                # Modify values of original df at the indexes in the groups
-                df.at[idx, col_name] = new_code
-
-        if only_icd10:
-            # Column for just the roots of the converted ICD10 column
-            df['root'] = df[col_name].apply(lambda x: x[:3] if type(x) is str else np.nan)
-
     module = get_module_cohort(module_path, adm_cohort_path)
     #print(module.shape)
     #print(module['icd_code'].nunique())
@@ -280,7 +224,7 @@ def preproc_icd_module(module_path:str, adm_cohort_path:str, icd_map_path=None,
     if icd_map_path:
         icd_map = read_icd_mapping(icd_map_path)
         #print(icd_map)
-        standardize_icd(icd_map, module, root=True)
+        standardize_icd(icd_map, module, root=True, map_code_col=map_code_colname or 'diagnosis_code', add_root=only_icd10)
         print("# unique ICD-9 codes",module[module['icd_version']==9]['icd_code'].nunique())
         print("# unique ICD-10 codes",module[module['icd_version']==10]['icd_code'].nunique())
         print("# unique ICD-10 codes (After converting ICD-9 to ICD-10)",module['root_icd10_convert'].nunique())
@@ -290,27 +234,39 @@ def preproc_icd_module(module_path:str, adm_cohort_path:str, icd_map_path=None,
     return module
 
 
-def pivot_cohort(df: pd.DataFrame, prefix: str, target_col:str, values='values', use_mlb=False, ohe=True, max_features=None):
+def pivot_cohort(df: pd.DataFrame, prefix: str, target_col:str, values='values', use_mlb=False, ohe=True, max_features=None, as_sparse=False):
     """Pivots long_format data into a multiindex array:
                                             || feature 1 || ... || feature n ||
         || subject_id || label || timedelta ||
+    With as_sparse (one feature per row, without use_mlb) returns the scipy.sparse matrix of sparse_pivot.pivot_sparse,
+    the index frame of its rows and its column names instead.
     """
+    if as_sparse and not use_mlb:
+        matrix, index, columns = pivot_sparse(df, target_col, values=None if ohe else values, aggfunc='max' if ohe else 'mean', max_features=max_features)
+        return matrix, index, pd.Index(prefix + columns.astype(str).values)
     aggfunc = np.mean
     pivot_df = df.dropna(subset=[target_col])
 
     if use_mlb:
-        mlb = MultiLabelBinarizer()
-        output = mlb.fit_transform(pivot_df[target_col].apply(ast.literal_eval))
-        output = pd.DataFrame(output, columns=mlb.classes_)
+        # lists of labels (or their text, as read back from csv, parsed once per distinct text) are binarized into
+        # a sparse matrix; only the kept columns are made dense
+        labels = pivot_df[target_col].reset_index(drop=True)
+        if len(labels) and isinstance(labels.iloc[0], str):
+            distinct = labels.unique()
+            labels = labels.map(dict(zip(distinct, map(ast.literal_eval, distinct))))
+        pairs = labels.explode().dropna()
+        col, classes = pd.factorize(pairs, sort=True)
+        output = sparse.csr_matrix((np.ones(len(pairs), dtype=int), (pairs.index.values, col)), shape=(len(labels), len(classes)))
+        output.data[:] = 1    # a label repeated in a list counts once
+        keep = np.arange(len(classes))
         if max_features:
-            top_features = output.sum().sort_values(ascending=False).index[:max_features]
-            output = output[top_features]
+            keep = np.argsort(-output.sum(axis=0).A1, kind='stable')[:max_features]
+        output = pd.DataFrame(output[:, keep].toarray(), columns=classes[keep])
         pivot_df = pd.concat([pivot_df[['subject_id', 'label', 'timedelta']].reset_index(drop=True), output], axis=1)
         pivot_df = pd.pivot_table(pivot_df, index=['subject_id', 'label', 'timedelta'], values=pivot_df.columns[3:], aggfunc=np.max)
     else:
         if max_features:
-            top_features = pd.Series(pivot_df[['subject_id', target_col]].drop_duplicates()[target_col].value_counts().index[:max_features], name=target_col)
-            pivot_df = pivot_df.merge(top_features, how='inner', left_on=target_col, right_on=target_col)
+            pivot_df = pivot_df[pivot_df[target_col].isin(top_features(pivot_df, target_col, max_features))]
         if ohe:
             pivot_df = pd.concat([pivot_df.reset_index(drop=True), pd.Series(np.ones(pivot_df.shape[0], dtype=int), name='values')], axis=1)
             aggfunc = np.max
@@ -1,133 +1,175 @@
 import os
-from glob import glob
-from uuid import uuid1
-from functools import partial
-from multiprocessing import Pool
-from collections import defaultdict
-from typing import Union, List, Tuple
+from typing import Union
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+from parallel_extract import process_context
 if not os.path.exists("./data/temp"):
     os.makedirs("./data/temp")
 
-def hadm_imputer(
-    charttime: pd._libs.tslibs.timestamps.Timestamp,
-    hadm_old: Union[str, float],
-    hadm_ids_w_timestamps: List[
-        Tuple[
-            str,
-            pd._libs.tslibs.timestamps.Timestamp,
-            pd._libs.tslibs.timestamps.Timestamp,
-        ]
-    ],
-) -> Tuple[str, pd._libs.tslibs.timestamps.Timestamp]:
-    # if old hadm exists use that
-    if not np.isnan(hadm_old):
-        #print("old")
-        hadm_old = int(hadm_old)
-        admtime, dischtime = [
-            [adm_time, disch_time]
-            for h_id, adm_time, disch_time in hadm_ids_w_timestamps
-            if h_id == hadm_old
-        ][0]
-        #print("got old")
-        return (
-            hadm_old,
-            admtime.strftime("%Y-%m-%d %H:%M:%S"),
-            dischtime.strftime("%Y-%m-%d %H:%M:%S"),
-        )
-    # get the difference between this lab event charttime and all admit times for this subject_id
-    hadm_ids_w_timestamps = [
-        [
-            hadm_id,
-            admittime.strftime("%Y-%m-%d %H:%M:%S"),
-            dischtime.strftime("%Y-%m-%d %H:%M:%S"),
-            charttime.normalize() - admittime.normalize(),
-            charttime.normalize() - dischtime.normalize(),
-        ]
-        for hadm_id, admittime, dischtime in hadm_ids_w_timestamps
-    ]
-    # the lab charttime must be in between admit time and discharge time
-    hadm_ids_w_timestamps = [
-        x for x in hadm_ids_w_timestamps if x[3].days >= 0 and x[4].days <= 0
-    ]
-    # there should be exactly one hadm_id that satisfies this criteria
-    # if multiple, select the hadm id with admittime closest to the lab event charttime
-    hadm_ids_w_timestamps = sorted(hadm_ids_w_timestamps, key=lambda x: x[3])
-    if not hadm_ids_w_timestamps:
-        return None, None, None
-    return_data = hadm_ids_w_timestamps[0][:3]
-    return return_data
-
-
-def impute_missing_hadm_ids(
-    lab_table: pd.DataFrame, subject_hadm_admittime_tracker: defaultdict
-) -> pd.DataFrame:
-    list_rows_lab = []
-    all_lab_cols = lab_table.columns
-    for row in lab_table.itertuples():
-        existing_data = {
-            col_name: row.__getattribute__(col_name) for col_name in all_lab_cols
-        }
-        new_hadm_id, new_admittime, new_dischtime = hadm_imputer(
-            row.charttime,
-            row.hadm_id,
-            subject_hadm_admittime_tracker.get(
-                row.subject_id, []
-            ),  # using get as defaultdict will create key if does not exist
-        )
-        existing_data["hadm_id_new"] = new_hadm_id
-        existing_data["admittime"] = new_admittime
-        existing_data["dischtime"] = new_dischtime
-        list_rows_lab.append(existing_data)
-    tab_name = str(uuid1())
-    pd.DataFrame(list_rows_lab).to_csv(f"{tab_name}.csv")
+# A lab event without hadm_id is given the admission of the subject whose admit and discharge dates contain the
+# date of its charttime; if several do, the one with the closest admittime (then the first of the admissions table).
+# This is an interval join: the admissions are sorted by subject and admit date, and a searchsorted finds the last
+# admission of the subject admitted on or before the charttime date, which holds the event if it is discharged on
+# or after that date. Only the events of subjects with overlapping admissions (a running max of the discharge dates
+# past the charttime date) need the other admissions of the subject to be checked.
+#
+# ImputationPool runs the lookups of a whole labs extraction in worker processes started once, with the admission
+# arrays in shared memory: a call only sends the subject_ids and charttimes of the events and gets hadm_ids back.
+ADMISSION_ARRAYS = ['key', 'hadm_id', 'disch_day', 'max_disch_day']
+# events of a call below which the workers are not used
+PARALLEL_ROWS = 100000
+
+# admission arrays of a worker process, views of the shared memory of its ImputationPool
+_SHARED = None
+_ADMISSIONS = None
+
+
+def _days(times) -> np.ndarray:
+    """Days since 1970-01-01 of the dates of times"""
+    return np.asarray(times, dtype='datetime64[ns]').astype('datetime64[D]').astype('int64')
+
+
+def _keys(subject_ids, days) -> np.ndarray:
+    # subject_id in the high 32 bits and the day in the low ones, sorted keys order by subject then day
+    return (np.asarray(subject_ids).astype('int64') << 32) + (days + 2**31)
+
+
+def admission_intervals(admission_table: pd.DataFrame) -> dict:
+    """Arrays of the admissions sorted by subject_id and admit date for impute_missing_hadm_ids: key (subject_id
+    and admit date), hadm_id, disch_day and max_disch_day, the latest discharge date of the subject's admissions up
+    to each one"""
+    adm = admission_table[['subject_id', 'hadm_id', 'admittime', 'dischtime']].dropna(subset=['admittime', 'dischtime'])
+    adm = pd.DataFrame({'subject_id': adm['subject_id'].values.astype('int64'), 'hadm_id': adm['hadm_id'].values.astype('float64'),
+                        'adm_day': _days(adm['admittime']), 'disch_day': _days(adm['dischtime']), 'order': np.arange(len(adm))})
+    # among the admissions of a day the first of the table wins, it is put last as the lookup takes the last one
+    adm = adm.sort_values(['subject_id', 'adm_day', 'order'], ascending=[True, True, False], kind='mergesort')
+    arrays = {'key': _keys(adm['subject_id'].values, adm['adm_day'].values), 'hadm_id': adm['hadm_id'].values,
+              'disch_day': adm['disch_day'].values, 'max_disch_day': adm.groupby('subject_id')['disch_day'].cummax().values}
+    return {name: np.ascontiguousarray(values) for name, values in arrays.items()}
+
+
+def impute_missing_hadm_ids(subject_ids, charttimes, adm: dict) -> np.ndarray:
+    """hadm_ids (float, NaN if no admission holds the event) of lab events of the subjects at charttimes,
+    adm from admission_intervals"""
+    hadm_ids = np.full(len(subject_ids), np.nan)
+    times = np.asarray(charttimes, dtype='datetime64[ns]')
+    known = np.flatnonzero(~np.isnat(times))
+    days = _days(times[known])
+    keys = _keys(np.asarray(subject_ids)[known], days)
+    # last admission of the subject admitted on or before the charttime date
+    pos = np.searchsorted(adm['key'], keys, side='right') - 1
+    found = pos >= 0
+    found[found] = (adm['key'][pos[found]] >> 32) == (keys[found] >> 32)
+    known, days, keys, pos = known[found], days[found], keys[found], pos[found]
+    inside = adm['disch_day'][pos] >= days
+    hadm_ids[known[inside]] = adm['hadm_id'][pos[inside]]
+
+    # an earlier admission (or one of the same day) still open on the charttime date: the last of the subject's
+    # admissions up to pos that holds the event
+    overlap = ~inside & (adm['max_disch_day'][pos] >= days)
+    if overlap.any():
+        first = np.searchsorted(adm['key'], (keys[overlap] >> 32) << 32)
+        lengths = pos[overlap] - first + 1
+        events = np.repeat(np.arange(len(first)), lengths)
+        candidates = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - first, lengths)
+        holds = adm['disch_day'][candidates] >= days[overlap][events]
+        best = np.full(len(first), -1)
+        np.maximum.at(best, events[holds], candidates[holds])
+        hadm_ids[known[overlap]] = adm['hadm_id'][best]
+    return hadm_ids
+
+
+def _shared_arrays(buf, n: int) -> dict:
+    return {name: np.ndarray(n, dtype='float64' if name == 'hadm_id' else 'int64', buffer=buf, offset=8 * n * i)
+            for i, name in enumerate(ADMISSION_ARRAYS)}
+
+
+def _attach(name: str, n: int):
+    global _SHARED, _ADMISSIONS
+    _SHARED = shared_memory.SharedMemory(name=name)
+    _ADMISSIONS = _shared_arrays(_SHARED.buf, n)
+
+
+def _impute_part(subject_ids: np.ndarray, charttimes: np.ndarray) -> np.ndarray:
+    return impute_missing_hadm_ids(subject_ids, charttimes, _ADMISSIONS)
+
+
+class ImputationPool():
+    """Worker processes imputing the missing hadm_ids of lab events (impute_missing_hadm_ids) for a whole labs
+    extraction. The admission arrays are built once and copied to shared memory, which the workers attach to
+    when they start. With workers <= 1 (or small calls) the events are imputed in this process.
+
+    with ImputationPool(admissions, workers=8) as pool:
+        for chunk in chunks:
+            chunk = impute_hadm_ids(chunk, admissions, pool)"""
+
+    def __init__(self, admission_table: pd.DataFrame, workers=1):
+        self.workers = workers
+        self.adm = admission_intervals(admission_table)
+        self.shared, self.executor = None, None
+        if workers > 1:
+            n = len(self.adm['key'])
+            self.shared = shared_memory.SharedMemory(create=True, size=max(8 * n * len(ADMISSION_ARRAYS), 1))
+            views = _shared_arrays(self.shared.buf, n)
+            for name in ADMISSION_ARRAYS:
+                views[name][:] = self.adm[name]
+            del views
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=process_context(),
+                                                initializer=_attach, initargs=(self.shared.name, n))
+
+    def impute(self, subject_ids, charttimes) -> np.ndarray:
+        """hadm_ids of lab events of the subjects at charttimes, as impute_missing_hadm_ids"""
+        times = np.asarray(charttimes, dtype='datetime64[ns]')
+        if self.executor is None or len(times) < PARALLEL_ROWS:
+            return impute_missing_hadm_ids(subject_ids, times, self.adm)
+        parts = np.array_split(np.arange(len(times)), self.workers)
+        futures = [self.executor.submit(_impute_part, np.asarray(subject_ids)[part], times[part]) for part in parts]
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.shared is not None:
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def impute_hadm_ids(
-    lab_table: Union[str, pd.DataFrame], admission_table: Union[str, pd.DataFrame]
+    lab_table: Union[str, pd.DataFrame], admission_table: Union[str, pd.DataFrame], pool=None
 ) -> pd.DataFrame:
+    """Lab events with the column hadm_id_new, their hadm_id or the imputed one where it is missing
+    (NaN if no admission holds the event), and the admittime and dischtime of that admission.
+    pool: ImputationPool of the admission_table, reused across calls"""
     if isinstance(lab_table, str):
         lab_table = pd.read_csv(lab_table)
     if isinstance(admission_table, str):
         admission_table = pd.read_csv(admission_table)
+    lab_table = lab_table.reset_index(drop=True)
     lab_table["charttime"] = pd.to_datetime(lab_table.charttime)
-    admission_table["admittime"] = pd.to_datetime(admission_table.admittime)
-    admission_table["dischtime"] = pd.to_datetime(admission_table.dischtime)
-    # get a dictionary like this->
-    """ {
-        "sub_id_1": [["hadm_1", "admittime1", "dischtime1"], ["hadm_2", "admittime2", "dischtime2"]],
-        "sub_id_2": [["hadm_1", "admittime1", "dischtime1"], ["hadm_2", "admittime2", "dischtime2"]],
-        ...
-    """
-    subject_hadm_admittime_tracker = defaultdict(list)
-    for row in admission_table.itertuples():
-        subject_hadm_admittime_tracker[row.subject_id].append(
-            [row.hadm_id, row.admittime, row.dischtime]
-        )
-    lab_size = lab_table.shape[0]
-    chunks = 100
-    tab_size = lab_size // chunks
-    lab_table_chunks = []
-    for i in range(chunks):
-        st, en = i * tab_size, (i + 1) * tab_size
-        lab_table_chunks.append(lab_table[st:en])
-    if lab_size - chunks * tab_size > 0:
-        lab_table_chunks.append(lab_table[chunks * tab_size :])
-    # we dont need the original lab table as it is chunkified, hope is to save memory as lab table is huge
-    del lab_table
-    impute_missing_hadm_ids_w_lookup = partial(
-        impute_missing_hadm_ids,
-        subject_hadm_admittime_tracker=subject_hadm_admittime_tracker,
-    )
-    #print(impute_missing_hadm_ids_w_lookup)
-    #print(len(lab_table_chunks))
-    with Pool(8) as p:
-        p.map(impute_missing_hadm_ids_w_lookup, lab_table_chunks)
-    all_csvs = glob("*.csv")
-    lab_tab = pd.DataFrame()
-    for csv in all_csvs:
-        lab_tab = pd.concat([lab_tab, pd.read_csv(csv)])
-        os.remove(csv)
-    return lab_tab
+    admission_table = admission_table.assign(admittime=pd.to_datetime(admission_table.admittime),
+                                             dischtime=pd.to_datetime(admission_table.dischtime))
 
+    hadm_ids = lab_table['hadm_id'].values.astype('float64')
+    missing = np.flatnonzero(np.isnan(hadm_ids))
+    if len(missing):
+        subject_ids, charttimes = lab_table['subject_id'].values[missing], lab_table['charttime'].values[missing]
+        if pool is None:
+            hadm_ids[missing] = impute_missing_hadm_ids(subject_ids, charttimes, admission_intervals(admission_table))
+        else:
+            hadm_ids[missing] = pool.impute(subject_ids, charttimes)
+    lab_table['hadm_id_new'] = hadm_ids
+    times = admission_table.drop_duplicates('hadm_id').set_index('hadm_id')
+    times.index = times.index.astype('float64')
+    lab_table['admittime'] = lab_table['hadm_id_new'].map(times['admittime'])
+    lab_table['dischtime'] = lab_table['hadm_id_new'].map(times['dischtime'])
+    return lab_table
@@ -0,0 +1,45 @@
+import os
+import glob
+import hashlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# Parsed mapping tables (ICD9_to_ICD10_mapping.txt, ndc_product.txt) are cached as uncompressed Arrow IPC files
+# next to their source, <source>.<name>_<key>.arrow, and read memory-mapped instead of parsing and normalizing the
+# text file again. The key comes from the size and modification time of the source: an edited mapping file gets
+# a new cache file (the stale ones are removed when it is written).
+
+
+def cache_path(source: str, name: str) -> str:
+    stat = os.stat(source)
+    key = hashlib.md5(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:12]
+    return f"{source}.{name}_{key}.arrow"
+
+
+def _read(path: str) -> pd.DataFrame:
+    df = feather.read_table(path, memory_map=True).to_pandas()
+    # Arrow nulls come back as None in text columns, the parsed tables hold NaN
+    for col in df.columns[df.dtypes == object]:
+        if df[col].isna().any():
+            df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+
+def cached_table(source: str, name: str, parse) -> pd.DataFrame:
+    """parse(source), the parsed mapping table, read from its cache unless the source changed since it was written.
+    name identifies the parser: the same source can be cached in several parsed forms."""
+    path = cache_path(source, name)
+    if os.path.exists(path):
+        return _read(path)
+    df = parse(source)
+    try:
+        for stale in glob.glob(glob.escape(source) + '.' + name + '_*.arrow'):
+            os.remove(stale)
+        feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), path + '.tmp', compression='uncompressed')
+        os.replace(path + '.tmp', path)
+    except (OSError, pa.ArrowException):
+        # read-only mapping folder or columns Arrow cannot store: the table is parsed on every run as before
+        pass
+    return df
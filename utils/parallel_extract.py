@@ -0,0 +1,73 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import chunk_sink
+
+
+def process_context():
+    """Multiprocessing context of the worker pools: fork keeps the sys.path set up by the notebook and the
+    modules already imported by the parent, and does not rerun the calling script"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+
+def _module_budget(memory_budget, name):
+    if isinstance(memory_budget, dict):
+        return memory_budget.get(name)
+    return memory_budget
+
+
+def _run_module(func, args, budget):
+    """Runs one extraction in a worker process. The module's loops collect their chunks in ChunkSinks,
+    half of the budget is given to them before they spill, the rest is left for the final frame."""
+    if budget is not None:
+        chunk_sink.DEFAULT_MEMORY_BUDGET = int(budget // 2)
+    func(*args)
+
+
+def run_modules(jobs, workers=1, memory_budget=None, memory_limit=None):
+    """Runs independent feature extraction modules, each in its own worker process.
+
+    jobs is a list of (name, func, args), func(*args) extracts one module and saves it to disk.
+    - workers: number of modules extracted at the same time, 1 runs them one after another in this process
+    - memory_budget: bytes a module may use, one number for all modules or a dict by module name
+    - memory_limit: bytes available to all modules together, a module is only started while the budgets of
+      the running modules leave room for it (or when nothing else is running)
+    Jobs are started in the order given, so the heaviest modules (chartevents, labevents) should come first.
+    The first module that fails stops the run and its error is raised here."""
+    if workers <= 1 or len(jobs) <= 1:
+        for name, func, args in jobs:
+            _run_local(func, args, _module_budget(memory_budget, name))
+        return
+
+    pending = list(jobs)
+    running = {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=process_context()) as pool:
+        try:
+            while pending or running:
+                while pending and len(running) < workers:
+                    name, func, args = pending[0]
+                    budget = _module_budget(memory_budget, name)
+                    used = sum(b or 0 for _, b in running.values())
+                    if running and memory_limit is not None and used + (budget or 0) > memory_limit:
+                        break
+                    pending.pop(0)
+                    running[pool.submit(_run_module, func, args, budget)] = (name, budget)
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, _ = running.pop(future)
+                    future.result()
+                    print("[ FINISHED " + name.upper() + " ]")
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+
+def _run_local(func, args, budget):
+    """Runs one extraction in this process, restoring the ChunkSink budget afterwards"""
+    previous = chunk_sink.DEFAULT_MEMORY_BUDGET
+    try:
+        _run_module(func, args, budget)
+    finally:
+        chunk_sink.DEFAULT_MEMORY_BUDGET = previous
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Sparse version of the long format -> (subject_id, label, timedelta) x feature pivot of pivot_cohort.
+# The rows and features are factorized to integer positions (the feature columns already hold the dictionary codes
+# of feature_dictionary.py) and the cells are reduced with array operations into a scipy.sparse csr_matrix,
+# instead of a dense pivot_table with a column per feature. Cells without rows are the implicit zeros of the
+# matrix, where the dense pivot holds NaN.
+
+
+def _positions(keys: pd.DataFrame):
+    """Row position of each key (in sorted key order) and the frame of the distinct keys"""
+    by = list(keys.columns)
+    positions = keys.groupby(by, sort=True).ngroup().values
+    return positions, keys.drop_duplicates().sort_values(by).reset_index(drop=True)
+
+
+def top_features(df: pd.DataFrame, target_col: str, max_features: int, group_col='subject_id') -> pd.Index:
+    """The max_features values of target_col found for the most group_col values, the column sums of the
+    group x feature indicator matrix. Features found for as many groups are taken in value order."""
+    group, _ = pd.factorize(df[group_col])
+    col, features = pd.factorize(df[target_col], sort=True)
+    indicator = sparse.csr_matrix((np.ones(len(df), dtype='int8'), (group, col)), shape=(group.max() + 1 if len(df) else 0, len(features)))
+    indicator.data[:] = 1    # a feature seen several times for a group counts once
+    counts = np.asarray(indicator.sum(axis=0, dtype='int64')).ravel()
+    return features[np.argsort(-counts, kind='stable')[:max_features]]
+
+
+def pivot_sparse(df: pd.DataFrame, target_col: str, values=None, index_cols=['subject_id', 'label', 'timedelta'],
+                 aggfunc='max', max_features=None):
+    """Pivots long format data into a sparse matrix, one row per distinct index_cols and one column per target_col value.
+    values: column reduced in each cell with aggfunc ('max' or 'mean'), 1 for every row if None (one hot)
+    max_features: only keep the features of top_features (counted over the subject_id of the rows)
+    Returns the csr_matrix, the index frame of its rows and the target_col values of its columns."""
+    if aggfunc not in ('max', 'mean'):
+        raise ValueError(f"aggfunc must be 'max' or 'mean', not {aggfunc!r}")
+    df = df.dropna(subset=index_cols + [target_col] + ([values] if values is not None else []))
+    if max_features:
+        df = df[df[target_col].isin(top_features(df, target_col, max_features))]
+
+    row, index = _positions(df[index_cols])
+    col, columns = pd.factorize(df[target_col], sort=True)
+    data = np.ones(len(df)) if values is None else df[values].values.astype('float64')
+    cells, inverse = np.unique(row.astype('int64') * len(columns) + col, return_inverse=True)
+    if aggfunc == 'max':
+        # last value of each cell once sorted by cell then value
+        order = np.lexsort((data, inverse))
+        last = np.r_[np.flatnonzero(np.diff(inverse[order])), len(order) - 1] if len(order) else []
+        data = data[order][last]
+    else:
+        data = np.bincount(inverse, data, len(cells)) / np.bincount(inverse, minlength=len(cells))
+    matrix = sparse.csr_matrix((data, (cells // max(len(columns), 1), cells % max(len(columns), 1))), shape=(len(index), len(columns)))
+    return matrix, index, pd.Series(columns, name=target_col)
@@ -0,0 +1,237 @@
+import os
+import pandas as pd
+import table_loader
+from table_schema import get_schema
+
+# DuckDB is optional; the pandas code paths are used unless engine='duckdb' is requested
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+ENGINES = ['pandas', 'duckdb']
+
+# Settings of the embedded engine. memory_limit/threads None keep the DuckDB defaults (80% of RAM, all cores);
+# joins larger than memory_limit spill to temp_directory.
+MEMORY_LIMIT = None
+THREADS = None
+TEMP_DIRECTORY = "./data/temp/duckdb"
+
+
+def use_sql(engine: str) -> bool:
+    """True if the SQL backend was requested; raises if the engine is unknown or DuckDB is not installed"""
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES}, got '{engine}'")
+    if engine == 'duckdb' and duckdb is None:
+        raise ImportError("engine='duckdb' requires the duckdb package (pip install duckdb)")
+    return engine == 'duckdb'
+
+
+def _quote(path: str) -> str:
+    return "'" + path.replace("'", "''") + "'"
+
+
+def csv_source(path: str) -> str:
+    """SQL table expression reading a gzip csv written by the pipeline (e.g. a cohort file)"""
+    return f"read_csv_auto({_quote(path)}, header=true)"
+
+
+def table_source(name: str, mimic4_path=None, filters=None) -> str:
+    """SQL table expression reading a MIMIC-IV table from its partitioned copy, Parquet file or csv.gz,
+    in the same order of preference as table_loader.load_table.
+    On a partitioned table only the buckets that can match `filters` (see table_loader.load_table) are read."""
+    parquet_path, csv_path = table_loader.table_paths(name, mimic4_path)
+    parts_dir = table_loader.partition_path(name, mimic4_path)
+    stats = table_loader._load_stats(parts_dir)
+    if stats is not None:
+        files = [table_loader._bucket_file(parts_dir, b) for b in table_loader._select_buckets(stats, filters)]
+        if not files:
+            files = [table_loader._bucket_file(parts_dir, 0)]
+        return "read_parquet([" + ", ".join(map(_quote, files)) + "])"
+    if os.path.exists(parquet_path):
+        return f"read_parquet({_quote(parquet_path)})"
+    return f"read_csv_auto({_quote(csv_path)}, header=true)"
+
+
+def query(sql: str, frames=None, schema_table=None) -> pd.DataFrame:
+    """Runs a query on a fresh in-memory DuckDB connection and returns the result as a DataFrame.
+
+    frames: {name: DataFrame} registered as views the query can refer to
+    schema_table: MIMIC-IV table whose registered dtypes (table_schema.py) are applied to the result"""
+    os.makedirs(TEMP_DIRECTORY, exist_ok=True)
+    con = duckdb.connect()
+    try:
+        con.execute(f"SET temp_directory={_quote(TEMP_DIRECTORY)}")
+        if MEMORY_LIMIT is not None:
+            con.execute(f"SET memory_limit={_quote(MEMORY_LIMIT)}")
+        if THREADS is not None:
+            con.execute(f"SET threads={int(THREADS)}")
+        for name, frame in (frames or {}).items():
+            con.register(name, frame)
+        df = con.execute(sql).df()
+    finally:
+        con.close()
+    if schema_table is not None:
+        df = apply_dtypes(df, schema_table)
+    return df
+
+
+def apply_dtypes(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    """Casts the columns of df to the dtypes registered for a MIMIC-IV table, skipping casts that fail"""
+    schema = get_schema(name)
+    if schema is None:
+        return df
+    for col, t in schema['dtype'].items():
+        if col in df.columns and df[col].dtype != t:
+            try:
+                df[col] = df[col].astype(t)
+            except (ValueError, TypeError):
+                pass
+    return df
+
+
+########################## COHORT ##########################
+def get_visit_pts(mimic4_path: str, group_col: str, visit_col: str, admit_col: str, disch_col: str, adm_visit_col: str,
+                  use_admn: bool, use_ICU: bool, hids=None, module='hosp', race_col='race', mark_admn=False) -> pd.DataFrame:
+    """SQL version of the joins in day_intervals_cohort(_v2).get_visit_pts; returns the same rows and columns.
+
+    hids: hadm_ids of the disease cohort (disease_cohort.extract_diag_cohort), None for no disease filter
+    module: folder of admissions/patients ('core' in MIMIC-IV 1.0, 'hosp' in 2.0)
+    race_col: 'ethnicity' in MIMIC-IV 1.0, 'race' in 2.0
+    mark_admn: keep the visits ending in a death and flag the others in an 'admn_valid' column instead
+    ICU stays also get the admittime and dischtime of their hospital admission."""
+    adm = table_source(module + "/admissions", mimic4_path)
+    pts = table_source(module + "/patients", mimic4_path)
+    frames = {}
+    hid_filter = ""
+    if hids is not None:
+        frames['hids'] = pd.DataFrame({'hadm_id': pd.Series(hids, dtype='int64').unique()})
+        hid_filter = "AND v.hadm_id IN (SELECT hadm_id FROM hids)"
+
+    if use_ICU:
+        # icustays has no death flag: readmission cohorts drop stays ending after the patient's death
+        alive = f"(p.dod IS NULL OR CAST(p.dod AS TIMESTAMP) >= v.{disch_col})"
+        death_filter = "AND " + alive if use_admn and not mark_admn else ""
+        visit = f"""
+            SELECT v.{group_col}, v.{visit_col}, v.{adm_visit_col}, v.{admit_col}, v.{disch_col}, v.los, {alive} AS admn_valid
+            FROM {table_source("icu/icustays", mimic4_path)} v
+            JOIN {pts} p ON v.subject_id = p.subject_id
+            WHERE TRUE {death_filter} {hid_filter}"""
+        visit_cols = [group_col, visit_col, adm_visit_col, admit_col, disch_col, 'los']
+    else:
+        # los in whole days, rounded down like the 'X days' part of the Timedelta string
+        expire_filter = "AND v.hospital_expire_flag = 0" if use_admn and not mark_admn else ""
+        visit = f"""
+            SELECT v.{group_col}, v.{visit_col}, v.{admit_col}, v.{disch_col},
+                   CAST(floor(epoch(v.{disch_col} - v.{admit_col}) / 86400) AS BIGINT) AS los,
+                   v.hospital_expire_flag = 0 AS admn_valid
+            FROM {adm} v
+            WHERE TRUE {expire_filter} {hid_filter}"""
+        visit_cols = [group_col, visit_col, admit_col, disch_col, 'los']
+
+    hosp_cols = ", a.admittime, a.dischtime" if use_ICU else ""
+    flag_col = ", v.admn_valid" if mark_admn else ""
+    # min_valid_year: anchor_year corresponding to the anchor_year_group 2017-2019
+    sql = f"""
+        WITH visit AS ({visit})
+        SELECT {", ".join("v." + c for c in visit_cols)},
+               p.anchor_year + (2019 - CAST(right(p.anchor_year_group, 4) AS INTEGER)) AS min_valid_year,
+               CAST(p.dod AS TIMESTAMP) AS dod, p.anchor_age AS Age, p.gender, a.{race_col}, a.insurance{hosp_cols}{flag_col}
+        FROM visit v
+        JOIN {pts} p ON v.{group_col} = p.{group_col}
+        JOIN {adm} a ON v.hadm_id = a.hadm_id
+        WHERE p.anchor_age >= 18
+        ORDER BY v.{group_col}, v.{visit_col}"""
+    visit_pts = query(sql, frames)
+    if not use_ICU:
+        visit_pts = visit_pts.dropna(subset=['min_valid_year'])
+    return visit_pts
+
+
+########################## EVENTS ##########################
+def minutes(interval: str) -> str:
+    """SQL expression of the whole minutes of an interval such as charttime - intime, as feature_store.offset_minutes"""
+    return f"CAST(floor(epoch({interval}) / 60) AS INTEGER)"
+
+
+def preproc_chart(dataset_path: str, cohort_path: str, time_col: str, usecols: list) -> pd.DataFrame:
+    """SQL version of the chartevents/cohort join in icu_preprocess_util.preproc_chart.
+    Rows with a missing value in any of usecols or the stay's intime are dropped, as the dropna of the pandas path does.
+    The engines differ on duplicates: they are dropped over the whole result here, per chunk of 10M rows in the
+    pandas path, which keeps a duplicate whose copies fall in different chunks."""
+    cohort = pd.read_csv(cohort_path, compression='gzip', usecols=['stay_id'])
+    source = table_source(dataset_path, filters=[('stay_id', 'in', cohort['stay_id'].unique())])
+    cols = [c for c in usecols if c != time_col]
+    # duplicates are dropped on the exact offsets, before they are rounded to minutes
+    sql = f"""
+        SELECT {", ".join(cols)}, {minutes("event_time_from_admit")} AS event_time_from_admit
+        FROM (
+            SELECT DISTINCT {", ".join("e." + c for c in cols)}, e.{time_col} - c.intime AS event_time_from_admit
+            FROM {source} e
+            JOIN (SELECT DISTINCT stay_id, CAST(intime AS TIMESTAMP) AS intime FROM {csv_source(cohort_path)}) c
+              ON e.stay_id = c.stay_id
+            WHERE {" AND ".join("e." + c + " IS NOT NULL" for c in usecols)} AND c.intime IS NOT NULL)"""
+    return query(sql, schema_table=dataset_path)
+
+
+def preproc_labs(dataset_path: str, adm_path: str, cohort_path: str) -> pd.DataFrame:
+    """SQL version of hosp_preprocess_util.preproc_labs: labevents of the cohort subjects, missing hadm_ids imputed
+    (the admission of the subject whose admit/discharge dates contain the charttime date, closest admittime first,
+    like labs_preprocess_util.impute_hadm_ids) and joined to the cohort admissions."""
+    cohort = pd.read_csv(cohort_path, compression='gzip', usecols=['subject_id'])
+    source = table_source(dataset_path, filters=[('subject_id', 'in', cohort['subject_id'].unique())])
+    sql = f"""
+        WITH cohort AS (
+            SELECT DISTINCT hadm_id, CAST(admittime AS TIMESTAMP) AS admittime, CAST(dischtime AS TIMESTAMP) AS dischtime
+            FROM {csv_source(cohort_path)}),
+        ev AS (
+            SELECT row_number() OVER () AS rid, subject_id, hadm_id, itemid, charttime, valuenum, valueuom
+            FROM {source}
+            WHERE valuenum IS NOT NULL
+              AND subject_id IN (SELECT DISTINCT subject_id FROM {csv_source(cohort_path)})),
+        adm AS (
+            SELECT row_number() OVER () AS pos, subject_id, hadm_id, admittime, dischtime FROM {table_source(adm_path)}),
+        imputed AS (
+            SELECT ev.rid, a.hadm_id,
+                   row_number() OVER (PARTITION BY ev.rid ORDER BY CAST(ev.charttime AS DATE) - CAST(a.admittime AS DATE), a.pos) AS rn
+            FROM ev JOIN adm a ON ev.subject_id = a.subject_id
+            WHERE ev.hadm_id IS NULL
+              AND CAST(ev.charttime AS DATE) >= CAST(a.admittime AS DATE)
+              AND CAST(ev.charttime AS DATE) <= CAST(a.dischtime AS DATE))
+        SELECT ev.itemid, ev.subject_id, CAST(coalesce(ev.hadm_id, i.hadm_id) AS DOUBLE) AS hadm_id, ev.charttime,
+               ev.valuenum, coalesce(ev.valueuom, '0') AS valueuom, c.admittime, c.dischtime,
+               {minutes("ev.charttime - c.admittime")} AS lab_time_from_admit
+        FROM ev
+        LEFT JOIN imputed i ON ev.rid = i.rid AND i.rn = 1
+        JOIN cohort c ON coalesce(ev.hadm_id, i.hadm_id) = c.hadm_id
+        WHERE c.admittime IS NOT NULL AND c.dischtime IS NOT NULL"""
+    df = query(sql, schema_table=dataset_path)
+    # units as an object column, like the pandas path gives drop_wrong_uom
+    df['valueuom'] = df['valueuom'].astype(object)
+    return df
+
+
+def preproc_meds_hosp(module_path: str, adm_cohort_path: str) -> pd.DataFrame:
+    """SQL version of the prescriptions/cohort join in hosp_preprocess_util.preproc_meds"""
+    sql = f"""
+        SELECT m.subject_id, m.hadm_id, m.drug, m.starttime, m.stoptime, m.ndc, m.dose_val_rx, c.admittime,
+               {minutes("m.starttime - c.admittime")} AS start_hours_from_admit,
+               {minutes("m.stoptime - c.admittime")} AS stop_hours_from_admit
+        FROM {table_source(module_path)} m
+        JOIN (SELECT hadm_id, CAST(admittime AS TIMESTAMP) AS admittime FROM {csv_source(adm_cohort_path)}) c
+          ON m.hadm_id = c.hadm_id"""
+    return query(sql, schema_table=module_path)
+
+
+def preproc_meds_icu(module_path: str, adm_cohort_path: str) -> pd.DataFrame:
+    """SQL version of the inputevents/cohort join in icu_preprocess_util.preproc_meds (rows with missing values dropped)"""
+    cols = ['subject_id', 'stay_id', 'itemid', 'starttime', 'endtime', 'rate', 'amount', 'orderid']
+    sql = f"""
+        SELECT {", ".join("m." + c for c in cols)}, c.hadm_id, c.intime,
+               {minutes("m.starttime - c.intime")} AS start_hours_from_admit,
+               {minutes("m.endtime - c.intime")} AS stop_hours_from_admit
+        FROM {table_source(module_path)} m
+        JOIN (SELECT hadm_id, stay_id, CAST(intime AS TIMESTAMP) AS intime FROM {csv_source(adm_cohort_path)}) c
+          ON m.stay_id = c.stay_id
+        WHERE {" AND ".join("m." + c + " IS NOT NULL" for c in cols)} AND c.hadm_id IS NOT NULL AND c.intime IS NOT NULL"""
+    return query(sql, schema_table=module_path)
@@ -0,0 +1,132 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import table_loader
+from feature_store import feature_path, save_feature, load_feature
+
+# Incremental refresh of the feature extraction when a new MIMIC-IV release lands.
+#
+# A fingerprint is an order-independent content hash of the rows of one subject: the wrapping uint64 sum of the
+# row hashes. The fingerprints of a raw table are computed in one pass and cached next to it
+# (<table>.fingerprints_<key>.arrow, like the diagnosis index). A module extracted with refresh=True stores, next
+# to its feature table, the frame it extracted before the cohort-wide steps (<name>.base.arrow, e.g. before
+# drop_wrong_uom) and the fingerprints of every cohort subject (<name>.fingerprints.arrow): its rows in the module's
+# tables, its cohort rows and the mapping files used. The next refresh only extracts the subjects whose fingerprint
+# changed (or are new to the cohort) and merges them with the stored rows of the other subjects.
+# Changes to the extraction code itself are not seen, run without refresh after changing it.
+CHUNKSIZE = 10000000
+
+
+def frame_fingerprints(df: pd.DataFrame, group_col='subject_id') -> pd.Series:
+    """Fingerprint of the rows of each group_col value, indexed by it"""
+    if df.empty:
+        return pd.Series([], dtype='uint64', index=pd.Index([], name=group_col))
+    rows = pd.util.hash_pandas_object(df, index=False).values
+    # the 64 bit sum is done on the two 32 bit halves, int64 sums of those do not overflow
+    halves = pd.DataFrame({'lo': (rows & 0xffffffff).astype('int64'), 'hi': (rows >> 32).astype('int64')})
+    return _join_halves(halves.groupby(df[group_col].values).sum(), group_col)
+
+
+def _join_halves(sums: pd.DataFrame, group_col) -> pd.Series:
+    fingerprints = sums['lo'].values.astype('uint64') + (sums['hi'].values.astype('uint64') << np.uint64(32))
+    return pd.Series(fingerprints, index=pd.Index(sums.index, name=group_col))
+
+
+def fingerprints_path(name: str, mimic4_path: str) -> str:
+    """Path of the cached subject fingerprints of a raw table, keyed by the table files"""
+    parquet_path, csv_path = table_loader.table_paths(name, mimic4_path)
+    sources = [p for p in (parquet_path, csv_path, table_loader.partition_path(name, mimic4_path)) if os.path.exists(p)]
+    key = json.dumps([table_loader.file_key(p) for p in sources])
+    return csv_path[:-len('.csv.gz')] + '.fingerprints_' + hashlib.md5(key.encode()).hexdigest()[:12] + '.arrow'
+
+
+def table_fingerprints(name: str, mimic4_path: str) -> pd.Series:
+    """Fingerprints of the subjects of a raw table (e.g. 'icu/chartevents'), over the columns load_table reads.
+    Computed in one pass over the table the first time and cached next to it."""
+    path = fingerprints_path(name, mimic4_path)
+    if os.path.exists(path):
+        return pd.read_feather(path).set_index('subject_id')['fingerprint']
+    print("[ FINGERPRINTING " + name + " ]")
+    sums = []
+    for chunk in table_loader.iter_table(name, CHUNKSIZE, mimic4_path=mimic4_path):
+        rows = pd.util.hash_pandas_object(chunk, index=False).values
+        halves = pd.DataFrame({'lo': (rows & 0xffffffff).astype('int64'), 'hi': (rows >> 32).astype('int64')})
+        sums.append(halves.groupby(chunk['subject_id'].values).sum())
+    if sums:
+        fingerprints = _join_halves(pd.concat(sums).groupby(level=0).sum(), 'subject_id')
+    else:
+        fingerprints = frame_fingerprints(pd.DataFrame({'subject_id': []}))
+    fingerprints.reset_index(name='fingerprint').to_feather(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return fingerprints
+
+
+def subject_fingerprints(cohort: pd.DataFrame, mimic4_path: str, tables: list, sources=()) -> pd.Series:
+    """Fingerprints of the cohort subjects for a module reading tables of the release and the files sources"""
+    subjects = pd.Index(cohort['subject_id'].unique(), name='subject_id')
+    parts = {'cohort': frame_fingerprints(cohort).reindex(subjects, fill_value=0)}
+    for name in tables:
+        parts[name] = table_fingerprints(name, mimic4_path).reindex(subjects, fill_value=0)
+    parts = pd.DataFrame(parts)
+    # a changed mapping file changes every fingerprint
+    parts['sources'] = json.dumps([[os.path.basename(p)] + table_loader.file_key(p)[1:] for p in sources])
+    return pd.Series(pd.util.hash_pandas_object(parts, index=True).values, index=subjects)
+
+
+def changed_subjects(previous: pd.Series, current: pd.Series) -> np.ndarray:
+    """Subjects whose fingerprint differs, including the subjects only in one of them"""
+    both = pd.concat([previous.rename('previous'), current.rename('current')], axis=1)
+    return both.index[both['previous'] != both['current']].values
+
+
+def _row_subjects(df: pd.DataFrame, cohort: pd.DataFrame) -> pd.Series:
+    """subject_id of the rows of an extracted frame, through the cohort ids when the frame has no subject_id
+    (NaN for rows of visits no longer in the cohort)"""
+    if 'subject_id' in df.columns:
+        return df['subject_id']
+    key = 'stay_id' if 'stay_id' in df.columns and 'stay_id' in cohort.columns else 'hadm_id'
+    return df[key].map(cohort.drop_duplicates(key).set_index(key)['subject_id'])
+
+
+def extract_subjects(name: str, extract, cohort_output: str, version_path: str, tables: list, refresh=False, sources=()) -> pd.DataFrame:
+    """Runs extract(cohort_output), the extraction of a module for a cohort.
+
+    With refresh, the rows stored by the previous refresh of the module (name is its feature table) are reused for
+    the subjects whose fingerprint did not change, and extract is only run on a cohort of the other subjects.
+    tables are the raw tables of the release the module reads (e.g. ['icu/chartevents']), sources the other
+    files it reads (mapping files). extract must only depend on the rows of each subject: cohort-wide steps
+    are applied to the returned frame."""
+    if not refresh:
+        return extract(cohort_output)
+    cohort = pd.read_csv('./data/cohort/'+cohort_output+'.csv.gz', compression='gzip')
+    fingerprints = subject_fingerprints(cohort, "./"+version_path, tables, sources)
+    base, previous = name + '.base', name + '.fingerprints'
+
+    if os.path.exists(feature_path(base)) and os.path.exists(feature_path(previous)):
+        changed = changed_subjects(load_feature(previous).set_index('subject_id')['fingerprint'], fingerprints)
+        kept = load_feature(base)
+        subjects = _row_subjects(kept, cohort)
+        kept = kept[subjects.notna() & ~subjects.isin(changed)]
+        partial = cohort[cohort['subject_id'].isin(changed)]
+        print(f"[ REFRESHING {name}: {partial['subject_id'].nunique()} OF {len(fingerprints)} SUBJECTS CHANGED ]")
+        if len(partial):
+            partial_output = cohort_output + '.refresh_' + name
+            partial.to_csv('./data/cohort/'+partial_output+'.csv.gz', index=False, compression='gzip')
+            try:
+                new = extract(partial_output)
+            finally:
+                os.remove('./data/cohort/'+partial_output+'.csv.gz')
+            # a few subjects can come back with wider dtypes (e.g. float ids in labs), the stored rows decide
+            cast = {col: kept[col].dtype for col in kept.columns if col in new.columns and new[col].dtype != kept[col].dtype
+                    and new[col].dtype.kind in 'iuf' and kept[col].dtype.kind in 'iuf' and new[col].notna().all()}
+            df = pd.concat([kept, new.astype(cast)], ignore_index=True)
+        else:
+            df = kept.reset_index(drop=True)
+    else:
+        df = extract(cohort_output)
+
+    save_feature(df, base)
+    save_feature(fingerprints.reset_index(name='fingerprint'), previous)
+    return df
@@ -0,0 +1,518 @@
+import io
+import os
+import sys
+import glob
+import json
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from tqdm import tqdm
+from table_schema import get_schema
+import gzip_index
+from parallel_extract import process_context
+
+# Sub-folders of a MIMIC-IV release that are converted; 'core' only exists in v1.0
+MODULES = ['core', 'hosp', 'icu']
+# Large event tables that are stored hash-partitioned by the id the cohort readers filter on
+PARTITIONED_TABLES = {'hosp/labevents': 'subject_id', 'icu/chartevents': 'stay_id'}
+PARTITION_STATS = '_stats.json'
+# Processes parsing an indexed gzip csv table in parallel (see gzip_index.py)
+READ_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+
+
+def is_time_col(col: str) -> bool:
+    """MIMIC-IV names every timestamp column *time or *date, plus the patients.dod column"""
+    return col.endswith('time') or col.endswith('date') or col == 'dod'
+
+
+def table_paths(name: str, mimic4_path=None) -> tuple:
+    """Returns the (parquet, csv.gz) paths of a table.
+
+    name: table name relative to mimic4_path (e.g. 'hosp/admissions') or a path to the raw .csv.gz file"""
+    if mimic4_path is not None:
+        name = os.path.join(mimic4_path, name)
+    if name.endswith('.csv.gz'):
+        name = name[:-len('.csv.gz')]
+    return name + '.parquet', name + '.csv.gz'
+
+
+def partition_path(name: str, mimic4_path=None) -> str:
+    """Returns the folder holding the partitioned copy of a table (see partition_table)"""
+    return table_paths(name, mimic4_path)[0][:-len('.parquet')] + '.parts'
+
+
+def file_key(path: str) -> list:
+    """Path, size and modification time of a file (or folder), the part of the key of a cache derived from it"""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+
+########################## CONVERSION ##########################
+class _SchemaConflict(Exception):
+    """Raised when a later csv chunk holds values that do not fit the column types seen so far"""
+
+    def __init__(self, kinds):
+        super().__init__(str(kinds))
+        self.kinds = kinds
+
+
+def _sample_kinds(csv_path: str, nrows=100000) -> dict:
+    """Guesses a storage kind ('int', 'float', 'time' or 'text') for every column from the first rows of a table"""
+    header = pd.read_csv(csv_path, compression='gzip', nrows=0).columns
+    time_cols = [c for c in header if is_time_col(c)]
+    sample = pd.read_csv(csv_path, compression='gzip', nrows=nrows, parse_dates=time_cols)
+    kinds = {}
+    for col in sample.columns:
+        dtype = sample[col].dtype
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            kinds[col] = 'time'
+        elif pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+            kinds[col] = 'int'
+        elif pd.api.types.is_float_dtype(dtype):
+            kinds[col] = 'float'
+        else:
+            kinds[col] = 'text'
+    return kinds
+
+
+def _check_chunk(chunk: pd.DataFrame, kinds: dict) -> pd.DataFrame:
+    """Verifies a parsed chunk against the column kinds, raising _SchemaConflict with the widened kinds if needed"""
+    widened = {}
+    for col, kind in kinds.items():
+        values = chunk[col]
+        if values.isna().all():
+            chunk[col] = pd.Series([None] * len(values), index=values.index, dtype=object)
+            continue
+        dtype = values.dtype
+        if kind == 'int':
+            if pd.api.types.is_float_dtype(dtype):
+                if (values.dropna() % 1 != 0).any():
+                    widened[col] = 'float'
+            elif not (pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype)):
+                widened[col] = 'text'
+        elif kind == 'float':
+            if not pd.api.types.is_numeric_dtype(dtype):
+                widened[col] = 'text'
+        elif kind == 'time':
+            if not pd.api.types.is_datetime64_any_dtype(dtype):
+                widened[col] = 'text'
+    if widened:
+        raise _SchemaConflict({**kinds, **widened})
+    return chunk
+
+
+def _arrow_schema(kinds: dict) -> pa.Schema:
+    types = {'int': pa.int64(), 'float': pa.float64(), 'time': pa.timestamp('ns'), 'text': pa.string()}
+    return pa.schema([(col, types[kind]) for col, kind in kinds.items()])
+
+
+def _write_parquet(csv_path: str, parquet_path: str, kinds: dict, chunksize: int, row_group_size: int):
+    schema = _arrow_schema(kinds)
+    time_cols = [c for c, k in kinds.items() if k == 'time']
+    text_cols = {c: str for c, k in kinds.items() if k == 'text'}
+    tmp_path = parquet_path + '.tmp'
+    writer = pq.ParquetWriter(tmp_path, schema)
+    try:
+        for chunk in tqdm(pd.read_csv(csv_path, compression='gzip', header=0, index_col=None, dtype=text_cols, parse_dates=time_cols, chunksize=chunksize)):
+            chunk = _check_chunk(chunk, kinds)
+            writer.write_table(pa.Table.from_pandas(chunk[list(kinds)], schema=schema, preserve_index=False), row_group_size=row_group_size)
+    except BaseException:
+        writer.close()
+        os.remove(tmp_path)
+        raise
+    writer.close()
+    # rename only once complete so that load_table never picks up a partial conversion
+    os.replace(tmp_path, parquet_path)
+
+
+def convert_table(csv_path: str, parquet_path=None, chunksize=5000000, row_group_size=1000000):
+    """Converts one gzip csv table to Parquet, typing time columns as timestamps and ids/values as numbers.
+    Column types are guessed from the first rows; if a later chunk contradicts the guess the column is
+    widened (int -> float -> text) and the conversion restarts."""
+    if parquet_path is None:
+        parquet_path = table_paths(csv_path)[0]
+    kinds = _sample_kinds(csv_path)
+    while True:
+        try:
+            _write_parquet(csv_path, parquet_path, kinds, chunksize, row_group_size)
+            return parquet_path
+        except _SchemaConflict as conflict:
+            print("Widening column types and restarting:", {c: k for c, k in conflict.kinds.items() if kinds[c] != k})
+            kinds = conflict.kinds
+
+
+def convert_to_parquet(mimic4_path: str, modules=None, overwrite=False, chunksize=5000000):
+    """One-time conversion of the raw gzip csv tables of a MIMIC-IV release (e.g. './mimiciv/2.0') into
+    Parquet files written next to them. load_table reads the Parquet files once they exist."""
+    if modules is None:
+        modules = MODULES
+    for module in modules:
+        for csv_path in sorted(glob.glob(os.path.join(mimic4_path, module, '*.csv.gz'))):
+            parquet_path = table_paths(csv_path)[0]
+            if os.path.exists(parquet_path) and not overwrite:
+                continue
+            print(f"[ CONVERTING {module}/{os.path.basename(csv_path)} ]")
+            convert_table(csv_path, parquet_path, chunksize=chunksize)
+    print("[ SUCCESSFULLY CONVERTED TABLES TO PARQUET ]")
+
+
+########################## PARTITIONING ##########################
+def _bucket_file(parts_dir: str, bucket: int) -> str:
+    return os.path.join(parts_dir, f'part-{bucket:04d}.parquet')
+
+
+def partition_table(name: str, key: str, buckets=64, mimic4_path=None, overwrite=False, row_group_size=100000):
+    """Stores a table as `buckets` Parquet files bucketed by key % buckets, each sorted by key, plus a
+    _stats.json file with the row count and min/max key of every bucket.
+    load_table and iter_table then only open the buckets that can hold the ids in an 'in'/'==' filter on key
+    (and skip buckets whose min/max range lies outside range filters), so small cohorts read a few files
+    instead of the whole table. The table is converted to Parquet first if needed."""
+    parquet_path, csv_path = table_paths(name, mimic4_path)
+    parts_dir = partition_path(name, mimic4_path)
+    if os.path.exists(os.path.join(parts_dir, PARTITION_STATS)) and not overwrite:
+        return parts_dir
+    if not os.path.exists(parquet_path):
+        convert_table(csv_path, parquet_path)
+    os.makedirs(parts_dir, exist_ok=True)
+    dataset = ds.dataset(parquet_path, format='parquet')
+    schema = dataset.schema
+
+    # 1st pass: scatter rows into their bucket files
+    tmp_files = {b: _bucket_file(parts_dir, b) + '.tmp' for b in range(buckets)}
+    writers = {b: pq.ParquetWriter(path, schema) for b, path in tmp_files.items()}
+    try:
+        for batch in tqdm(dataset.to_batches(batch_size=5000000)):
+            df = batch.to_pandas()
+            bucket = (df[key].fillna(0).astype('int64') % buckets).values
+            for b, part in df.groupby(bucket, sort=False):
+                writers[b].write_table(pa.Table.from_pandas(part, schema=schema, preserve_index=False))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    # 2nd pass: sort every bucket by key so that the row group statistics are selective too
+    stats = {'key': key, 'buckets': buckets, 'parts': {}}
+    for b, tmp_path in tqdm(tmp_files.items()):
+        part = pq.read_table(tmp_path).to_pandas()
+        part = part.sort_values(key, kind='mergesort')
+        pq.write_table(pa.Table.from_pandas(part, schema=schema, preserve_index=False), _bucket_file(parts_dir, b), row_group_size=row_group_size)
+        os.remove(tmp_path)
+        ids = part[key].dropna()
+        stats['parts'][str(b)] = {'rows': int(part.shape[0]),
+                                  'min': int(ids.min()) if ids.shape[0] else None,
+                                  'max': int(ids.max()) if ids.shape[0] else None}
+    # written last: a folder without stats is an unfinished partitioning and is ignored by the readers
+    with open(os.path.join(parts_dir, PARTITION_STATS), 'w') as f:
+        json.dump(stats, f)
+    return parts_dir
+
+
+def partition_events(mimic4_path: str, buckets=64, overwrite=False):
+    """Partitions the large event tables (PARTITIONED_TABLES) of a MIMIC-IV release"""
+    for name, key in PARTITIONED_TABLES.items():
+        if not os.path.exists(table_paths(name, mimic4_path)[1]) and not os.path.exists(table_paths(name, mimic4_path)[0]):
+            continue
+        print(f"[ PARTITIONING {name} BY {key} ]")
+        partition_table(name, key, buckets=buckets, mimic4_path=mimic4_path, overwrite=overwrite)
+    print("[ SUCCESSFULLY PARTITIONED EVENT TABLES ]")
+
+
+def _load_stats(parts_dir: str):
+    stats_path = os.path.join(parts_dir, PARTITION_STATS)
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path) as f:
+        return json.load(f)
+
+
+def _select_buckets(stats: dict, filters) -> list:
+    """Buckets that may contain rows passing the filters on the partition key"""
+    key, n = stats['key'], stats['buckets']
+    selected = []
+    for b, part in stats['parts'].items():
+        b = int(b)
+        if part['rows'] == 0:
+            continue
+        keep = True
+        for col, op, val in filters or []:
+            if col != key:
+                continue
+            if part['min'] is None:
+                keep = False
+            elif op in ('=', '=='):
+                keep = val % n == b and part['min'] <= val <= part['max']
+            elif op == 'in':
+                ids = np.asarray(list(val), dtype='int64')
+                keep = bool(((ids % n == b) & (ids >= part['min']) & (ids <= part['max'])).any())
+            elif op == '<':
+                keep = part['min'] < val
+            elif op == '<=':
+                keep = part['min'] <= val
+            elif op == '>':
+                keep = part['max'] > val
+            elif op == '>=':
+                keep = part['max'] >= val
+            if not keep:
+                break
+        if keep:
+            selected.append(b)
+    return selected
+
+
+def _partitioned_dataset(name: str, mimic4_path, filters):
+    """pyarrow dataset over the buckets of a partitioned table needed for the filters, None if the table is not partitioned"""
+    parts_dir = partition_path(name, mimic4_path)
+    stats = _load_stats(parts_dir)
+    if stats is None:
+        return None
+    files = [_bucket_file(parts_dir, b) for b in _select_buckets(stats, filters)]
+    schema = pq.read_schema(_bucket_file(parts_dir, 0))
+    return ds.dataset(files, schema=schema, format='parquet')
+
+
+########################## READING ##########################
+def filter_expression(filters):
+    """Turns a list of (column, op, value) tuples into a pyarrow dataset expression (all tuples are AND-ed)"""
+    expr = None
+    for col, op, val in filters:
+        field = ds.field(col)
+        if op in ('=', '=='):
+            cond = field == val
+        elif op == '!=':
+            cond = field != val
+        elif op == '<':
+            cond = field < val
+        elif op == '<=':
+            cond = field <= val
+        elif op == '>':
+            cond = field > val
+        elif op == '>=':
+            cond = field >= val
+        elif op == 'in':
+            cond = field.isin(list(val))
+        elif op == 'not in':
+            cond = ~field.isin(list(val))
+        else:
+            raise ValueError(f"Unsupported filter operator '{op}'")
+        expr = cond if expr is None else expr & cond
+    return expr
+
+
+def filter_frame(df: pd.DataFrame, filters) -> pd.DataFrame:
+    """Applies a list of (column, op, value) tuples to an in-memory frame"""
+    if not filters:
+        return df
+    mask = np.ones(df.shape[0], dtype=bool)
+    for col, op, val in filters:
+        if op in ('=', '=='):
+            mask &= (df[col] == val).values
+        elif op == '!=':
+            mask &= (df[col] != val).values
+        elif op == '<':
+            mask &= (df[col] < val).values
+        elif op == '<=':
+            mask &= (df[col] <= val).values
+        elif op == '>':
+            mask &= (df[col] > val).values
+        elif op == '>=':
+            mask &= (df[col] >= val).values
+        elif op == 'in':
+            mask &= df[col].isin(val).values
+        elif op == 'not in':
+            mask &= ~df[col].isin(val).values
+        else:
+            raise ValueError(f"Unsupported filter operator '{op}'")
+    return df[mask]
+
+
+def _read_columns(columns, filters):
+    """Columns that have to be read from csv to evaluate the filters"""
+    if columns is None:
+        return None
+    extra = [col for col, _, _ in (filters or []) if col not in columns]
+    return list(columns) + list(dict.fromkeys(extra))
+
+
+class _ReadPlan():
+    """Where and how a table is read: the source (partitioned/Parquet dataset or csv) plus the columns,
+    dtypes and time formats resolved from the arguments and the schema registry (see table_schema.py)"""
+
+    def __init__(self, name, mimic4_path, columns, filters, parse_dates, dtype):
+        parquet_path, self.csv_path = table_paths(name, mimic4_path)
+        self.dataset = _partitioned_dataset(name, mimic4_path, filters)
+        if self.dataset is None and os.path.exists(parquet_path):
+            self.dataset = ds.dataset(parquet_path, format='parquet')
+        self.filters = filters
+        schema = get_schema(name) or {'columns': None, 'dtype': {}, 'dates': {}}
+        if columns is None and schema['columns'] is not None:
+            available = set(self.dataset.schema.names if self.dataset is not None
+                            else pd.read_csv(self.csv_path, compression='gzip', nrows=0).columns)
+            columns = [col for col in schema['columns'] if col in available]
+        self.columns = list(columns) if columns is not None else None
+        self.dtype = {**schema['dtype'], **(dtype or {})}
+        self.dates = {col: schema['dates'].get(col) for col in parse_dates or []}
+        self.dates.update({col: fmt for col, fmt in schema['dates'].items() if self.columns is None or col in self.columns})
+
+    def csv_args(self) -> dict:
+        # integer casts fail on missing values while parsing, so only the float/categorical/text dtypes
+        # are given to read_csv; _finish casts the rest
+        dtype = {col: t for col, t in self.dtype.items() if not str(t).startswith('int')}
+        return dict(compression='gzip', header=0, index_col=None, usecols=_read_columns(self.columns, self.filters), dtype=dtype)
+
+    def finish(self, df: pd.DataFrame) -> pd.DataFrame:
+        if self.columns is not None:
+            df = df[self.columns]
+        parsed = {col: _to_datetime(df[col], fmt) for col, fmt in self.dates.items()
+                  if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col])}
+        if parsed:
+            df = df.assign(**parsed)
+        casts = {}
+        for col, t in self.dtype.items():
+            if col in df.columns and df[col].dtype != t:
+                try:
+                    casts[col] = df[col].astype(t)
+                except (ValueError, TypeError):
+                    # e.g. an id column with missing values keeps its float dtype
+                    pass
+        if casts:
+            df = df.assign(**casts)
+        return df
+
+
+def _to_datetime(values: pd.Series, fmt) -> pd.Series:
+    if fmt is not None:
+        try:
+            return pd.to_datetime(values, format=fmt)
+        except (ValueError, TypeError):
+            pass
+    return pd.to_datetime(values)
+
+
+def load_table(name: str, columns=None, filters=None, mimic4_path=None, parse_dates=None, dtype=None) -> pd.DataFrame:
+    """Reads a MIMIC-IV table, preferring its partitioned copy (see partition_table), then its Parquet
+    conversion (see convert_to_parquet) over the raw gzip csv.
+
+    Parameters:
+    name: table name relative to mimic4_path (e.g. 'hosp/admissions') or a path to the raw .csv.gz file
+    columns: columns to read; None reads the columns registered for the table in table_schema.py
+             (every column for tables that are not registered)
+    filters: list of (column, op, value) tuples, op one of '==', '!=', '<', '<=', '>', '>=', 'in', 'not in'.
+             On Parquet the filters are pushed down to the reader; on a partitioned table
+             filters on the partition key also skip the buckets that cannot match.
+    parse_dates: time columns to parse, in addition to the registered time columns
+    dtype: dtypes to apply to the loaded columns, overriding the registered ones"""
+    plan = _ReadPlan(name, mimic4_path, columns, filters, parse_dates, dtype)
+    if plan.dataset is not None:
+        df = plan.dataset.to_table(columns=plan.columns, filter=filter_expression(filters) if filters else None).to_pandas()
+    else:
+        df = filter_frame(pd.read_csv(plan.csv_path, **plan.csv_args()), filters)
+    return plan.finish(df)
+
+
+def iter_table(name: str, chunksize: int, columns=None, filters=None, mimic4_path=None, parse_dates=None, dtype=None):
+    """Same as load_table but yields the table in chunks of about chunksize rows.
+    A raw gzip csv table indexed with gzip_index.py is parsed in parallel ranges by READ_WORKERS processes."""
+    plan = _ReadPlan(name, mimic4_path, columns, filters, parse_dates, dtype)
+    if plan.dataset is not None:
+        batches = plan.dataset.to_batches(columns=plan.columns, filter=filter_expression(filters) if filters else None, batch_size=chunksize)
+        # the reader returns at most batch_size rows per batch (one or more per row group / bucket file),
+        # so small batches are combined to keep the chunks close to chunksize
+        pending, rows = [], 0
+        for batch in batches:
+            if not batch.num_rows:
+                continue
+            pending.append(batch)
+            rows += batch.num_rows
+            if rows >= chunksize:
+                yield plan.finish(pa.Table.from_batches(pending).to_pandas())
+                pending, rows = [], 0
+        if pending:
+            yield plan.finish(pa.Table.from_batches(pending).to_pandas())
+    elif gzip_index.has_index(plan.csv_path) and READ_WORKERS > 1:
+        yield from _iter_indexed(plan, chunksize)
+    else:
+        for chunk in pd.read_csv(plan.csv_path, chunksize=chunksize, **plan.csv_args()):
+            yield plan.finish(filter_frame(chunk, filters))
+
+
+def _read_range(plan: _ReadPlan, header: bytes, start: int, end: int) -> pd.DataFrame:
+    """Parses one row-aligned byte range of an indexed gzip csv table (runs in a worker process)"""
+    data = gzip_index.read_range(plan.csv_path, start, end)
+    chunk = pd.read_csv(io.BytesIO(header + data), **{**plan.csv_args(), 'compression': None})
+    return plan.finish(filter_frame(chunk, plan.filters))
+
+
+def _iter_indexed(plan: _ReadPlan, chunksize: int):
+    """Yields the ranges of an indexed gzip csv table in file order while READ_WORKERS processes decompress
+    and parse the following ones. At most READ_WORKERS parsed ranges wait to be consumed."""
+    header = gzip_index.load_index(plan.csv_path)['header'].encode()
+    ranges = deque(gzip_index.split_ranges(plan.csv_path, chunksize))
+    with ProcessPoolExecutor(max_workers=READ_WORKERS, mp_context=process_context()) as pool:
+        running = deque()
+        try:
+            while ranges or running:
+                while ranges and len(running) < READ_WORKERS:
+                    start, end = ranges.popleft()
+                    running.append(pool.submit(_read_range, plan, header, start, end))
+                yield running.popleft().result()
+        finally:
+            for future in running:
+                future.cancel()
+
+
+_END = object()
+
+
+def prefetch(chunks, depth=1):
+    """Iterates over `chunks` (e.g. iter_table or pd.read_csv(..., chunksize=...)) while the following chunks
+    are decompressed and parsed on a background thread. At most `depth` chunks wait in the queue, so no more
+    than depth + 2 chunks are held in memory at a time."""
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # gives up once the consumer stopped iterating, so the thread never blocks on a full queue forever
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    return
+            put((_END, None))
+        except BaseException as e:
+            put((_END, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk, error = buffer.get()
+            if chunk is _END:
+                if error is not None:
+                    raise error
+                return
+            yield chunk
+    finally:
+        stop.set()
+
+
+if __name__ == '__main__':
+    # python utils/table_loader.py ./mimiciv/2.0 [--partition]
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    mimic4_path = args[0] if args else './mimiciv/2.0'
+    convert_to_parquet(mimic4_path)
+    if '--partition' in sys.argv:
+        partition_events(mimic4_path)
@@ -0,0 +1,93 @@
+import os
+
+# Formats of the MIMIC-IV time columns, passed to pd.to_datetime instead of letting pandas infer them
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
+
+# Columns the pipeline reads from every MIMIC-IV table, the compact dtypes they are loaded as and the
+# format of their time columns. load_table/iter_table use the columns when no projection is passed and
+# always apply the dtypes and formats (dtypes passed by the caller take precedence).
+# - ids are int32 (MIMIC-IV ids are below 2^31); hadm_id stays float64 where it can be missing (labevents),
+#   float32 cannot hold 8 digit ids exactly
+# - measured values are float32
+# - valueuom is categorical, it repeats a few dozen unit strings over hundreds of millions of rows
+# itemid and icd_code are kept as int32/object: the feature code groups on them and writes converted codes
+# into copies of icd_code, which categoricals would change (unobserved groups, new categories).
+# Columns missing from a MIMIC-IV version (e.g. 'race' in 1.0, 'ethnicity' in 2.0) are skipped.
+TABLE_SCHEMAS = {
+    ########################## HOSP / CORE ##########################
+    'admissions': {
+        'columns': ['subject_id', 'hadm_id', 'admittime', 'dischtime', 'deathtime', 'admission_type',
+                    'insurance', 'ethnicity', 'race', 'hospital_expire_flag'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32', 'hospital_expire_flag': 'int8'},
+        'dates': {'admittime': TIME_FORMAT, 'dischtime': TIME_FORMAT, 'deathtime': TIME_FORMAT},
+    },
+    'patients': {
+        'columns': ['subject_id', 'gender', 'anchor_age', 'anchor_year', 'anchor_year_group', 'dod'],
+        'dtype': {'subject_id': 'int32', 'anchor_age': 'int16', 'anchor_year': 'int16'},
+        'dates': {'dod': DATE_FORMAT},
+    },
+    'diagnoses_icd': {
+        'columns': ['subject_id', 'hadm_id', 'seq_num', 'icd_code', 'icd_version'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32', 'seq_num': 'int16', 'icd_version': 'int8'},
+        'dates': {},
+    },
+    'procedures_icd': {
+        'columns': ['subject_id', 'hadm_id', 'seq_num', 'chartdate', 'icd_code', 'icd_version'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32', 'seq_num': 'int16', 'icd_version': 'int8'},
+        'dates': {'chartdate': DATE_FORMAT},
+    },
+    'prescriptions': {
+        # ndc has 11 digits and missing values, so it stays float64
+        'columns': ['subject_id', 'hadm_id', 'drug', 'starttime', 'stoptime', 'ndc', 'dose_val_rx'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32'},
+        'dates': {'starttime': TIME_FORMAT, 'stoptime': TIME_FORMAT},
+    },
+    'labevents': {
+        'columns': ['subject_id', 'hadm_id', 'itemid', 'charttime', 'valuenum', 'valueuom'],
+        'dtype': {'subject_id': 'int32', 'itemid': 'int32', 'valuenum': 'float32', 'valueuom': 'category'},
+        'dates': {'charttime': TIME_FORMAT},
+    },
+    ########################## ICU ##########################
+    'icustays': {
+        'columns': ['subject_id', 'hadm_id', 'stay_id', 'first_careunit', 'last_careunit', 'intime', 'outtime', 'los'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32', 'stay_id': 'int32'},
+        'dates': {'intime': TIME_FORMAT, 'outtime': TIME_FORMAT},
+    },
+    'chartevents': {
+        'columns': ['subject_id', 'hadm_id', 'stay_id', 'itemid', 'charttime', 'valuenum', 'valueuom'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32', 'stay_id': 'int32', 'itemid': 'int32',
+                  'valuenum': 'float32', 'valueuom': 'category'},
+        'dates': {'charttime': TIME_FORMAT},
+    },
+    'outputevents': {
+        'columns': ['subject_id', 'hadm_id', 'stay_id', 'itemid', 'charttime', 'value'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32', 'stay_id': 'int32', 'itemid': 'int32', 'value': 'float32'},
+        'dates': {'charttime': TIME_FORMAT},
+    },
+    'procedureevents': {
+        'columns': ['subject_id', 'hadm_id', 'stay_id', 'itemid', 'starttime', 'endtime'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32', 'stay_id': 'int32', 'itemid': 'int32'},
+        'dates': {'starttime': TIME_FORMAT, 'endtime': TIME_FORMAT},
+    },
+    'inputevents': {
+        'columns': ['subject_id', 'hadm_id', 'stay_id', 'itemid', 'starttime', 'endtime', 'amount', 'rate', 'orderid'],
+        'dtype': {'subject_id': 'int32', 'hadm_id': 'int32', 'stay_id': 'int32', 'itemid': 'int32',
+                  'amount': 'float32', 'rate': 'float32', 'orderid': 'int32'},
+        'dates': {'starttime': TIME_FORMAT, 'endtime': TIME_FORMAT},
+    },
+}
+
+
+def table_key(name: str) -> str:
+    """Registry key of a table given as 'hosp/labevents', a .csv.gz/.parquet path or a partition folder"""
+    base = os.path.basename(os.path.normpath(name))
+    for ext in ('.csv.gz', '.parquet', '.parts'):
+        if base.endswith(ext):
+            return base[:-len(ext)]
+    return base
+
+
+def get_schema(name: str):
+    """Schema registered for a table, None for tables that are not in the registry"""
+    return TABLE_SCHEMAS.get(table_key(name))